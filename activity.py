@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Module activity.py answers questions about editing activity from the rollup
+tables built by csv_to_database.py ('contributors', 'user_daily_activity',
+'user_monthly_activity' and 'changeset_activity'). Each query reads a range of
+an indexed rollup table instead of scanning 'nodes' and 'ways', and results
+are served from a query_cache.QueryCache until the database is reloaded.
+
+Acknowledgments:
+[1] https://www.sqlite.org/lang_datefunc.html
+"""
+
+import calendar
+import datetime
+import sqlite3
+
+from query_cache import QueryCache, fetchall
+
+
+DB = 'mydb.db'
+"""str: Path to the sqlite database to be queried."""
+
+CACHE = QueryCache()
+"""query_cache.QueryCache: Default cache of query results."""
+
+SECONDS_PER_DAY = 86400
+"""int: Number of seconds in a day."""
+
+
+def to_day(date):
+    """Convert a date to the number of days since 1970-01-01.
+
+    Parameters
+    ----------
+    date : str or datetime.date
+        The date, as a datetime.date or a 'YYYY-MM-DD' string.
+
+    Returns
+    -------
+    int
+        The day number used by the rollup tables.
+    """
+    if not isinstance(date, datetime.date):
+        date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+    return calendar.timegm(date.timetuple()) // SECONDS_PER_DAY
+
+
+def run_query(db, query, params, cache=CACHE):
+    """Run a query, serving the result from the cache if possible.
+
+    Parameters
+    ----------
+    db : str
+        Path to the sqlite database.
+
+    query : str
+        The query text.
+
+    params : tuple
+        The query parameters.
+
+    cache : query_cache.QueryCache
+        Cache of query results, or None to always run the query.
+
+    Returns
+    -------
+    list
+        The rows returned by the query.
+    """
+    conn = sqlite3.connect(db)
+    try:
+        return fetchall(conn, db, query, params, cache)
+    finally:
+        conn.close()
+
+
+def activity_in_range(start, end, uid=None, db=DB, cache=CACHE):
+    """Count the edits made on each day of a date range.
+
+    Parameters
+    ----------
+    start, end : str or datetime.date
+        First and last day of the range, inclusive.
+
+    uid : int
+        If given, only the edits of this user are counted.
+
+    db : str
+        Path to the sqlite database.
+
+    cache : query_cache.QueryCache
+        Cache of query results, or None to always run the query.
+
+    Returns
+    -------
+    list
+        ('YYYY-MM-DD', nodes, ways, edits) for each day with edits, in date
+        order.
+    """
+    params = (to_day(start), to_day(end))
+    user_filter = ''
+    if uid is not None:
+        user_filter = 'AND uid = ?'
+        params += (uid,)
+    query = '''SELECT date(day * 86400, 'unixepoch'), SUM(nodes), SUM(ways),
+                      SUM(edits)
+               FROM user_daily_activity
+               WHERE day BETWEEN ? AND ? %s
+               GROUP BY day
+               ORDER BY day;''' % user_filter
+    return run_query(db, query, params, cache)
+
+
+def top_contributors(year=None, limit=10, db=DB, cache=CACHE):
+    """Find the users with the most edits in a year.
+
+    Parameters
+    ----------
+    year : int
+        The year. Defaults to the current year (UTC).
+
+    limit : int
+        Number of users returned.
+
+    db : str
+        Path to the sqlite database.
+
+    cache : query_cache.QueryCache
+        Cache of query results, or None to always run the query.
+
+    Returns
+    -------
+    list
+        (user, uid, edits) for the most active users, most edits first.
+    """
+    if year is None:
+        year = datetime.datetime.utcnow().year
+    query = '''SELECT c.user, a.uid, SUM(a.edits) AS total
+               FROM user_monthly_activity a
+               JOIN contributors c ON c.uid = a.uid
+               WHERE a.month BETWEEN ? AND ?
+               GROUP BY a.uid
+               ORDER BY total DESC, a.uid
+               LIMIT ?;'''
+    return run_query(db, query, (year * 100 + 1, year * 100 + 12, limit),
+                     cache)
+
+
+def changesets_in_range(start, end, db=DB, cache=CACHE):
+    """List the changesets whose first edit falls in a date range.
+
+    Parameters
+    ----------
+    start, end : str or datetime.date
+        First and last day of the range, inclusive.
+
+    db : str
+        Path to the sqlite database.
+
+    cache : query_cache.QueryCache
+        Cache of query results, or None to always run the query.
+
+    Returns
+    -------
+    list
+        (changeset, uid, nodes, ways, first_epoch, last_epoch) for each
+        changeset, in order of first edit.
+    """
+    query = '''SELECT changeset, uid, nodes, ways, first_epoch, last_epoch
+               FROM changeset_activity
+               WHERE first_epoch >= ? AND first_epoch < ?
+               ORDER BY first_epoch, changeset;'''
+    return run_query(db, query, (to_day(start) * SECONDS_PER_DAY,
+                                 (to_day(end) + 1) * SECONDS_PER_DAY), cache)
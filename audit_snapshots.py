@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Module audit_snapshots.py saves the field counts of an audit by audit_tags.py
+(tag keys, street types, cities, zip codes and phone numbers) to a snapshot
+file, and compares the counts of a new audit with those of a baseline
+snapshot. Only the values that are new, gone, or counted differently are
+reported, so that a data-quality regression in a refreshed extract stands
+out without reading the whole report.
+
+A snapshot is a gzip-compressed JSON document:
+
+    {"format": 1, "sources": ["Rochester.osm"], "scale": 1,
+     "approximate": false, "fields": {"cities": {"Rochester": 1234, ...}}}
+
+Counts are stored already scaled, so a snapshot of a sampled audit holds
+estimated totals. For an approximate audit only the tracked heavy hitters
+are stored, and a value missing from such a snapshot may merely have been
+too rare to be tracked.
+
+Acknowledgments:
+[1] https://docs.python.org/2/library/gzip.html
+[2] https://docs.python.org/2/library/json.html
+"""
+
+import gzip
+import json
+import os
+import time
+
+
+SNAPSHOT_FORMAT = 1
+"""int: Version of the snapshot layout, checked when loading."""
+
+
+def snapshot_counts(counts, scale=1):
+    """Convert the counter of an audited field into a plain dict.
+
+    Parameters
+    ----------
+    counts : sketches.ExactCounter or sketches.FieldSketch
+        Counts of the distinct values of a field.
+
+    scale : float
+        Factor applied to each count. Defaults to 1.
+
+    Returns
+    -------
+    dict
+        The (estimated total) count of each value.
+    """
+    return dict((value, int(round(counts[value] * scale)))
+                for value in counts.keys())
+
+
+def save_snapshot(path, fields, sources=(), scale=1, approximate=False):
+    """Write the field counts of an audit to a snapshot file.
+
+    The snapshot is written to a temporary file that then replaces path, so
+    an interrupted run never leaves a truncated baseline behind.
+
+    Parameters
+    ----------
+    path : str
+        Path to the snapshot file.
+
+    fields : dict
+        A counter for each audited field, as returned by
+        audit_tags.count_fields.
+
+    sources : tuple
+        Paths to the audited files, recorded in the snapshot.
+
+    scale : float
+        Factor that turns the counts into estimated totals. Defaults to 1.
+
+    approximate : bool
+        True if the counts come from sketches.
+    """
+    snapshot = {
+        'format': SNAPSHOT_FORMAT,
+        'created': int(time.time()),
+        'sources': [os.path.abspath(source) for source in sources],
+        'scale': scale,
+        'approximate': approximate,
+        'fields': dict((name, snapshot_counts(counts, scale))
+                       for name, counts in fields.iteritems())
+    }
+    temp_path = path + '.tmp'
+    fout = gzip.open(temp_path, 'wb')
+    try:
+        json.dump(snapshot, fout, separators=(',', ':'), sort_keys=True)
+    finally:
+        fout.close()
+    os.rename(temp_path, path)
+
+
+def load_snapshot(path):
+    """Read a snapshot file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the snapshot file.
+
+    Returns
+    -------
+    dict
+        The snapshot; its 'fields' entry holds the count of each value of
+        each audited field.
+
+    Raises
+    ------
+    ValueError
+        If the file was written in an unknown snapshot format.
+    """
+    fin = gzip.open(path, 'rb')
+    try:
+        snapshot = json.load(fin)
+    finally:
+        fin.close()
+    if snapshot.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError("Unknown snapshot format in '%s'." % path)
+    return snapshot
+
+
+def diff_counts(baseline, current):
+    """Compare the counts of one field.
+
+    Parameters
+    ----------
+    baseline : dict
+        The count of each value in the baseline.
+
+    current : dict
+        The count of each value in the new audit.
+
+    Returns
+    -------
+    dict
+        'new': values missing from the baseline, with their counts;
+        'removed': values missing from the new audit, with their baseline
+        counts; 'changed': other values whose count differs, with their
+        (baseline, new) counts.
+    """
+    diff = {'new': {}, 'removed': {}, 'changed': {}}
+    for value, count in current.iteritems():
+        if value not in baseline:
+            diff['new'][value] = count
+        elif baseline[value] != count:
+            diff['changed'][value] = (baseline[value], count)
+    for value, count in baseline.iteritems():
+        if value not in current:
+            diff['removed'][value] = count
+    return diff
+
+
+def diff_snapshots(baseline, current):
+    """Compare the field counts of two audits.
+
+    Parameters
+    ----------
+    baseline : dict
+        The baseline snapshot, as returned by load_snapshot.
+
+    current : dict
+        The count of each value of each field in the new audit, e.g. the
+        'fields' entry of a snapshot.
+
+    Returns
+    -------
+    dict
+        The diff_counts result for each field of the new audit.
+    """
+    return dict((name, diff_counts(baseline['fields'].get(name, {}), counts))
+                for name, counts in current.iteritems())
+
+
+def print_diff(diff, new_only=False):
+    """Print the differences found by diff_snapshots.
+
+    Parameters
+    ----------
+    diff : dict
+        The differences of each field.
+
+    new_only : bool
+        True to print the new values only, e.g. when the new audit covers
+        part of the data.
+    """
+    sort_key = lambda s: (s.lower(), s)
+    for name in sorted(diff):
+        field = diff[name]
+        print "#" * 10, name.upper(), "#" * 10
+        if new_only:
+            print "%d new" % len(field['new'])
+        else:
+            print "%d new, %d removed, %d changed" % (
+                len(field['new']), len(field['removed']),
+                len(field['changed']))
+        for value in sorted(field['new'], key=sort_key):
+            print "+ %s: %d" % (value, field['new'][value])
+        if not new_only:
+            for value in sorted(field['removed'], key=sort_key):
+                print "- %s: %d" % (value, field['removed'][value])
+            for value in sorted(field['changed'], key=sort_key):
+                print "~ %s: %d -> %d" % ((value,) + field['changed'][value])
+        print "\n"
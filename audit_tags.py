@@ -6,28 +6,54 @@ elements for errors. Specifically, the script looks for:
  - Street names that are abbreviated
  - Incorrect zip codes
  - Incorrect phone numbers
+
+The counts can be saved to a snapshot and compared with a baseline snapshot
+of an earlier audit, and the elements created or modified by an osmChange
+file can be audited against such a baseline without auditing the full file.
  
 Acknowledgments:
 [1] https://classroom.udacity.com/nanodegrees/nd002/parts/0021345404/modules/
     316820862075461/lessons/5436095827/concepts/54456296460923#
 [2] https://classroom.udacity.com/nanodegrees/nd002/parts/0021345404/modules/
     316820862075461/lessons/5436095827/concepts/54446302850923#
+[3] https://wiki.openstreetmap.org/wiki/OsmChange
 """
 
 from collections import defaultdict
+from multiprocessing import Pool, cpu_count
 import pprint
 import re
 import xml.etree.cElementTree as ET
 
+from audit_snapshots import (diff_snapshots, load_snapshot, print_diff,
+                             save_snapshot, snapshot_counts)
+from osm_shards import iter_shard_elements, shard_offsets
+from sampling import ElementSampler
+from sketches import ExactCounter, FieldSketch
+
 
 FILENAME = "Rochester.osm"
 """str: Path to OpenStreetMaps XML file to be analyzed."""
 
+PROBLEM_CHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+"""re.RegexObject: Regular expression to identify problematic characters."""
+
+STREET_TAG = re.compile(r'^(addr:street)\w*')
+"""re.RegexObject: Regular expression to identify street address keys."""
+
+# Assume that street abbreviations, if they exist, will be the last word 
+# character at the end of the full street string
+STREET_NAME = re.compile(r'\b\w+\b$')
+"""re.RegexObject: Regular expression to extract the street type."""
+
+KEY_CATEGORIES = ('fixme', 'tiger', 'gnis', 'problem', 'other')
+"""tuple: Categories of tag keys counted by categorize_keys."""
+
 ################################################################################
 #                              HELPER FUNCTIONS                                #
 ################################################################################
 
-def print_sorted_dict(d):
+def print_sorted_dict(d, scale=1):
     """Print key/value pairs from a dictionary, sorted by key.
     
     Parameters
@@ -35,15 +61,60 @@ def print_sorted_dict(d):
     
     d : dict
         A dictionary with keys of type 'str'.
+
+    scale : float
+        Factor applied to each value before printing, used to turn counts
+        from a sample into estimated totals. Defaults to 1.
     """
     keys = d.keys()
-    keys = sorted(keys, key=lambda s: s.lower())
+    keys = sorted(keys, key=lambda s: (s.lower(), s))
     for k in keys:
         v = d[k]
-        print "%s: %d" % (k, v)
+        if isinstance(d, FieldSketch):
+            print "%s: %d (error <= %d)" % (k, int(round(v * scale)),
+                                            int(round(d.error(k) * scale)))
+        else:
+            print "%s: %d" % (k, int(round(v * scale)))
+
+
+def print_counts(counts, scale=1):
+    """Print the counts of an audited field, with error bounds if approximate.
+    
+    Parameters
+    ----------
+    counts : sketches.ExactCounter or sketches.FieldSketch
+        Counts of the distinct values of a field.
+
+    scale : float
+        Factor applied to each count before printing. Defaults to 1.
+    """
+    if isinstance(counts, FieldSketch):
+        print "Distinct values (estimate): %d (relative error %.1f%%)" % \
+            (len(counts), 100 * counts.distinct.relative_error)
+        print "Heavy hitters shown; counts overestimate by at most the error"
+    print_sorted_dict(counts, scale)
+
+
+def make_counter(approximate=False):
+    """Create a counter for the distinct values of an audited field.
+    
+    Parameters
+    ----------
+    approximate : bool
+        True for a bounded-memory sketch, False for an exact count.
+        
+    Returns
+    -------
+    sketches.ExactCounter or sketches.FieldSketch
+        An empty counter.
+    """
+    if approximate:
+        return FieldSketch()
+    return ExactCounter()
      
         
-def iter_elements(filename=FILENAME, tags=('node', 'way', 'relation')):
+def iter_elements(filename=FILENAME, tags=('node', 'way', 'relation'),
+                  sample_every=None, sample_fraction=None, way_nodes=True):
     """Yield an OSM element if it is a node, way, or relation.
     
     Parameters
@@ -54,6 +125,16 @@ def iter_elements(filename=FILENAME, tags=('node', 'way', 'relation')):
         tags : tuple
             The type of tags to be yielded by the function. Defaults to nodes, 
             ways, and relations.
+        sample_every : int
+            If given, only every Kth element of each type is yielded, plus the
+            nodes referenced by the yielded ways.
+        sample_fraction : float
+            If given, only elements whose hashed id falls below this fraction
+            are yielded, plus the nodes referenced by the yielded ways.
+        way_nodes : bool
+            Whether a sample also includes the nodes referenced by the sampled
+            ways. The audit turns this off, since those extra nodes would bias
+            the scaled estimates. Defaults to True.
             
     Yields
     ------
@@ -61,15 +142,315 @@ def iter_elements(filename=FILENAME, tags=('node', 'way', 'relation')):
             An element of the OSM file that belongs to a type identified in the 
             parameter tags.
     """
+    sampler = None
+    if sample_every or sample_fraction:
+        sampler = ElementSampler(sample_every, sample_fraction)
+        if way_nodes and 'node' in tags:
+            sampler.collect_way_nodes(iter_elements(filename, tags=('way',)))
+
     context = ET.iterparse(filename, events=('start', 'end'))
     _, root = next(context)
     for event, elem in context:
         if event == 'end' and elem.tag in tags:
-            yield elem
+            if sampler is None or sampler.keep(elem):
+                yield elem
             root.clear()
     
+
+
+def iter_change_elements(filename, tags=('node', 'way', 'relation')):
+    """Yield the elements created or modified by an osmChange file.
+    
+    Parameters
+    ----------
+    filename : str
+        Path to the osmChange (.osc) file.
+
+    tags : tuple
+        The type of elements to be yielded. Defaults to nodes, ways, and
+        relations.
             
-def aggregate_tag_keys(filename=FILENAME):
+    Yields
+    ------
+    xml.etree.cElementTree.Element
+        A new version of an element, from a 'create' or 'modify' block.
+    """
+    context = ET.iterparse(filename, events=('start', 'end'))
+    _, root = next(context)
+    action = None
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag in ('create', 'modify', 'delete'):
+                action = elem
+        elif elem.tag in tags:
+            if action is not None and action.tag != 'delete':
+                yield elem
+            if action is not None:
+                action.clear()
+        elif elem is action:
+            action = None
+            root.clear()
+
+            
+def tag_key(key, value):
+    """Extract the value counted by aggregate_tag_keys: the key itself."""
+    return key
+
+
+def street_abbrev(key, value):
+    """Extract the value counted by aggregate_street_abbrevs: the last word of
+    a street address."""
+    if STREET_TAG.search(key):
+        street = STREET_NAME.search(value)
+        if street:
+            return street.group()
+
+
+def key_category(key, value):
+    """Extract the value counted in the 'key_categories' field: the category
+    of the key, one of KEY_CATEGORIES."""
+    if PROBLEM_CHARS.search(key):
+        return 'problem'
+    elif ('FIXME' in key) or ('fixme' in key):
+        return 'fixme'
+    elif 'tiger' in key:
+        return 'tiger'
+    elif 'gnis' in key:
+        return 'gnis'
+    return 'other'
+
+
+def problem_key(key, value):
+    """Extract the value counted in the 'problem_keys' field: a key with
+    problem characters."""
+    if PROBLEM_CHARS.search(key):
+        return key
+
+
+def addr_key(key, value):
+    """Extract the value counted in the 'addr_keys' field: a key related to
+    address."""
+    if 'addr' in key:
+        return key
+
+
+def city_name(key, value):
+    """Extract the value counted by aggregate_cities."""
+    if key == 'addr:city':
+        return value
+
+
+def zip_code(key, value):
+    """Extract the value counted by aggregate_zips."""
+    if key == 'addr:postcode':
+        return value
+
+
+def phone_number(key, value):
+    """Extract the value counted by aggregate_phone_numbers."""
+    if 'phone' in key:
+        return value
+
+
+AUDIT_FIELDS = (('keys', tag_key),
+                ('key_categories', key_category),
+                ('problem_keys', problem_key),
+                ('addr_keys', addr_key),
+                ('streets', street_abbrev),
+                ('cities', city_name),
+                ('zips', zip_code),
+                ('phone_numbers', phone_number))
+"""tuple: Name and extractor function of each audited field."""
+
+EXACT_FIELDS = ('key_categories', 'problem_keys', 'addr_keys')
+"""tuple: Fields counted exactly even in approximate mode. They have few
+distinct values, and the rare ones, which a sketch would drop from its heavy
+hitters, are what the audit is looking for."""
+
+
+def count_fields(elements, fields=AUDIT_FIELDS, approximate=False):
+    """Count the values of several audited fields in a single pass.
+    
+    Parameters
+    ----------
+    elements : iterable
+        OSM elements to be audited.
+
+    fields : tuple
+        Pairs of field name and extractor function. An extractor takes the key
+        and value of a tag and returns the value to be counted, or None.
+
+    approximate : bool
+        If True, values are counted with a bounded-memory sketch instead of
+        exactly, except for the fields in EXACT_FIELDS. Defaults to False.
+        
+    Returns
+    -------
+    dict
+        A counter for each field name.
+    """
+    counters = [(make_counter(approximate and name not in EXACT_FIELDS),
+                 extractor)
+                for name, extractor in fields]
+    for element in elements:
+        for subelement in element:
+            if (subelement.tag == 'tag') and ('k' in subelement.attrib):
+                key = subelement.get('k')
+                value = subelement.get('v')
+                for counter, extractor in counters:
+                    counted = extractor(key, value)
+                    if counted is not None:
+                        counter.add(counted)
+    return dict((name, counter) for (name, _), (counter, _) in
+                zip(fields, counters))
+
+
+def merge_fields(partials, approximate=False):
+    """Combine the field counts of separate parts of the input.
+    
+    Parameters
+    ----------
+    partials : iterable
+        Dictionaries returned by count_fields.
+
+    approximate : bool
+        Whether the parts were counted with sketches, for the empty counters
+        returned if there are no parts. Defaults to False.
+        
+    Returns
+    -------
+    dict
+        A counter for each field name, covering all parts. Empty counters if
+        there are no parts, e.g. for files without elements.
+    """
+    merged = None
+    for partial in partials:
+        if merged is None:
+            merged = partial
+        else:
+            for name, counter in partial.iteritems():
+                merged[name].merge(counter)
+    if merged is None:
+        merged = count_fields((), approximate=approximate)
+    return merged
+
+
+def aggregate_field(filename, extractor, sample_every=None,
+                    sample_fraction=None, approximate=False):
+    """Count the values of one audited field.
+    
+    Parameters
+    ----------
+    filename : str
+        A string containing the path to an OSM file.
+
+    extractor : function
+        Function of the key and value of a tag that returns the value to be
+        counted, or None.
+
+    sample_every : int
+        If given, only every Kth element of each type is audited.
+
+    sample_fraction : float
+        If given, only elements whose hashed id falls below this fraction are
+        audited.
+
+    approximate : bool
+        If True, values are counted with a bounded-memory sketch instead of
+        exactly. Defaults to False.
+        
+    Returns
+    -------
+    sketches.ExactCounter or sketches.FieldSketch
+        Counts of the extracted values.
+    """
+    elements = iter_elements(filename, sample_every=sample_every,
+                             sample_fraction=sample_fraction, way_nodes=False)
+    fields = (('field', extractor),)
+    return count_fields(elements, fields, approximate)['field']
+
+
+def categorize_keys(keys):
+    """Count tag keys in five categories.
+    
+    Parameters
+    ----------
+    keys : dict
+        Counts of tag keys, as returned by aggregate_tag_keys.
+        
+    Returns
+    -------
+    dict
+        A dictionary containing counts of five categories of tags: (i) 'fixme', 
+        (ii) 'tiger', (iii) 'gnis', (iv) problematic characters, and (v) other.
+    """
+    key_categories = dict.fromkeys(KEY_CATEGORIES, 0)
+    for key in keys:
+        key_categories[key_category(key, None)] += keys[key]
+    return key_categories
+
+
+def category_counts(categories):
+    """Complete the counts of the 'key_categories' field.
+    
+    Parameters
+    ----------
+    categories : sketches.ExactCounter
+        Counts of key categories, as counted by count_fields.
+        
+    Returns
+    -------
+    dict
+        The count of each of the five categories of categorize_keys,
+        including those that were not seen.
+    """
+    return dict((category, categories.get(category, 0))
+                for category in KEY_CATEGORIES)
+
+
+def problem_keys(keys):
+    """Select the tag keys that contain problem characters.
+    
+    Parameters
+    ----------
+    keys : dict
+        Counts of tag keys, as returned by aggregate_tag_keys.
+        
+    Returns
+    -------
+    collections.defaultdict
+        A dictionary containing counts of specific problematic keys.
+    """
+    problems = defaultdict(int)
+    for key in keys:
+        if PROBLEM_CHARS.search(key):
+            problems[key] += 1
+    return problems
+
+
+def addr_keys(keys):
+    """Select the tag keys that contain information related to address.
+    
+    Parameters
+    ----------
+    keys : dict
+        Counts of tag keys, as returned by aggregate_tag_keys.
+        
+    Returns
+    -------
+    collections.defaultdict
+        A dictionary containing counts of keys that indicate an address 
+        component.
+    """
+    addresses = defaultdict(int)
+    for key in keys:
+        if 'addr' in key:
+            addresses[key] += keys[key]
+    return addresses
+
+
+def aggregate_tag_keys(filename=FILENAME, sample_every=None,
+                       sample_fraction=None, approximate=False):
     """Compile all the keys found in tag subelements.
     
     Parameters
@@ -77,21 +458,29 @@ def aggregate_tag_keys(filename=FILENAME):
     filename : str
         A string containing the path to an OSM file. Defaults to the module 
         level variable FILENAME.
+
+    sample_every : int
+        If given, only every Kth element of each type is audited.
+
+    sample_fraction : float
+        If given, only elements whose hashed id falls below this fraction are
+        audited.
+
+    approximate : bool
+        If True, values are counted with a bounded-memory sketch instead of
+        exactly. Defaults to False.
         
     Returns
     -------
-    collections.defaultdict
+    sketches.ExactCounter or sketches.FieldSketch
         A dictionary containing counts of all the tag keys in an OSM file.
     """
-    keys = defaultdict(int)
-    for element in iter_elements(filename):
-        for subelement in element:
-            if (subelement.tag == 'tag') and ('k' in subelement.attrib):
-                keys[subelement.get('k')] += 1
-    return keys
+    return aggregate_field(filename, tag_key, sample_every,
+                           sample_fraction, approximate)
 
 
-def categorize_tags(filename=FILENAME):
+def categorize_tags(filename=FILENAME, sample_every=None,
+                    sample_fraction=None, approximate=False):
     """Compile all the keys that contain problem characters.
     
     Parameters
@@ -99,6 +488,17 @@ def categorize_tags(filename=FILENAME):
     filename : str
         A string containing the path to an OSM file. Defaults to the module 
         level variable FILENAME.
+
+    sample_every : int
+        If given, only every Kth element of each type is audited.
+
+    sample_fraction : float
+        If given, only elements whose hashed id falls below this fraction are
+        audited.
+
+    approximate : bool
+        Ignored: the keys are counted exactly, since the rare ones are what
+        is looked for. Kept for the signature of the other aggregations.
         
     Returns
     -------
@@ -106,24 +506,13 @@ def categorize_tags(filename=FILENAME):
         A dictionary containing counts of five categories of tags: (i) 'fixme', 
         (ii) 'tiger', (iii) 'gnis', (iv) problematic characters, and (v) other.
     """
-    problem_chars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
-    key_categories = {'fixme':0, 'tiger':0, 'gnis':0, 'problem':0, 'other':0}
-    keys = aggregate_tag_keys(filename)
-    for key in keys:
-        if problem_chars.search(key):
-            key_categories['problem'] += keys[key]
-        elif ('FIXME' in key) or ('fixme' in key):
-            key_categories['fixme'] += keys[key]
-        elif 'tiger' in key:
-            key_categories['tiger'] += keys[key]
-        elif 'gnis' in key:
-            key_categories['gnis'] += keys[key]
-        else:
-            key_categories['other'] += keys[key]
-    return key_categories
+    categories = aggregate_field(filename, key_category, sample_every,
+                                 sample_fraction)
+    return category_counts(categories)
 
 
-def aggregate_problem_tags(filename=FILENAME):
+def aggregate_problem_tags(filename=FILENAME, sample_every=None,
+                           sample_fraction=None, approximate=False):
     """Compile all tags that contain problem characters.
     
     Parameters
@@ -131,23 +520,31 @@ def aggregate_problem_tags(filename=FILENAME):
     filename : str
         A string containing the path to an OSM file. Defaults to the module 
         level variable FILENAME.
-    
+
+    sample_every : int
+        If given, only every Kth element of each type is audited.
+
+    sample_fraction : float
+        If given, only elements whose hashed id falls below this fraction are
+        audited.
+
+    approximate : bool
+        Ignored: the keys are counted exactly, since the rare ones are what
+        is looked for. Kept for the signature of the other aggregations.
+        
     Returns
     -------
     collections.defaultdict
         A dictionary containing counts of specific problematic keys in the OSM
         file.
     """
-    problem_keys = defaultdict(int)
-    problem_chars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
-    keys = aggregate_tag_keys(filename)
-    for key in keys:
-        if problem_chars.search(key):
-            problem_keys[key] += 1
-    return problem_keys
-      
+    keys = aggregate_field(filename, problem_key, sample_every,
+                           sample_fraction)
+    return problem_keys(keys)
+
     
-def aggregate_addr_tags(filename=FILENAME):
+def aggregate_addr_tags(filename=FILENAME, sample_every=None,
+                        sample_fraction=None, approximate=False):
     """Compile all tags that contain information related to address.
     
     Parameters
@@ -155,6 +552,17 @@ def aggregate_addr_tags(filename=FILENAME):
     filename : str
         A string containing the path to an OSM file. Defaults to the module 
         level variable FILENAME.
+
+    sample_every : int
+        If given, only every Kth element of each type is audited.
+
+    sample_fraction : float
+        If given, only elements whose hashed id falls below this fraction are
+        audited.
+
+    approximate : bool
+        Ignored: the keys are counted exactly, since the rare ones are what
+        is looked for. Kept for the signature of the other aggregations.
         
     Returns
     -------
@@ -162,15 +570,13 @@ def aggregate_addr_tags(filename=FILENAME):
         A dictionary containing counts of keys that indicate an address 
         component.
     """
-    addr_keys = defaultdict(int)
-    keys = aggregate_tag_keys(filename)
-    for key in keys:
-        if 'addr' in key:
-            addr_keys[key] += keys[key]
-    return addr_keys
-    
+    keys = aggregate_field(filename, addr_key, sample_every,
+                           sample_fraction)
+    return addr_keys(keys)
+
     
-def aggregate_street_abbrevs(filename=FILENAME):
+def aggregate_street_abbrevs(filename=FILENAME, sample_every=None,
+                             sample_fraction=None, approximate=False):
     """Compile abbreviations found in tags related to address.
     
     Parameters
@@ -178,33 +584,30 @@ def aggregate_street_abbrevs(filename=FILENAME):
     filename : str
         A string containing the path to an OSM file. Defaults to the module 
         level variable FILENAME.
+
+    sample_every : int
+        If given, only every Kth element of each type is audited.
+
+    sample_fraction : float
+        If given, only elements whose hashed id falls below this fraction are
+        audited.
+
+    approximate : bool
+        If True, values are counted with a bounded-memory sketch instead of
+        exactly. Defaults to False.
         
     Returns
     -------
-    collections.defaultdict
+    sketches.ExactCounter or sketches.FieldSketch
         A dictionary containing counts of common street abbreviations found in
         tags.
     """
-    streets = defaultdict(int)
-    street_tag = re.compile(r'^(addr:street)\w*')
-    
-    # Assume that street abbreviations, if they exist, will be the last word 
-    # character at the end of the full street string
-    street_name = re.compile(r'\b\w+\b$')
-    
-    for element in iter_elements(filename):
-        for subelement in element:
-            if subelement.tag == 'tag' \
-            and ('k' in subelement.attrib):
-                key = subelement.get('k')
-                if street_tag.search(key):
-                    street = street_name.search(subelement.get('v'))
-                    if street:
-                        streets[street.group()] += 1
-    return streets
+    return aggregate_field(filename, street_abbrev, sample_every,
+                           sample_fraction, approximate)
 
 
-def aggregate_cities(filename=FILENAME):
+def aggregate_cities(filename=FILENAME, sample_every=None,
+                     sample_fraction=None, approximate=False):
     """Compile city names.
     
     Parameters
@@ -212,24 +615,29 @@ def aggregate_cities(filename=FILENAME):
     filename : str
         A string containing the path to an OSM file. Defaults to the module 
         level variable FILENAME.
+
+    sample_every : int
+        If given, only every Kth element of each type is audited.
+
+    sample_fraction : float
+        If given, only elements whose hashed id falls below this fraction are
+        audited.
+
+    approximate : bool
+        If True, values are counted with a bounded-memory sketch instead of
+        exactly. Defaults to False.
         
     Returns
     -------
-    collections.defaultdict
+    sketches.ExactCounter or sketches.FieldSketch
         A dictionary containing counts of unique city names in the OSM file.
     """
-    cities = defaultdict(int)
-    for element in iter_elements(filename):
-        for subelement in element:
-            if subelement.tag == 'tag' \
-            and ('k' in subelement.attrib) \
-            and (subelement.get('k') == 'addr:city'):
-                key = subelement.get('v')
-                cities[key] += 1
-    return cities    
-        
+    return aggregate_field(filename, city_name, sample_every,
+                           sample_fraction, approximate)
+
     
-def aggregate_zips(filename=FILENAME):
+def aggregate_zips(filename=FILENAME, sample_every=None,
+                   sample_fraction=None, approximate=False):
     """Compile zip codes.
     
     Parameters
@@ -237,94 +645,317 @@ def aggregate_zips(filename=FILENAME):
     filename : str
         A string containing the path to an OSM file. Defaults to the module 
         level variable FILENAME.
+
+    sample_every : int
+        If given, only every Kth element of each type is audited.
+
+    sample_fraction : float
+        If given, only elements whose hashed id falls below this fraction are
+        audited.
+
+    approximate : bool
+        If True, values are counted with a bounded-memory sketch instead of
+        exactly. Defaults to False.
         
     Returns
     -------
-    collections.defaultdict
+    sketches.ExactCounter or sketches.FieldSketch
         A dictionary containing counts of unique zip codes in the OSM file.
     """
-    zips = defaultdict(int)
-    for element in iter_elements(filename):
-        for subelement in element:
-            if subelement.tag == 'tag' \
-            and ('k' in subelement.attrib) \
-            and (subelement.get('k') == 'addr:postcode'):
-                key = subelement.get('v')
-                zips[key] += 1
-    return zips    
-    
+    return aggregate_field(filename, zip_code, sample_every,
+                           sample_fraction, approximate)
 
-def aggregate_phone_numbers(filename=FILENAME):
-    """Compile city names.
+    
+def aggregate_phone_numbers(filename=FILENAME, sample_every=None,
+                            sample_fraction=None, approximate=False):
+    """Compile phone numbers.
     
     Parameters
     ----------
     filename : str
         A string containing the path to an OSM file. Defaults to the module 
         level variable FILENAME.
+
+    sample_every : int
+        If given, only every Kth element of each type is audited.
+
+    sample_fraction : float
+        If given, only elements whose hashed id falls below this fraction are
+        audited.
+
+    approximate : bool
+        If True, values are counted with a bounded-memory sketch instead of
+        exactly. Defaults to False.
         
     Returns
     -------
-    collections.defaultdict
+    sketches.ExactCounter or sketches.FieldSketch
         A dictionary containing counts of unique phone numbers in the OSM file.
     """
-    phone_numbers = defaultdict(int)
-    for element in iter_elements(filename):
-        for subelement in element:
-            if subelement.tag == 'tag' \
-            and ('k' in subelement.attrib) \
-            and ('phone' in subelement.get('k')):
-                key = subelement.get('v')
-                phone_numbers[key] += 1
-    return phone_numbers
-    
+    return aggregate_field(filename, phone_number, sample_every,
+                           sample_fraction, approximate)
 
-################################################################################
-#                                MAIN FUNCTION                                 #
-#############################################@##################################
 
-def audit_osm_file(filename=FILENAME):
-    """Perform audit of OSM file.
+def print_audit_report(fields, scale=1):
+    """Print the audit report for a set of field counts.
     
     Parameters
     ----------
-    filename : str
-        A string containing the path to an OSM file. Defaults to the module 
-        level variable FILENAME.
+    fields : dict
+        A counter for each audited field, as returned by count_fields.
+
+    scale : float
+        Factor applied to each count before printing. Defaults to 1.
     """
-    keys = aggregate_tag_keys(filename)
+    keys = fields['keys']
+
+    if scale != 1:
+        print "Sampled audit: counts scaled by %g to estimate totals" % scale
+        print "\n"
 
     print "#################### KEYS ####################"
     print "Total unique keys: ", len(keys)
-    print_sorted_dict(keys)
+    print_sorted_dict(keys, scale)
 
     print "\n"
     print "############### KEY CATEGORIES ###############"
-    print_sorted_dict(categorize_tags(filename))
+    print_sorted_dict(category_counts(fields['key_categories']), scale)
 
     print "\n"
     print "################ PROBLEM KEYS ################"
-    print_sorted_dict(aggregate_problem_tags(filename))
+    print_sorted_dict(problem_keys(fields['problem_keys']))
 
     print "\n"
     print "########## KEYS RELATED TO ADDRESS ###########"
-    print_sorted_dict(aggregate_addr_tags(filename))
+    print_sorted_dict(fields['addr_keys'], scale)
 
     print "\n"
     print "############ STREET ABBREVIATIONS ############"
-    print_sorted_dict(aggregate_street_abbrevs(filename))
+    print_counts(fields['streets'], scale)
     
     print "\n"
     print "################### CITIES ###################"
-    print_sorted_dict(aggregate_cities(filename))
+    print_counts(fields['cities'], scale)
 
     print "\n"
     print "################# ZIP CODES ##################"
-    print_sorted_dict(aggregate_zips(filename))
+    print_counts(fields['zips'], scale)
     
     print "\n"
     print "################# ZIP CODES ##################"
-    print_sorted_dict(aggregate_phone_numbers(filename))
+    print_counts(fields['phone_numbers'], scale)
+
+
+def report_fields(fields, sources, scale=1, approximate=False, snapshot=None,
+                  baseline=None):
+    """Print the audit report or its differences from a baseline, and
+    optionally save the counts to a snapshot.
+    
+    Parameters
+    ----------
+    fields : dict
+        A counter for each audited field, as returned by count_fields.
+
+    sources : tuple
+        Paths to the audited files.
+
+    scale : float
+        Factor that turns the counts into estimated totals. Defaults to 1.
+
+    approximate : bool
+        True if the counts come from sketches.
+
+    snapshot : str
+        If given, path to which the counts are saved.
+
+    baseline : str
+        If given, path to the snapshot of an earlier audit. Only the values
+        that differ from it are printed instead of the full report.
+    """
+    if baseline is not None:
+        current = dict((name, snapshot_counts(counts, scale))
+                       for name, counts in fields.iteritems())
+        print_diff(diff_snapshots(load_snapshot(baseline), current))
+    else:
+        print_audit_report(fields, scale)
+    if snapshot is not None:
+        save_snapshot(snapshot, fields, sources, scale, approximate)
+
+
+def sample_scale(sample_every=None, sample_fraction=None):
+    """Return the factor that turns counts from a sample into estimated totals.
+    
+    Parameters
+    ----------
+    sample_every : int
+        Every Kth element of each type is audited.
+
+    sample_fraction : float
+        Elements whose hashed id falls below this fraction are audited.
+
+    Returns
+    -------
+    float
+        The scaling factor; 1 if no sampling is used.
+    """
+    if sample_every or sample_fraction:
+        return ElementSampler(sample_every, sample_fraction).scale
+    return 1
+
+
+def audit_shard(task):
+    """Count the audited fields of a byte range of an OSM file.
+    
+    Runs in a worker process of audit_osm_files.
+    
+    Parameters
+    ----------
+    task : tuple
+        The path to the OSM file, the start and end byte offsets of the range,
+        sample_every, sample_fraction, and approximate.
+        
+    Returns
+    -------
+    dict
+        A counter for each audited field.
+    """
+    filename, start, end, sample_every, sample_fraction, approximate = task
+    elements = iter_shard_elements(filename, start, end)
+    if sample_every or sample_fraction:
+        sampler = ElementSampler(sample_every, sample_fraction)
+        elements = (element for element in elements if sampler.keep(element))
+    return count_fields(elements, approximate=approximate)
+    
+
+################################################################################
+#                                MAIN FUNCTION                                 #
+#############################################@##################################
+
+def audit_osm_file(filename=FILENAME, sample_every=None,
+                   sample_fraction=None, approximate=False, snapshot=None,
+                   baseline=None):
+    """Perform audit of OSM file.
+    
+    Parameters
+    ----------
+    filename : str
+        A string containing the path to an OSM file. Defaults to the module 
+        level variable FILENAME.
+
+    sample_every : int
+        If given, only every Kth element of each type is audited.
+
+    sample_fraction : float
+        If given, only elements whose hashed id falls below this fraction are
+        audited.
+
+    approximate : bool
+        If True, values are counted with a bounded-memory sketch instead of
+        exactly. Defaults to False.
+
+    snapshot : str
+        If given, path to a snapshot file to which the counts are saved.
+
+    baseline : str
+        If given, path to the snapshot of an earlier audit; only the values
+        that are new, gone or counted differently are printed.
+    """
+    elements = iter_elements(filename, sample_every=sample_every,
+                             sample_fraction=sample_fraction, way_nodes=False)
+    fields = count_fields(elements, approximate=approximate)
+    report_fields(fields, (filename,),
+                  sample_scale(sample_every, sample_fraction), approximate,
+                  snapshot, baseline)
+
+
+def audit_osm_files(filenames=(FILENAME,), processes=None, shards=None,
+                    sample_every=None, sample_fraction=None,
+                    approximate=False, snapshot=None, baseline=None):
+    """Perform audit of one or more OSM files in parallel.
+
+    Each file is split into byte ranges that are audited in a pool of worker
+    processes; the partial counts are then merged. Without sampling or
+    sketches, the printed report is identical to that of audit_osm_file run
+    on the concatenated input.
+    
+    Parameters
+    ----------
+    filenames : tuple
+        Paths to the OSM files, e.g. several regional extracts. Defaults to
+        the module level variable FILENAME.
+
+    processes : int
+        Number of worker processes. Defaults to the number of CPUs.
+
+    shards : int
+        Number of byte ranges per file. Defaults to four per process.
+
+    sample_every : int
+        If given, only every Kth element of each type within each byte range
+        is audited.
+
+    sample_fraction : float
+        If given, only elements whose hashed id falls below this fraction are
+        audited.
+
+    approximate : bool
+        If True, values are counted with a bounded-memory sketch instead of
+        exactly. Defaults to False.
+
+    snapshot : str
+        If given, path to a snapshot file to which the counts are saved.
+
+    baseline : str
+        If given, path to the snapshot of an earlier audit; only the values
+        that are new, gone or counted differently are printed.
+    """
+    processes = processes or cpu_count()
+    if shards is None:
+        shards = 4 * processes
+    pool = Pool(processes)
+    try:
+        tasks = [(filename, start, end, sample_every, sample_fraction,
+                  approximate)
+                 for filename in filenames
+                 for start, end in shard_offsets(filename, shards)]
+        fields = merge_fields(pool.imap_unordered(audit_shard, tasks),
+                              approximate)
+    finally:
+        pool.close()
+        pool.join()
+    report_fields(fields, filenames,
+                  sample_scale(sample_every, sample_fraction), approximate,
+                  snapshot, baseline)
+
+
+def audit_changes(filename, baseline):
+    """Audit the elements created or modified by an osmChange file.
+
+    Only the values that do not appear in the baseline are printed, with
+    their counts among the changed elements. Deleted elements and the old
+    versions of modified elements are not part of an osmChange file, so the
+    counts of the baseline cannot be updated from it.
+    
+    Parameters
+    ----------
+    filename : str
+        Path to the osmChange (.osc) file, e.g. a daily diff.
+
+    baseline : str
+        Path to the snapshot of an audit of the extract the changes apply to.
+
+    Returns
+    -------
+    dict
+        The values of each field that are new relative to the baseline, with
+        their counts.
+    """
+    fields = count_fields(iter_change_elements(filename))
+    current = dict((name, snapshot_counts(counts))
+                   for name, counts in fields.iteritems())
+    diff = diff_snapshots(load_snapshot(baseline), current)
+    print_diff(diff, new_only=True)
+    return dict((name, field['new']) for name, field in diff.iteritems())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Script batch_ingest.py converts a set of regional OpenStreetMaps extracts and
+loads them into one database. The regions are listed in a JSON manifest:
+
+    {"regions": [
+        {"name": "rochester", "osm": "Rochester.osm"},
+        {"name": "buffalo", "osm": "Buffalo.osm",
+         "rules": ["rules/western_ny.json"]}
+    ]}
+
+Relative paths are taken relative to the manifest. Each region is converted
+with osm_to_csv.process_map and loaded with
+csv_to_database.convert_csv_to_database into its own directory under the work
+directory, in a pool of worker processes. The regional databases are then
+attached one at a time and copied into the combined database, whose tables
+have an extra 'region' column. Extracts of neighbouring regions overlap at
+their borders; a node or way found in several regions is kept from the first
+region in the manifest only, together with its tags and way nodes.
+
+Acknowledgments:
+[1] https://docs.python.org/2/library/multiprocessing.html
+[2] https://www.sqlite.org/lang_attach.html
+"""
+
+import json
+from multiprocessing import Pool, cpu_count
+import os
+import sqlite3
+
+from csv_to_database import (PLAIN_INDEXES, PLAIN_SCHEMA,
+                             build_activity_tables, convert_csv_to_database,
+                             drop_schema)
+from osm_to_csv import (NODES_PATH, NODE_TAGS_PATH, RULES_PATHS, WAYS_PATH,
+                        WAY_NODES_PATH, WAY_TAGS_PATH, process_map)
+from query_cache import bump_generation
+
+
+MANIFEST_PATH = 'regions.json'
+"""str: Path to the manifest listing the regions."""
+
+DB = 'mydb.db'
+"""str: Path to the combined database."""
+
+WORK_DIR = 'regions'
+"""str: Directory holding one subdirectory of intermediate files per
+region."""
+
+REGION_INDEXES = [
+    'CREATE INDEX nodes_region ON nodes(region)',
+    'CREATE INDEX ways_region ON ways(region)'
+]
+"""list: Indexes on the region column of the combined database."""
+
+
+################################################################################
+#                              HELPER FUNCTIONS                                #
+################################################################################
+
+def load_manifest(path=MANIFEST_PATH):
+    """Read the list of regions from a manifest.
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON manifest.
+
+    Returns
+    -------
+    list
+        One dict per region with keys 'name', 'osm' and 'rules', the paths
+        made absolute.
+
+    Raises
+    ------
+    ValueError
+        If a region has no name or OSM file, or a name is used twice.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as fin:
+        manifest = json.load(fin)
+    regions = []
+    names = set()
+    for entry in manifest['regions']:
+        if not entry.get('name') or not entry.get('osm'):
+            raise ValueError("Every region needs a 'name' and an 'osm' file.")
+        if entry['name'] in names:
+            raise ValueError("Region '%s' is listed twice." % entry['name'])
+        names.add(entry['name'])
+        rules = entry.get('rules')
+        regions.append({
+            'name': entry['name'],
+            'osm': os.path.join(base, entry['osm']),
+            'rules': RULES_PATHS + tuple(os.path.join(base, rules_path)
+                                         for rules_path in rules or ())
+        })
+    return regions
+
+
+def ingest_region(task):
+    """Convert one region and load it into a regional database.
+
+    Parameters
+    ----------
+    task : tuple
+        The region (as returned by load_manifest), the work directory, and
+        the 'validate' and 'check_integrity' arguments of process_map.
+
+    Returns
+    -------
+    tuple
+        The name of the region and the path to its database.
+    """
+    region, work_dir, validate, check_integrity = task
+    output_dir = os.path.join(work_dir, region['name'])
+    process_map(region['osm'], validate, rules_paths=region['rules'],
+                checkpoint_path=os.path.join(output_dir, 'checkpoint'),
+                check_integrity=check_integrity, output_dir=output_dir)
+    db = os.path.join(output_dir, region['name'] + '.db')
+    convert_csv_to_database(db,
+                            nodes=os.path.join(output_dir, NODES_PATH),
+                            nodes_tags=os.path.join(output_dir,
+                                                    NODE_TAGS_PATH),
+                            ways=os.path.join(output_dir, WAYS_PATH),
+                            ways_nodes=os.path.join(output_dir,
+                                                    WAY_NODES_PATH),
+                            ways_tags=os.path.join(output_dir, WAY_TAGS_PATH),
+                            check_tables=False, activity=False, indexes=False)
+    return region['name'], db
+
+
+def merge_region(conn, name, region_db):
+    """Copy a regional database into the combined database.
+
+    Nodes and ways already copied from an earlier region are skipped, along
+    with their tags and way nodes.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the combined database.
+
+    name : str
+        Name of the region, stored in the 'region' column.
+
+    region_db : str
+        Path to the regional database.
+
+    Returns
+    -------
+    dict
+        Number of nodes and ways copied and skipped as duplicates.
+    """
+    conn.execute('ATTACH DATABASE ? AS region_db', (region_db,))
+    try:
+        stats = {}
+        for table, children in (('nodes', ('nodes_tags',)),
+                                ('ways', ('ways_nodes', 'ways_tags'))):
+            total = conn.execute('SELECT COUNT(*) FROM region_db.%s'
+                                 % table).fetchone()[0]
+            before = conn.total_changes
+            conn.execute('INSERT OR IGNORE INTO main.%s '
+                         'SELECT *, ? FROM region_db.%s' % (table, table),
+                         (name,))
+            copied = conn.total_changes - before
+            stats[table] = copied
+            stats[table + '_duplicates'] = total - copied
+            for child in children:
+                conn.execute('''INSERT INTO main.%s
+                                SELECT c.*, ? FROM region_db.%s c
+                                JOIN main.%s p
+                                ON p.id = c.id AND p.region = ?'''
+                             % (child, child, table), (name, name))
+        conn.commit()
+    finally:
+        conn.execute('DETACH DATABASE region_db')
+    return stats
+
+
+################################################################################
+#                                MAIN FUNCTION                                 #
+################################################################################
+
+def batch_ingest(manifest=MANIFEST_PATH, db=DB, work_dir=WORK_DIR,
+                 processes=None, validate=False, check_integrity=None):
+    """Convert the regions of a manifest and load them into one database.
+
+    Parameters
+    ----------
+    manifest : str
+        Path to the JSON manifest listing the regions.
+
+    db : str
+        Path to the combined database, replaced if it exists.
+
+    work_dir : str
+        Directory holding the csv files and database of each region.
+
+    processes : int
+        Number of worker processes. Defaults to the number of CPUs.
+
+    validate : bool
+        True to validate the elements of each region against the schema.
+
+    check_integrity : str
+        Passed to process_map: None, 'report' or 'drop'.
+
+    Returns
+    -------
+    dict
+        Number of nodes and ways copied and skipped for each region.
+    """
+    regions = load_manifest(manifest)
+    pool = Pool(processes or cpu_count())
+    try:
+        region_dbs = dict(pool.imap_unordered(
+            ingest_region,
+            [(region, work_dir, validate, check_integrity)
+             for region in regions]))
+    finally:
+        pool.close()
+        pool.join()
+
+    conn = sqlite3.connect(db)
+    try:
+        cur = conn.cursor()
+        drop_schema(cur)
+        for statement in PLAIN_SCHEMA:
+            cur.execute(statement)
+        for table in ('nodes', 'nodes_tags', 'ways', 'ways_nodes',
+                      'ways_tags'):
+            cur.execute('ALTER TABLE %s ADD COLUMN region TEXT' % table)
+        conn.commit()
+
+        stats = {}
+        for region in regions:
+            stats[region['name']] = merge_region(
+                conn, region['name'], region_dbs[region['name']])
+
+        for statement in PLAIN_INDEXES + REGION_INDEXES:
+            cur.execute(statement)
+        build_activity_tables(cur)
+        conn.commit()
+        bump_generation(conn)
+    finally:
+        conn.close()
+
+    for region in regions:
+        region_stats = stats[region['name']]
+        print "%s: %d nodes (%d duplicates skipped), %d ways (%d " \
+              "duplicates skipped)" % (region['name'], region_stats['nodes'],
+                                       region_stats['nodes_duplicates'],
+                                       region_stats['ways'],
+                                       region_stats['ways_duplicates'])
+    return stats
+
+
+if __name__ == '__main__':
+    batch_ingest()
@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+"""
+Script bench_queries.py guards the report queries of sql_queries.py against
+performance regressions. It builds a synthetic database of a configurable
+size from seeded random csv files, through
+csv_to_database.convert_csv_to_database like a real load, and runs each
+report repeatedly. Every query the reports issue is timed and its plan is
+captured with EXPLAIN QUERY PLAN.
+
+The first run saves the latency percentiles and plans to a baseline file.
+Later runs fail if a query's median latency exceeds the baseline by more than
+TOLERANCE (plus SLACK_MS, to absorb timer noise on fast queries), or if a
+query scans a table in full that it reached through an index in the
+baseline, e.g. after an index was dropped or a schema change defeated it.
+
+    python bench_queries.py
+    python osm_cli.py bench --nodes 200000
+
+Acknowledgments:
+[1] https://www.sqlite.org/eqp.html
+[2] https://en.wikipedia.org/wiki/Percentile#The_nearest-rank_method
+"""
+
+import csv
+import json
+import math
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from csv_to_database import convert_csv_to_database
+from osm_to_csv import (NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS,
+                        WAY_NODES_FIELDS, WAY_TAGS_FIELDS)
+import sql_queries
+
+
+BASELINE_PATH = 'bench_baseline.json'
+"""str: Path to the file holding the baseline timings and plans."""
+
+NODES = 50000
+"""int: Number of nodes in the synthetic database."""
+
+SEED = 0
+"""int: Seed of the random generator of the synthetic database."""
+
+REPEAT = 10
+"""int: Number of times each report is run."""
+
+TOLERANCE = 2.0
+"""float: Factor by which a query's median latency may exceed the baseline."""
+
+SLACK_MS = 2.0
+"""float: Milliseconds added to the allowed latency of every query."""
+
+PERCENTILES = (50, 90, 99)
+"""tuple: Latency percentiles reported and saved."""
+
+REPORTS = ('db_statistics', 'distribution_way_nodes', 'describe_large_ways')
+"""tuple: Names of the report functions of sql_queries.py that are run."""
+
+USERS = 50
+"""int: Number of distinct users in the synthetic database."""
+
+NODE_TAGS = (('name', 'regular', 'Main Street Cafe'),
+             ('amenity', 'regular', 'restaurant'),
+             ('amenity', 'regular', 'school'),
+             ('amenity', 'regular', 'bench'),
+             ('city', 'addr', 'Rochester'),
+             ('postcode', 'addr', '14607'),
+             ('phone', 'regular', '585-555-1234'))
+"""tuple: (key, type, value) of the tags given to the synthetic nodes."""
+
+WAY_TAGS = (('highway', 'regular', 'residential'),
+            ('name', 'regular', 'Main Street'),
+            ('building', 'regular', 'yes'),
+            ('street', 'addr', 'Park Avenue'))
+"""tuple: (key, type, value) of the tags given to the synthetic ways."""
+
+TABLE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+"""re.RegexObject: Regular expression for the table read by a SCAN step of a
+query plan."""
+
+
+################################################################################
+#                              HELPER FUNCTIONS                                #
+################################################################################
+
+def write_synthetic_csvs(directory, nodes=NODES, seed=SEED):
+    """Write seeded random csv files in the layout of osm_to_csv.py.
+
+    About a fifth of the nodes are tagged; there is one way per five nodes,
+    with a skewed number of way nodes, and user activity is skewed towards a
+    few users, as in real extracts.
+
+    Parameters
+    ----------
+    directory : str
+        Directory in which the csv files are written.
+
+    nodes : int
+        Number of nodes.
+
+    seed : int
+        Seed of the random generator; the same seed gives the same files.
+
+    Returns
+    -------
+    dict
+        Paths to the csv files, keyed by the argument names of
+        convert_csv_to_database.
+    """
+    rand = random.Random(seed)
+    paths = dict((name, os.path.join(directory, name + '.csv'))
+                 for name in ('nodes', 'nodes_tags', 'ways', 'ways_nodes',
+                              'ways_tags'))
+    files = dict((name, open(path, 'wb')) for name, path in paths.iteritems())
+    try:
+        writers = {}
+        for name, fields in (('nodes', NODE_FIELDS),
+                             ('nodes_tags', NODE_TAGS_FIELDS),
+                             ('ways', WAY_FIELDS),
+                             ('ways_nodes', WAY_NODES_FIELDS),
+                             ('ways_tags', WAY_TAGS_FIELDS)):
+            writers[name] = csv.writer(files[name])
+            writers[name].writerow(fields)
+
+        def attributes():
+            uid = int(rand.paretovariate(1.2)) % USERS + 1
+            timestamp = '20%02d-%02d-%02dT%02d:%02d:%02dZ' % (
+                rand.randint(8, 16), rand.randint(1, 12), rand.randint(1, 28),
+                rand.randint(0, 23), rand.randint(0, 59), rand.randint(0, 59))
+            return ['user%d' % uid, uid, rand.randint(1, 5),
+                    rand.randint(1, nodes), timestamp]
+
+        for node_id in xrange(1, nodes + 1):
+            writers['nodes'].writerow(
+                [node_id, '%.7f' % rand.uniform(43.0, 43.3),
+                 '%.7f' % rand.uniform(-77.8, -77.4)] + attributes())
+            if rand.random() < 0.2:
+                for key, tag_type, value in rand.sample(NODE_TAGS, 2):
+                    writers['nodes_tags'].writerow([node_id, key, value,
+                                                    tag_type])
+
+        for way_id in xrange(1, nodes // 5 + 1):
+            writers['ways'].writerow([way_id] + attributes())
+            length = min(2 + int(rand.expovariate(0.1)), 500)
+            start = rand.randint(1, nodes)
+            for position in xrange(length):
+                writers['ways_nodes'].writerow(
+                    [way_id, (start + position - 1) % nodes + 1, position])
+            for key, tag_type, value in rand.sample(WAY_TAGS,
+                                                    rand.randint(1, 3)):
+                writers['ways_tags'].writerow([way_id, key, value, tag_type])
+    finally:
+        for output in files.itervalues():
+            output.close()
+    return paths
+
+
+def percentile(values, percent):
+    """Return a percentile of a list of numbers by the nearest-rank method."""
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def table_scans(plan, tables):
+    """Return the tables a query plan reads in full without an index.
+
+    Parameters
+    ----------
+    plan : list
+        The 'detail' column of the EXPLAIN QUERY PLAN rows.
+
+    tables : set
+        Names of the tables of the database, so that scans of subqueries are
+        ignored.
+
+    Returns
+    -------
+    list
+        Sorted names of the scanned tables.
+    """
+    scans = set()
+    for detail in plan:
+        match = TABLE_SCAN.match(detail)
+        if match and match.group(1) in tables and 'INDEX' not in detail:
+            scans.add(match.group(1))
+    return sorted(scans)
+
+
+class QueryRecorder(object):
+    """Stand-in for the query cache of sql_queries.py that runs every query,
+    timing it and capturing its plan.
+
+    The reports pass each query to the fetchall method of their cache, so
+    the queries are recorded as issued, without copying them here. Queries
+    are named after the report and their position in it, e.g.
+    'db_statistics[2]'.
+    """
+
+    def __init__(self):
+        self.queries = {}
+        self.order = []
+        self._report = None
+        self._position = 0
+
+    def start(self, report):
+        """Start recording a run of a report."""
+        self._report = report
+        self._position = 0
+
+    def fetchall(self, conn, db, query, params=()):
+        """Run a query, recording its latency and, the first time, its plan.
+
+        Parameters
+        ----------
+        conn : sqlite3.Connection
+            Connection to the database.
+
+        db : str
+            Path to the database, unused.
+
+        query : str
+            The query text.
+
+        params : tuple
+            The query parameters.
+
+        Returns
+        -------
+        list
+            The rows returned by the query.
+        """
+        name = '%s[%d]' % (self._report, self._position)
+        self._position += 1
+        if name not in self.queries:
+            plan = [row[3] for row in
+                    conn.execute('EXPLAIN QUERY PLAN ' + query, params)]
+            self.queries[name] = {'query': query, 'plan': plan,
+                                  'timings': []}
+            self.order.append(name)
+        start = time.time()
+        rows = conn.execute(query, params).fetchall()
+        self.queries[name]['timings'].append(1000 * (time.time() - start))
+        return rows
+
+
+def run_reports(db, repeat=REPEAT, reports=REPORTS):
+    """Run the reports of sql_queries.py and record their queries.
+
+    Parameters
+    ----------
+    db : str
+        Path to the database.
+
+    repeat : int
+        Number of times each report is run.
+
+    reports : tuple
+        Names of the report functions.
+
+    Returns
+    -------
+    QueryRecorder
+        The timings and plans of the queries.
+    """
+    # Draw plots off screen, so that the plotting report does not block
+    import matplotlib
+    matplotlib.use('Agg')
+
+    recorder = QueryRecorder()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for report in reports:
+            for _ in range(repeat):
+                recorder.start(report)
+                getattr(sql_queries, report)(db, recorder)
+                if 'matplotlib.pyplot' in sys.modules:
+                    sys.modules['matplotlib.pyplot'].close('all')
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return recorder
+
+
+def summarize(recorder, db):
+    """Compute the percentiles and full table scans of each query.
+
+    Parameters
+    ----------
+    recorder : QueryRecorder
+        The recorded queries.
+
+    db : str
+        Path to the database, to look up its table names.
+
+    Returns
+    -------
+    dict
+        For each query name: the query text, the plan, the scanned tables,
+        and 'p50_ms', 'p90_ms', ... latencies.
+    """
+    conn = sqlite3.connect(db)
+    try:
+        tables = set(row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    finally:
+        conn.close()
+    results = {}
+    for name in recorder.order:
+        recorded = recorder.queries[name]
+        result = {'query': recorded['query'], 'plan': recorded['plan'],
+                  'table_scans': table_scans(recorded['plan'], tables)}
+        for percent in PERCENTILES:
+            result['p%d_ms' % percent] = round(
+                percentile(recorded['timings'], percent), 3)
+        results[name] = result
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE, slack_ms=SLACK_MS):
+    """Find the queries that are slower or scan more than in the baseline.
+
+    Parameters
+    ----------
+    results : dict
+        The summary of the current run, as returned by summarize.
+
+    baseline : dict
+        The 'queries' entry of the baseline file.
+
+    tolerance : float
+        Factor by which the median latency may exceed the baseline.
+
+    slack_ms : float
+        Milliseconds added to the allowed median latency.
+
+    Returns
+    -------
+    list
+        One message per regression.
+    """
+    failures = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        result, base = results[name], baseline[name]
+        allowed = base['p50_ms'] * tolerance + slack_ms
+        if result['p50_ms'] > allowed:
+            failures.append('%s: median %.1f ms exceeds %.1f ms (baseline '
+                            '%.1f ms)' % (name, result['p50_ms'], allowed,
+                                          base['p50_ms']))
+        new_scans = set(result['table_scans']) - set(base['table_scans'])
+        if new_scans:
+            failures.append('%s: full table scan of %s; plan: %s' % (
+                name, ', '.join(sorted(new_scans)),
+                ' / '.join(result['plan'])))
+    return failures
+
+
+def print_results(results, baseline=None):
+    """Print the latency percentiles and plan of each query."""
+    for name in sorted(results):
+        result = results[name]
+        line = '%s: ' % name + ', '.join(
+            'p%d %.1f ms' % (percent, result['p%d_ms' % percent])
+            for percent in PERCENTILES)
+        if baseline is not None:
+            if name in baseline:
+                line += ' (baseline p50 %.1f ms)' % baseline[name]['p50_ms']
+            else:
+                line += ' (not in baseline)'
+        print line
+        for detail in result['plan']:
+            print '    ' + detail
+
+
+################################################################################
+#                                MAIN FUNCTION                                 #
+################################################################################
+
+def bench_queries(baseline_path=BASELINE_PATH, nodes=NODES, seed=SEED,
+                  repeat=REPEAT, encoded=False, tolerance=TOLERANCE,
+                  update=False, work_dir=None):
+    """Benchmark the report queries against a synthetic database.
+
+    Parameters
+    ----------
+    baseline_path : str
+        Path to the baseline file. It is created if it does not exist.
+
+    nodes : int
+        Number of nodes of the synthetic database.
+
+    seed : int
+        Seed of the synthetic database.
+
+    repeat : int
+        Number of times each report is run.
+
+    encoded : bool
+        True to load the synthetic database into the dictionary-encoded
+        schema of csv_to_database.py.
+
+    tolerance : float
+        Factor by which a query's median latency may exceed the baseline.
+
+    update : bool
+        True to replace the baseline with the results of this run.
+
+    work_dir : str
+        Directory for the csv files and the database, kept after the run. A
+        temporary directory, removed afterwards, if None.
+
+    Returns
+    -------
+    list
+        One message per regression; empty if the run passed.
+
+    Raises
+    ------
+    ValueError
+        If the baseline was recorded for a different synthetic database.
+    """
+    config = {'nodes': nodes, 'seed': seed, 'encoded': encoded}
+    baseline = None
+    if os.path.exists(baseline_path) and not update:
+        with open(baseline_path) as fin:
+            baseline = json.load(fin)
+        if baseline['config'] != config:
+            raise ValueError("The baseline in '%s' was recorded with %r, not "
+                             "%r." % (baseline_path, baseline['config'],
+                                      config))
+
+    directory = work_dir or tempfile.mkdtemp()
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        db = os.path.join(directory, 'bench.db')
+        paths = write_synthetic_csvs(directory, nodes, seed)
+        convert_csv_to_database(db, check_tables=False, encoded=encoded,
+                                **paths)
+        results = summarize(run_reports(db, repeat), db)
+    finally:
+        if work_dir is None:
+            shutil.rmtree(directory)
+
+    if baseline is None:
+        print_results(results)
+        with open(baseline_path, 'w') as fout:
+            json.dump({'config': config,
+                       'sqlite_version': sqlite3.sqlite_version,
+                       'queries': results}, fout, indent=2, sort_keys=True)
+        print "Baseline saved to %s" % baseline_path
+        return []
+
+    print_results(results, baseline['queries'])
+    failures = compare(results, baseline['queries'], tolerance)
+    for failure in failures:
+        print "REGRESSION " + failure
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(1 if bench_queries() else 0)
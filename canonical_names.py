@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Module canonical_names.py corrects misspelled names (cities, streets) using
+the data itself instead of hand-written mappings. The values of a field are
+counted in a first pass; values seen at least MIN_COUNT times become
+canonical forms, indexed by their character n-grams. A value is then replaced
+by the closest canonical form within a small edit distance, provided that
+form is at least MIN_RATIO times as frequent, e.g. 'Rochster' by 'Rochester',
+but not 'Brighton' by a similar name that is only a few times as common.
+
+Values containing digits are only matched to forms with the same digits, so
+that '5th Street' is never taken for a misspelling of '1st Street'.
+Corrections are memoized, so each distinct value is looked up once per run.
+
+Acknowledgments:
+[1] https://en.wikipedia.org/wiki/Levenshtein_distance
+[2] E. Ukkonen, Approximate string-matching with q-grams and maximal matches,
+    Theoretical Computer Science 92 (1992)
+"""
+
+from collections import defaultdict
+import re
+
+
+MIN_COUNT = 5
+"""int: Minimum number of occurrences of a canonical form."""
+
+MIN_RATIO = 10
+"""int: Minimum ratio of the count of a canonical form to the count of a value
+it replaces."""
+
+MAX_DISTANCE = 2
+"""int: Maximum edit distance between a value and its canonical form."""
+
+CHARS_PER_EDIT = 4
+"""int: Number of characters of a value per allowed edit, so that short values
+are only corrected for a single typo. Values shorter than this are never
+corrected."""
+
+NGRAM_SIZE = 3
+"""int: Length of the character n-grams indexed."""
+
+PAD = '\x00'
+"""str: Character padding values at both ends, so that their first and last
+characters appear in as many n-grams as the others."""
+
+DIGITS = re.compile(r'[0-9]+')
+"""re.RegexObject: Regular expression for the numbers in a value."""
+
+
+def edit_distance(a, b, limit=None):
+    """Return the Levenshtein distance between two strings.
+
+    Parameters
+    ----------
+    a, b : str
+        The strings to be compared.
+
+    limit : int
+        If given, the computation stops as soon as the distance is known to
+        exceed limit, and limit + 1 is returned.
+
+    Returns
+    -------
+    int
+        The minimum number of single-character insertions, deletions and
+        substitutions turning a into b.
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if limit is not None and len(a) - len(b) > limit:
+        return limit + 1
+    previous = range(len(b) + 1)
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class NGramIndex(object):
+    """Index of strings for finding those within an edit distance of a query.
+
+    Each string is indexed under its character n-grams, padded at both ends.
+    An edit changes at most n of the n-grams of a string, so a string within
+    distance k of the query shares all but at most k * n of the query's
+    n-grams. Candidates are collected from the postings of the k * n + 1
+    rarest n-grams of the query (one of which every match must contain),
+    filtered by their number of shared n-grams and by length, and only the
+    few that remain are compared with edit_distance.
+
+    Parameters
+    ----------
+    n : int
+        Length of the n-grams.
+    """
+
+    def __init__(self, n=NGRAM_SIZE):
+        self.n = n
+        self.words = []
+        self.word_grams = []
+        self.postings = defaultdict(list)
+
+    def grams(self, word):
+        """Return the set of padded n-grams of a string."""
+        padded = PAD * (self.n - 1) + word + PAD * (self.n - 1)
+        return frozenset(padded[i:i + self.n]
+                         for i in range(len(padded) - self.n + 1))
+
+    def add(self, word):
+        """Add a string to the index."""
+        grams = self.grams(word)
+        index = len(self.words)
+        self.words.append(word)
+        self.word_grams.append(grams)
+        for gram in grams:
+            self.postings[gram].append(index)
+
+    def search(self, word, max_distance):
+        """Find the indexed strings within an edit distance of a string.
+
+        Parameters
+        ----------
+        word : str
+            The query.
+
+        max_distance : int
+            Maximum edit distance.
+
+        Returns
+        -------
+        list
+            (distance, string) pairs.
+        """
+        grams = self.grams(word)
+        threshold = len(grams) - max_distance * self.n
+        if threshold > 0:
+            postings = self.postings
+            rarest = sorted(grams,
+                            key=lambda gram: len(postings.get(gram, ())))
+            candidates = set()
+            for gram in rarest[:max_distance * self.n + 1]:
+                candidates.update(postings.get(gram, ()))
+        else:
+            # Too short for the n-grams to rule anything out
+            candidates = range(len(self.words))
+
+        matches = []
+        for index in candidates:
+            if len(grams & self.word_grams[index]) < threshold:
+                continue
+            candidate = self.words[index]
+            if abs(len(candidate) - len(word)) > max_distance:
+                continue
+            distance = edit_distance(word, candidate, max_distance)
+            if distance <= max_distance:
+                matches.append((distance, candidate))
+        return matches
+
+
+class CanonicalIndex(object):
+    """Frequency-ranked canonical forms of a field, with fuzzy lookup.
+
+    Parameters
+    ----------
+    counts : dict
+        Number of occurrences of each value of the field.
+
+    min_count : int
+        Minimum number of occurrences of a canonical form.
+
+    min_ratio : float
+        Minimum ratio of the count of a canonical form to the count of a
+        value it replaces.
+
+    max_distance : int
+        Maximum edit distance between a value and its canonical form.
+    """
+
+    def __init__(self, counts, min_count=MIN_COUNT, min_ratio=MIN_RATIO,
+                 max_distance=MAX_DISTANCE):
+        self.counts = counts
+        self.min_ratio = min_ratio
+        self.max_distance = max_distance
+        self.index = NGramIndex()
+        for value, count in counts.iteritems():
+            if count >= min_count:
+                self.index.add(value)
+        self._memo = {}
+
+    def canonical(self, value):
+        """Return the canonical form of a value.
+
+        Parameters
+        ----------
+        value : str
+            A value of the field.
+
+        Returns
+        -------
+        str
+            The most frequent of the closest sufficiently frequent forms, or
+            the value itself if there is none.
+        """
+        memo = self._memo
+        if value in memo:
+            return memo[value]
+
+        result = value
+        count = self.counts.get(value, 0)
+        max_distance = min(self.max_distance, len(value) // CHARS_PER_EDIT)
+        digits = DIGITS.findall(value)
+        best = None
+        matches = []
+        if max_distance > 0:
+            matches = self.index.search(value, max_distance)
+        for distance, form in matches:
+            if distance == 0 or DIGITS.findall(form) != digits:
+                continue
+            form_count = self.counts[form]
+            if form_count < self.min_ratio * max(count, 1):
+                continue
+            rank = (distance, -form_count, form)
+            if best is None or rank < best:
+                best = rank
+        if best is not None:
+            result = best[2]
+        memo[value] = result
+        return result
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Module cleaning_rules.py compiles the declarative cleaning rules used by
+osm_to_csv.py. A rules file is a JSON document with two sections:
+ - "mappings": named lookup tables, e.g. street type abbreviations
+ - "rules": a list of rules, each matching the 'type' and 'key' of a tag with
+   glob patterns and naming the cleaner function (and optional mapping) to be
+   applied to the tag's value
+
+Several rules files can be loaded on top of each other, so that regional rules
+extend the defaults without changing the code. The rules are compiled into a
+dispatch table keyed on (type, key): the patterns are matched once for each
+distinct pair, after which each tag costs a single dictionary lookup.
+
+Acknowledgments:
+[1] https://docs.python.org/2/library/fnmatch.html
+"""
+
+from collections import namedtuple
+from fnmatch import fnmatchcase
+from functools import partial
+import json
+import os
+
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'cleaning_rules.json')
+"""str: Path to the default cleaning rules."""
+
+CleaningAction = namedtuple('CleaningAction', ['name', 'mapping', 'apply'])
+"""namedtuple: A cleaner to be applied to a tag value. 'name' is the cleaner
+name from the rules file, 'mapping' the mapping table (or None), and 'apply' a
+function of the value that returns the cleaned value."""
+
+
+def load_rules(paths=(RULES_PATH,)):
+    """Load and combine one or more rules files.
+
+    Mapping tables with the same name are merged, later files taking
+    precedence; rules are concatenated in file order.
+
+    Parameters
+    ----------
+    paths : tuple
+        Paths to JSON rules files. Defaults to the module level variable
+        RULES_PATH.
+
+    Returns
+    -------
+    dict
+        The combined rules, with keys 'mappings' and 'rules'.
+    """
+    combined = {'mappings': {}, 'rules': []}
+    for path in paths:
+        with open(path) as fin:
+            config = json.load(fin)
+        for name, table in config.get('mappings', {}).iteritems():
+            combined['mappings'].setdefault(name, {}).update(table)
+        combined['rules'].extend(config.get('rules', []))
+    return combined
+
+
+class RuleTable(object):
+    """Compiled dispatch table from (type, key) to cleaning actions.
+
+    Parameters
+    ----------
+    config : dict
+        Rules as returned by load_rules.
+
+    cleaners : dict
+        Cleaner functions by name. A cleaner takes the value of a tag and, if
+        the rule names a mapping, the mapping table as keyword 'mapping'.
+
+    key_fixer : function
+        Function applied to each key before the rules are matched, e.g. to
+        replace problematic characters. Defaults to leaving keys unchanged.
+
+    Raises
+    ------
+    ValueError
+        If a rule names an unknown cleaner or mapping.
+    """
+
+    def __init__(self, config, cleaners, key_fixer=None):
+        self.mappings = config['mappings']
+        self.key_fixer = key_fixer
+        self._rules = []
+        for rule in config['rules']:
+            name = rule['cleaner']
+            if name not in cleaners:
+                raise ValueError("Unknown cleaner '%s' in cleaning rules."
+                                 % name)
+            mapping = None
+            apply = cleaners[name]
+            if rule.get('mapping') is not None:
+                if rule['mapping'] not in self.mappings:
+                    raise ValueError("Unknown mapping '%s' in cleaning rules."
+                                     % rule['mapping'])
+                mapping = self.mappings[rule['mapping']]
+                apply = partial(apply, mapping=mapping)
+            self._rules.append((rule.get('type', '*'), rule.get('key', '*'),
+                                CleaningAction(name, mapping, apply)))
+        self._dispatch = {}
+
+    def _resolve(self, tag_type, key):
+        """Match a (type, key) pair against every rule.
+
+        Parameters
+        ----------
+        tag_type : str
+            The 'type' field of a tag.
+
+        key : str
+            The 'key' field of a tag, before key fixing.
+
+        Returns
+        -------
+        tuple
+            The fixed key and a tuple of CleaningActions, in rule order.
+        """
+        if self.key_fixer is not None:
+            key = self.key_fixer(key)
+        actions = tuple(action for type_pattern, key_pattern, action
+                        in self._rules
+                        if fnmatchcase(tag_type, type_pattern) and
+                        fnmatchcase(key, key_pattern))
+        return key, actions
+
+    def lookup(self, tag_type, key):
+        """Return the fixed key and the cleaning actions for a tag.
+
+        Parameters
+        ----------
+        tag_type : str
+            The 'type' field of a tag.
+
+        key : str
+            The 'key' field of a tag.
+
+        Returns
+        -------
+        tuple
+            The fixed key and a tuple of CleaningActions, in rule order.
+        """
+        try:
+            return self._dispatch[(tag_type, key)]
+        except KeyError:
+            entry = self._dispatch[(tag_type, key)] = \
+                self._resolve(tag_type, key)
+            return entry
@@ -11,10 +11,13 @@ Acknowledgments:
 """
 
 
+import calendar
 import csv
 from pprint import pprint
 import sqlite3
 
+from query_cache import bump_generation
+
 
 SQLITE_FILE = 'mydb.db'
 """str: Path to the database to be created."""
@@ -34,141 +37,650 @@ WAYS_NODES = 'ways_nodes.csv'
 WAYS_TAGS = 'ways_tags.csv'
 """str: Path to the csv file containing data for the 'ways_tags' table."""
 
+PLAIN_SCHEMA = [
+    '''CREATE TABLE nodes(
+       id INTEGER PRIMARY KEY,
+       lat REAL,
+       lon REAL,
+       user TEXT,
+       uid INTEGER,
+       version TEXT,
+       changeset INTEGER,
+       timestamp TEXT,
+       epoch INTEGER)''',
+    '''CREATE TABLE nodes_tags(
+       id INTEGER REFERENCES nodes(id),
+       key TEXT,
+       value TEXT,
+       type TEXT)''',
+    '''CREATE TABLE ways(
+       id INTEGER PRIMARY KEY,
+       user TEXT,
+       uid INTEGER,
+       version TEXT,
+       changeset INTEGER,
+       timestamp TEXT,
+       epoch INTEGER)''',
+    '''CREATE TABLE ways_nodes(
+       id INTEGER REFERENCES ways(id),
+       node_id INTEGER REFERENCES nodes(id),
+       position INTEGER)''',
+    '''CREATE TABLE ways_tags(
+       id INTEGER REFERENCES ways(id),
+       key TEXT,
+       value TEXT,
+       type TEXT)'''
+]
+"""list: Statements creating the plain schema, one table per csv file."""
 
-def convert_csv_to_database(sqlite_file=SQLITE_FILE, nodes=NODES, 
-                            nodes_tags=NODES_TAGS, ways=WAYS, 
-                            ways_nodes=WAYS_NODES, ways_tags=WAYS_TAGS,
-                            check_tables=True):
-    """Transfers records from csv files to a sqlite database.
+ENCODED_SCHEMA = [
+    '''CREATE TABLE users(
+       id INTEGER PRIMARY KEY,
+       user TEXT UNIQUE)''',
+    '''CREATE TABLE tag_keys(
+       id INTEGER PRIMARY KEY,
+       key TEXT UNIQUE)''',
+    '''CREATE TABLE tag_types(
+       id INTEGER PRIMARY KEY,
+       type TEXT UNIQUE)''',
+    '''CREATE TABLE nodes_data(
+       id INTEGER PRIMARY KEY,
+       lat REAL,
+       lon REAL,
+       user_id INTEGER REFERENCES users(id),
+       uid INTEGER,
+       version TEXT,
+       changeset INTEGER,
+       timestamp TEXT,
+       epoch INTEGER)''',
+    '''CREATE TABLE nodes_tags_data(
+       id INTEGER REFERENCES nodes_data(id),
+       key_id INTEGER REFERENCES tag_keys(id),
+       value TEXT,
+       type_id INTEGER REFERENCES tag_types(id))''',
+    '''CREATE TABLE ways_data(
+       id INTEGER PRIMARY KEY,
+       user_id INTEGER REFERENCES users(id),
+       uid INTEGER,
+       version TEXT,
+       changeset INTEGER,
+       timestamp TEXT,
+       epoch INTEGER)''',
+    '''CREATE TABLE ways_nodes(
+       id INTEGER REFERENCES ways_data(id),
+       node_id INTEGER REFERENCES nodes_data(id),
+       position INTEGER)''',
+    '''CREATE TABLE ways_tags_data(
+       id INTEGER REFERENCES ways_data(id),
+       key_id INTEGER REFERENCES tag_keys(id),
+       value TEXT,
+       type_id INTEGER REFERENCES tag_types(id))''',
+    # Compatibility views with the column names of the plain schema. They
+    # join every row to the lookup tables, so aggregations should read the
+    # data tables and look up names afterwards, as sql_queries.py does
+    '''CREATE VIEW nodes AS
+       SELECT n.id, n.lat, n.lon, u.user, n.uid, n.version, n.changeset,
+              n.timestamp, n.epoch
+       FROM nodes_data n JOIN users u ON n.user_id = u.id''',
+    '''CREATE VIEW nodes_tags AS
+       SELECT t.id, k.key, t.value, y.type
+       FROM nodes_tags_data t
+       JOIN tag_keys k ON t.key_id = k.id
+       JOIN tag_types y ON t.type_id = y.id''',
+    '''CREATE VIEW ways AS
+       SELECT w.id, u.user, w.uid, w.version, w.changeset, w.timestamp,
+              w.epoch
+       FROM ways_data w JOIN users u ON w.user_id = u.id''',
+    '''CREATE VIEW ways_tags AS
+       SELECT t.id, k.key, t.value, y.type
+       FROM ways_tags_data t
+       JOIN tag_keys k ON t.key_id = k.id
+       JOIN tag_types y ON t.type_id = y.id''',
+    'CREATE INDEX nodes_tags_data_key ON nodes_tags_data(key_id)',
+    'CREATE INDEX ways_tags_data_key ON ways_tags_data(key_id)',
+    'CREATE INDEX nodes_data_epoch ON nodes_data(epoch)',
+    'CREATE INDEX ways_data_epoch ON ways_data(epoch)'
+]
+"""list: Statements creating the dictionary-encoded schema."""
+
+CLUSTERED_WAYS_NODES_KEY = (',\n       PRIMARY KEY (node_id, id, position))'
+                            ' WITHOUT ROWID')
+"""str: Clause ending the 'ways_nodes' table definition of either schema when
+the table is clustered by node id."""
+
+NODE_ATTRS = 'node_attrs.csv'
+"""str: Path to the csv file containing data for the 'node_attrs' table."""
+
+WAY_ATTRS = 'way_attrs.csv'
+"""str: Path to the csv file containing data for the 'way_attrs' table."""
+
+SCHEMA_OBJECTS = ('nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags',
+                  'users', 'tag_keys', 'tag_types', 'nodes_data',
+                  'nodes_tags_data', 'ways_data', 'ways_tags_data',
+                  'node_attrs', 'way_attrs', 'contributors',
+                  'user_daily_activity', 'user_monthly_activity',
+                  'changeset_activity')
+"""tuple: Tables and views created by either schema."""
+
+PLAIN_INDEXES = [
+    'CREATE INDEX nodes_lat_lon ON nodes(lat, lon)',
+    'CREATE INDEX nodes_tags_id ON nodes_tags(id)',
+    'CREATE INDEX nodes_tags_key_value ON nodes_tags(key, value)',
+    'CREATE INDEX ways_tags_id ON ways_tags(id)',
+    'CREATE INDEX ways_tags_key_value ON ways_tags(key, value)',
+    'CREATE INDEX ways_nodes_id_position ON ways_nodes(id, position)',
+    'CREATE INDEX ways_nodes_node_id ON ways_nodes(node_id)'
+]
+"""list: Indexes of the plain schema used by exports and filtered queries."""
+
+ENCODED_INDEXES = [
+    'CREATE INDEX nodes_data_lat_lon ON nodes_data(lat, lon)',
+    'CREATE INDEX nodes_tags_data_id ON nodes_tags_data(id)',
+    'CREATE INDEX nodes_tags_data_key_value ON nodes_tags_data(key_id, value)',
+    'CREATE INDEX ways_tags_data_id ON ways_tags_data(id)',
+    'CREATE INDEX ways_tags_data_key_value ON ways_tags_data(key_id, value)',
+    'CREATE INDEX ways_nodes_id_position ON ways_nodes(id, position)',
+    'CREATE INDEX ways_nodes_node_id ON ways_nodes(node_id)'
+]
+"""list: Indexes of the encoded schema used by exports and filtered
+queries."""
+
+ACTIVITY_SCHEMA = [
+    '''CREATE TABLE contributors(
+       uid INTEGER PRIMARY KEY,
+       user TEXT)''',
+    '''CREATE TABLE user_daily_activity(
+       uid INTEGER,
+       day INTEGER,
+       nodes INTEGER,
+       ways INTEGER,
+       edits INTEGER,
+       PRIMARY KEY (uid, day)) WITHOUT ROWID''',
+    '''CREATE TABLE user_monthly_activity(
+       uid INTEGER,
+       month INTEGER,
+       nodes INTEGER,
+       ways INTEGER,
+       edits INTEGER,
+       PRIMARY KEY (uid, month)) WITHOUT ROWID''',
+    '''CREATE TABLE changeset_activity(
+       changeset INTEGER PRIMARY KEY,
+       uid INTEGER,
+       nodes INTEGER,
+       ways INTEGER,
+       edits INTEGER,
+       first_epoch INTEGER,
+       last_epoch INTEGER)''',
+    '''INSERT INTO contributors(uid, user)
+       SELECT uid, MAX(user) FROM
+           (SELECT uid, user FROM nodes
+            UNION ALL
+            SELECT uid, user FROM ways)
+       GROUP BY uid''',
+    '''INSERT INTO user_daily_activity(uid, day, nodes, ways, edits)
+       SELECT uid, epoch / 86400 AS day, SUM(kind = 0), SUM(kind = 1),
+              COUNT(*)
+       FROM
+           (SELECT uid, epoch, 0 AS kind FROM nodes
+            UNION ALL
+            SELECT uid, epoch, 1 AS kind FROM ways)
+       WHERE epoch IS NOT NULL
+       GROUP BY uid, day''',
+    '''INSERT INTO user_monthly_activity(uid, month, nodes, ways, edits)
+       SELECT uid,
+              CAST(strftime('%Y%m', day * 86400, 'unixepoch') AS INTEGER)
+              AS month,
+              SUM(nodes), SUM(ways), SUM(edits)
+       FROM user_daily_activity
+       GROUP BY uid, month''',
+    '''INSERT INTO changeset_activity(changeset, uid, nodes, ways, edits,
+                                      first_epoch, last_epoch)
+       SELECT changeset, MIN(uid), SUM(kind = 0), SUM(kind = 1), COUNT(*),
+              MIN(epoch), MAX(epoch)
+       FROM
+           (SELECT changeset, uid, epoch, 0 AS kind FROM nodes
+            UNION ALL
+            SELECT changeset, uid, epoch, 1 AS kind FROM ways)
+       GROUP BY changeset''',
+    'CREATE INDEX user_daily_activity_day ON user_daily_activity(day)',
+    'CREATE INDEX user_monthly_activity_month '
+    'ON user_monthly_activity(month)',
+    'CREATE INDEX changeset_activity_uid ON changeset_activity(uid)',
+    'CREATE INDEX changeset_activity_epoch '
+    'ON changeset_activity(first_epoch)'
+]
+"""list: Statements building the time-bucketed activity rollups from the
+'nodes' and 'ways' tables (or views). Days are counted since 1970-01-01 and
+months are written as YYYYMM."""
+
+
+class Interner(object):
+    """Assign consecutive integer ids to distinct strings."""
+
+    def __init__(self):
+        self.ids = {}
+
+    def __call__(self, value):
+        """Return the id of a string, assigning a new id on first sight.
+
+        Parameters
+        ----------
+        value : unicode
+            The string to be interned.
+
+        Returns
+        -------
+        int
+            The id of the string.
+        """
+        try:
+            return self.ids[value]
+        except KeyError:
+            new_id = self.ids[value] = len(self.ids) + 1
+            return new_id
+
+    def rows(self):
+        """Return (id, string) pairs for every interned string."""
+        return ((new_id, value) for value, new_id in self.ids.iteritems())
+
+
+def parse_timestamp(timestamp):
+    """Convert an OSM timestamp to seconds since the epoch.
     
     Parameters
     ----------
-    sqlite_file : str
-        Path to the sqlite database file to be created.
-    
-    nodes : str
-        Path to the csv file containing data for the 'nodes' table.
+    timestamp : str
+        A UTC timestamp in the form 'YYYY-MM-DDTHH:MM:SSZ'.
+
+    Returns
+    -------
+    int
+        Seconds since 1970-01-01T00:00:00Z, or None if the timestamp is
+        malformed.
+    """
+    try:
+        return calendar.timegm((int(timestamp[0:4]), int(timestamp[5:7]),
+                                int(timestamp[8:10]), int(timestamp[11:13]),
+                                int(timestamp[14:16]), int(timestamp[17:19])))
+    except ValueError:
+        return None
+
+
+def create_schema(cur, schema, clustered=False):
+    """Create the tables, views and indexes of a schema.
+
+    Parameters
+    ----------
+    cur : sqlite3.Cursor
+        Cursor on the database.
+
+    schema : list
+        The statements of the schema, e.g. PLAIN_SCHEMA.
+
+    clustered : bool
+        True to store 'ways_nodes' in a WITHOUT ROWID table ordered by node id,
+        way id and position, instead of in insertion order.
+    """
+    for statement in schema:
+        if clustered and statement.startswith('CREATE TABLE ways_nodes('):
+            statement = statement[:-1] + CLUSTERED_WAYS_NODES_KEY
+        cur.execute(statement)
+
+
+def drop_schema(cur):
+    """Drop every table and view created by either schema.
     
-    nodes_tags : str
-        Path to the csv file containing data for the 'nodes_tags' table.
+    Parameters
+    ----------
+    cur : sqlite3.Cursor
+        Cursor on the database.
+    """
+    for name in SCHEMA_OBJECTS:
+        cur.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,))
+        row = cur.fetchone()
+        if row is not None and row[0] in ('table', 'view'):
+            cur.execute('DROP %s %s' % (row[0].upper(), name))
+
+
+def read_csv(path, fields):
+    """Yield the selected fields of each row of a csv file as unicode.
     
-    ways : str
-        Path to the csv file containing data for the 'ways' table.
+    Parameters
+    ----------
+    path : str
+        Path to the csv file.
+
+    fields : tuple
+        Names of the columns to be returned.
+
+    Yields
+    ------
+    list
+        The values of the fields, decoded from utf-8.
+    """
+    with open(path, 'rb') as fin:
+        for row in csv.DictReader(fin):
+            yield [row[field].decode('utf-8') for field in fields]
+
+
+def load_encoded(cur, nodes=NODES, nodes_tags=NODES_TAGS, ways=WAYS,
+                 ways_nodes=WAYS_NODES, ways_tags=WAYS_TAGS, clustered=False):
+    """Load the csv files into the dictionary-encoded schema.
+
+    User names, tag keys and tag types are replaced by integer ids from
+    in-memory intern maps while the rows stream into the database; the lookup
+    tables are written at the end.
     
-    ways_nodes : str
-        Path to the csv file containing data for the 'ways_nodes' table.
+    Parameters
+    ----------
+    cur : sqlite3.Cursor
+        Cursor on a database without the tables of either schema.
     
-    ways_tags : str
-        Path to the csv file containing data for the 'ways_tags' table.
+    nodes, nodes_tags, ways, ways_nodes, ways_tags : str
+        Paths to the csv files containing data for each table.
+
+    clustered : bool
+        True to store 'ways_nodes' in a table clustered by node id.
     """
-    # Connect to the database
-    conn = sqlite3.connect(sqlite_file)
-    # Get a cursor object
-    cur = conn.cursor()
-    # Drop the table if it already exists
-    cur.execute('DROP TABLE IF EXISTS nodes')
-    cur.execute('DROP TABLE IF EXISTS nodes_tags')
-    cur.execute('DROP TABLE IF EXISTS ways')
-    cur.execute('DROP TABLE IF EXISTS ways_nodes')
-    cur.execute('DROP TABLE IF EXISTS ways_tags')
-    conn.commit()
+    users = Interner()
+    keys = Interner()
+    types = Interner()
+
+    create_schema(cur, ENCODED_SCHEMA, clustered)
 
-    # Create the table, specifying the column names and data types
-    cur.execute('''CREATE TABLE nodes(
-                   id INTEGER PRIMARY KEY, 
-                   lat REAL, 
-                   lon REAL, 
-                   user TEXT,
-                   uid INTEGER, 
-                   version TEXT, 
-                   changeset INTEGER, 
-                   timestamp TEXT)'''
-                )
-    cur.execute('''CREATE TABLE nodes_tags(
-                   id INTEGER REFERENCES nodes(id), 
-                   key TEXT, 
-                   value TEXT, 
-                   type TEXT)'''
-                )
-    cur.execute('''CREATE TABLE ways(
-                   id INTEGER PRIMARY KEY, 
-                   user TEXT, 
-                   uid INTEGER, 
-                   version TEXT,
-                   changeset INTEGER, 
-                   timestamp TEXT)'''
-                )
-    cur.execute('''CREATE TABLE ways_nodes(
-                   id INTEGER REFERENCES ways(id), 
-                   node_id INTEGER REFERENCES nodes(id), 
-                   position INTEGER)'''
-                )
-    cur.execute('''CREATE TABLE ways_tags(
-                   id INTEGER REFERENCES ways(id)	, 
-                   key TEXT, 
-                   value TEXT, 
-                   type TEXT)'''
-                )
+    cur.executemany('''INSERT INTO nodes_data(id, lat, lon, user_id, uid,
+                   version, changeset, timestamp, epoch)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);''',
+                   ((i, lat, lon, users(user), uid, version, changeset, ts,
+                     parse_timestamp(ts))
+                    for i, lat, lon, user, uid, version, changeset, ts
+                    in read_csv(nodes, ('id', 'lat', 'lon', 'user', 'uid',
+                                        'version', 'changeset',
+                                        'timestamp'))))
+    cur.executemany('''INSERT INTO nodes_tags_data(id, key_id, value, type_id)
+                   VALUES (?, ?, ?, ?);''',
+                   ((i, keys(key), value, types(tag_type))
+                    for i, key, value, tag_type
+                    in read_csv(nodes_tags, ('id', 'key', 'value', 'type'))))
+    cur.executemany('''INSERT INTO ways_data(id, user_id, uid, version,
+                   changeset, timestamp, epoch)
+                   VALUES (?, ?, ?, ?, ?, ?, ?);''',
+                   ((i, users(user), uid, version, changeset, ts,
+                     parse_timestamp(ts))
+                    for i, user, uid, version, changeset, ts
+                    in read_csv(ways, ('id', 'user', 'uid', 'version',
+                                       'changeset', 'timestamp'))))
+    cur.executemany('''INSERT INTO ways_nodes(id, node_id, position)
+                   VALUES (?, ?, ?);''',
+                   read_csv(ways_nodes, ('id', 'node_id', 'position')))
+    cur.executemany('''INSERT INTO ways_tags_data(id, key_id, value, type_id)
+                   VALUES (?, ?, ?, ?);''',
+                   ((i, keys(key), value, types(tag_type))
+                    for i, key, value, tag_type
+                    in read_csv(ways_tags, ('id', 'key', 'value', 'type'))))
+
+    cur.executemany('INSERT INTO users(id, user) VALUES (?, ?);',
+                    users.rows())
+    cur.executemany('INSERT INTO tag_keys(id, key) VALUES (?, ?);',
+                    keys.rows())
+    cur.executemany('INSERT INTO tag_types(id, type) VALUES (?, ?);',
+                    types.rows())
+
+
+def load_plain(cur, nodes=NODES, nodes_tags=NODES_TAGS, ways=WAYS,
+               ways_nodes=WAYS_NODES, ways_tags=WAYS_TAGS, clustered=False):
+    """Load the csv files into the plain schema, one table per csv file.
+    
+    Parameters
+    ----------
+    cur : sqlite3.Cursor
+        Cursor on a database without the tables of either schema.
+    
+    nodes, nodes_tags, ways, ways_nodes, ways_tags : str
+        Paths to the csv files containing data for each table.
+
+    clustered : bool
+        True to store 'ways_nodes' in a table clustered by node id.
+    """
+    # Create the tables, specifying the column names and data types
+    create_schema(cur, PLAIN_SCHEMA, clustered)
     # Commit the changes
-    conn.commit() 
+    cur.connection.commit() 
 
     # Read in the csv file as a dictionary; format the data as a list of tuples;
     # upload to db
-    with open('nodes.csv', 'rb') as fin:
+    with open(nodes, 'rb') as fin:
         dr = csv.DictReader(fin)
         to_db = [(i['id'].decode('utf-8'), i['lat'].decode('utf-8'), \
                   i['lon'].decode('utf-8'), i['user'].decode('utf-8'), \
                   i['uid'].decode('utf-8'), i['version'].decode('utf-8'), \
                   i['changeset'].decode('utf-8'), \
-                  i['timestamp'].decode('utf-8')) for i in dr]
+                  i['timestamp'].decode('utf-8'), \
+                  parse_timestamp(i['timestamp'])) for i in dr]
     cur.executemany('INSERT INTO nodes(id, lat, lon, user, uid, version, \
-                    changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?);', \
-                    to_db)
-    conn.commit()
+                    changeset, timestamp, epoch) \
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);', to_db)
+    cur.connection.commit()
 
-    with open('nodes_tags.csv', 'rb') as fin:
+    with open(nodes_tags, 'rb') as fin:
         dr = csv.DictReader(fin)
         to_db = [(i['id'].decode('utf-8'), i['key'].decode('utf-8'), \
                   i['value'].decode('utf-8'), i['type'].decode('utf-8')) \
                   for i in dr] 
     cur.executemany('INSERT INTO nodes_tags(id, key, value, type) VALUES \
                     (?, ?, ?, ?);', to_db)
-    conn.commit()
+    cur.connection.commit()
 
-    with open('ways.csv', 'rb') as fin:
+    with open(ways, 'rb') as fin:
         dr = csv.DictReader(fin)
         to_db = [(i['id'].decode('utf-8'), i['user'].decode('utf-8'), \
                   i['uid'].decode('utf-8'), i['version'].decode('utf-8'), \
                   i['changeset'].decode('utf-8'), \
-                  i['timestamp'].decode('utf-8')) for i in dr]
+                  i['timestamp'].decode('utf-8'), \
+                  parse_timestamp(i['timestamp'])) for i in dr]
     cur.executemany('INSERT INTO ways(id, user, uid, version, changeset, \
-                    timestamp) VALUES (?, ?, ?, ?, ?, ?);', to_db)
-    conn.commit()
+                    timestamp, epoch) VALUES (?, ?, ?, ?, ?, ?, ?);', to_db)
+    cur.connection.commit()
 
-    with open('ways_nodes.csv', 'rb') as fin:
+    with open(ways_nodes, 'rb') as fin:
         dr = csv.DictReader(fin)
         to_db = [(i['id'].decode('utf-8'), i['node_id'].decode('utf-8'), \
                   i['position'].decode('utf-8')) for i in dr]
     cur.executemany('INSERT INTO ways_nodes(id, node_id, position) VALUES \
                     (?, ?, ?);', to_db)
-    conn.commit()
+    cur.connection.commit()
 
-    with open('ways_tags.csv', 'rb') as fin:
+    with open(ways_tags, 'rb') as fin:
         dr = csv.DictReader(fin)
         to_db = [(i['id'].decode('utf-8'), i['key'].decode('utf-8'), \
                   i['value'].decode('utf-8'), i['type'].decode('utf-8')) \
                   for i in dr]
     cur.executemany('INSERT INTO ways_tags(id, key, value, type) VALUES \
                     (?, ?, ?, ?);', to_db)
+    cur.connection.commit()
+
+    cur.execute('CREATE INDEX nodes_epoch ON nodes(epoch)')
+    cur.execute('CREATE INDEX ways_epoch ON ways(epoch)')
+    cur.connection.commit()
+
+
+def build_activity_tables(cur):
+    """Build the activity rollups of the loaded 'nodes' and 'ways'.
+    
+    Parameters
+    ----------
+    cur : sqlite3.Cursor
+        Cursor on a database loaded by load_plain or load_encoded.
+    """
+    for statement in ACTIVITY_SCHEMA:
+        cur.execute(statement)
+
+
+def load_attrs(cur, table, path):
+    """Load a wide-format csv file written by osm_to_csv.process_map with
+    pivot=True.
+
+    The columns are taken from the header of the file. Every tag column is
+    indexed, so that e.g. all restaurants with their name, phone and address
+    can be found with a single indexed lookup.
+    
+    Parameters
+    ----------
+    cur : sqlite3.Cursor
+        Cursor on the database.
+
+    table : str
+        Name of the table to be created, 'node_attrs' or 'way_attrs'.
+
+    path : str
+        Path to the csv file.
+    """
+    with open(path, 'rb') as fin:
+        columns = next(csv.reader(fin))
+    definitions = []
+    for column in columns:
+        if column == 'id':
+            definitions.append('id INTEGER PRIMARY KEY')
+        elif column in ('lat', 'lon'):
+            definitions.append('%s REAL' % column)
+        else:
+            definitions.append('%s TEXT' % column)
+    cur.execute('CREATE TABLE %s(%s)' % (table, ', '.join(definitions)))
+    cur.executemany('INSERT INTO %s(%s) VALUES (%s);'
+                    % (table, ', '.join(columns),
+                       ', '.join('?' * len(columns))),
+                    ([value or None for value in row]
+                     for row in read_csv(path, columns)))
+    for column in columns:
+        if column not in ('id', 'lat', 'lon'):
+            cur.execute('CREATE INDEX %s_%s ON %s(%s)'
+                        % (table, column, table, column))
+
+
+def load_attrs_tables(cur, node_attrs=None, way_attrs=None):
+    """Load the wide-format tables whose csv files are given.
+    
+    Parameters
+    ----------
+    cur : sqlite3.Cursor
+        Cursor on the database.
+
+    node_attrs, way_attrs : str
+        Paths to the csv files for the 'node_attrs' and 'way_attrs' tables,
+        or None to skip a table.
+    """
+    if node_attrs is not None:
+        load_attrs(cur, 'node_attrs', node_attrs)
+    if way_attrs is not None:
+        load_attrs(cur, 'way_attrs', way_attrs)
+
+
+def print_tables(cur):
+    """Print the first rows of each table, to check the import.
+    
+    Parameters
+    ----------
+    cur : sqlite3.Cursor
+        Cursor on the database.
+    """
+    for f in ('nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags'):
+        cur.execute('SELECT * FROM %s LIMIT 10;' % f)
+        all_rows = cur.fetchall()
+        pprint(all_rows)
+
+
+def convert_csv_to_database(sqlite_file=SQLITE_FILE, nodes=NODES, 
+                            nodes_tags=NODES_TAGS, ways=WAYS, 
+                            ways_nodes=WAYS_NODES, ways_tags=WAYS_TAGS,
+                            check_tables=True, encoded=False,
+                            node_attrs=None, way_attrs=None, activity=True,
+                            indexes=True, clustered=False):
+    """Transfers records from csv files to a sqlite database.
+    
+    Parameters
+    ----------
+    sqlite_file : str
+        Path to the sqlite database file to be created.
+    
+    nodes : str
+        Path to the csv file containing data for the 'nodes' table.
+    
+    nodes_tags : str
+        Path to the csv file containing data for the 'nodes_tags' table.
+    
+    ways : str
+        Path to the csv file containing data for the 'ways' table.
+    
+    ways_nodes : str
+        Path to the csv file containing data for the 'ways_nodes' table.
+    
+    ways_tags : str
+        Path to the csv file containing data for the 'ways_tags' table.
+
+    check_tables : bool
+        True to print the first rows of each table after the import.
+
+    encoded : bool
+        True to store user names, tag keys and tag types once, in lookup
+        tables 'users', 'tag_keys' and 'tag_types', referenced by integer ids.
+        Views named after the plain tables keep the original column names.
+
+    node_attrs, way_attrs : str
+        Paths to the wide-format csv files for the 'node_attrs' and
+        'way_attrs' tables, e.g. the module level variables NODE_ATTRS and
+        WAY_ATTRS. The tables are only created if a path is given.
+
+    activity : bool
+        True to build the activity rollups 'contributors',
+        'user_daily_activity', 'user_monthly_activity' and
+        'changeset_activity', queried by activity.py.
+
+    indexes : bool
+        True to index tags by element id and by key and value, way nodes by
+        way and by node, and nodes by position, as used by export_osm.py and
+        other filtered queries.
+
+    clustered : bool
+        True to store 'ways_nodes' in a WITHOUT ROWID table clustered by node
+        id, way id and position, which makes the separate index on node id
+        unnecessary. Loading is fastest when the csv file is sorted in that
+        order, e.g. by osm_to_csv.process_map(sort=True).
+    """
+    # Connect to the database
+    conn = sqlite3.connect(sqlite_file)
+    # Get a cursor object
+    cur = conn.cursor()
+    # Drop the tables and views if they already exist
+    drop_schema(cur)
+    conn.commit()
+
+    if encoded:
+        load_encoded(cur, nodes, nodes_tags, ways, ways_nodes, ways_tags,
+                     clustered)
+    else:
+        load_plain(cur, nodes, nodes_tags, ways, ways_nodes, ways_tags,
+                   clustered)
     conn.commit()
 
+    if indexes:
+        for statement in ENCODED_INDEXES if encoded else PLAIN_INDEXES:
+            # The clustered table is already ordered by node id
+            if clustered and 'ways_nodes_node_id' in statement:
+                continue
+            cur.execute(statement)
+        conn.commit()
+
+    load_attrs_tables(cur, node_attrs, way_attrs)
+    if activity:
+        build_activity_tables(cur)
+    conn.commit()
+
+    # Invalidate cached query results for the previous contents
+    bump_generation(conn)
+
     # Check that the data imported correctly
     if check_tables == True:
-        for f in ('nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags'):
-            table = (f,)
-            cur.execute('SELECT * FROM %s LIMIT 10;' % f)
-            all_rows = cur.fetchall()
-            pprint(all_rows)
+        print_tables(cur)
 
     # Close the connection
     conn.close()
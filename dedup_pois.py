@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Script dedup_pois.py finds points of interest (POIs) that are mapped more than
+once in the database created by csv_to_database.py, e.g. a restaurant mapped
+both as a node and as the building way it occupies.
+
+Comparing every pair of POIs is quadratic, so candidates are blocked first. A
+POI is placed in a grid cell as tall as the match distance, under
+two blocking keys: its normalized name and its normalized phone number. Only
+POIs that share a key and lie in neighbouring cells are compared, and pairs
+closer than MAX_DISTANCE are joined into clusters with a union-find
+structure. Names are normalized with the street abbreviation expansion of
+osm_to_csv.py, and phone numbers with its phone number formatting.
+
+Acknowledgments:
+[1] https://en.wikipedia.org/wiki/Record_linkage#Blocking
+[2] https://en.wikipedia.org/wiki/Disjoint-set_data_structure
+"""
+
+from collections import defaultdict
+import csv
+import math
+import re
+import sqlite3
+
+import numpy as np
+
+from osm_to_csv import fix_phone_numbers, fix_street_abbrevs
+from osm_utils import EARTH_RADIUS, haversine, iter_rows
+
+
+DB = 'mydb.db'
+"""str: Path to the sqlite database to be searched."""
+
+DUPLICATES_PATH = 'duplicate_pois.csv'
+"""str: Path to the csv file listing the duplicate clusters."""
+
+POI_KEYS = ('amenity', 'shop', 'tourism', 'leisure', 'office', 'craft',
+            'healthcare', 'building')
+"""tuple: Tag keys that mark a node or way as a POI."""
+
+MAX_DISTANCE = 100.0
+"""float: Maximum distance in meters between duplicates."""
+
+METERS_PER_DEGREE = math.radians(EARTH_RADIUS)
+"""float: Length in meters of a degree of latitude."""
+
+PHONE_FORMAT = re.compile(r'^[0-9]{3}-[0-9]{3}-[0-9]{4}$')
+"""re.RegexObject: Regular expression for phone numbers normalized by
+osm_to_csv.fix_phone_numbers."""
+
+NAME_STRIP = re.compile(r"[^\w\s]", re.UNICODE)
+"""re.RegexObject: Regular expression for the punctuation removed from
+names."""
+
+POI_QUERY = '''SELECT 'node', n.id, n.lat, n.lon,
+                      (SELECT value FROM nodes_tags t
+                       WHERE t.id = n.id AND t.key = 'name'
+                       AND t.type = 'regular'),
+                      (SELECT value FROM nodes_tags t
+                       WHERE t.id = n.id AND t.key = 'phone'
+                       AND t.type = 'regular')
+               FROM nodes n
+               WHERE n.id IN (SELECT id FROM nodes_tags
+                              WHERE type = 'regular' AND key IN (%(keys)s))
+               UNION ALL
+               SELECT 'way', w.id,
+                      (SELECT AVG(n.lat) FROM ways_nodes wn
+                       JOIN nodes n ON n.id = wn.node_id WHERE wn.id = w.id),
+                      (SELECT AVG(n.lon) FROM ways_nodes wn
+                       JOIN nodes n ON n.id = wn.node_id WHERE wn.id = w.id),
+                      (SELECT value FROM ways_tags t
+                       WHERE t.id = w.id AND t.key = 'name'
+                       AND t.type = 'regular'),
+                      (SELECT value FROM ways_tags t
+                       WHERE t.id = w.id AND t.key = 'phone'
+                       AND t.type = 'regular')
+               FROM ways w
+               WHERE w.id IN (SELECT id FROM ways_tags
+                              WHERE type = 'regular' AND key IN (%(keys)s));'''
+"""str: Query for the type, id, position (the centroid, for ways), name and
+phone number of every POI."""
+
+
+################################################################################
+#                              HELPER FUNCTIONS                                #
+################################################################################
+
+def normalize_name(name):
+    """Reduce a name to a form shared by its spelling variants.
+
+    Abbreviations are expanded, punctuation removed, case folded, and the
+    words sorted, so that e.g. "Joe's Pizza" and "Pizza, Joes" match.
+
+    Parameters
+    ----------
+    name : str
+        The value of a 'name' tag.
+
+    Returns
+    -------
+    str
+        The normalized name, or None if nothing is left.
+    """
+    if not name:
+        return None
+    words = NAME_STRIP.sub('', fix_street_abbrevs(name)).lower().split()
+    return ' '.join(sorted(words)) or None
+
+
+def normalize_phone(phone):
+    """Reduce a phone number to the format written by fix_phone_numbers.
+
+    Parameters
+    ----------
+    phone : str
+        The value of a 'phone' tag.
+
+    Returns
+    -------
+    str
+        The number as '123-456-7890', or None if it has no such form.
+    """
+    if not phone:
+        return None
+    phone = fix_phone_numbers(phone)
+    return phone if PHONE_FORMAT.match(phone) else None
+
+
+class DisjointSet(object):
+    """Union-find over consecutive integers, with path halving."""
+
+    def __init__(self):
+        self.parent = []
+
+    def add(self):
+        """Add a new singleton set and return its element."""
+        self.parent.append(len(self.parent))
+        return len(self.parent) - 1
+
+    def find(self, x):
+        """Return the representative of the set containing x."""
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, x, y):
+        """Merge the sets containing x and y."""
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            self.parent[max(x, y)] = min(x, y)
+
+
+def iter_pois(conn, poi_keys=POI_KEYS):
+    """Yield the POIs of the database.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the database.
+
+    poi_keys : tuple
+        Tag keys that mark a node or way as a POI.
+
+    Yields
+    ------
+    tuple
+        (type, id, lat, lon, name, phone) of each POI with a position.
+    """
+    keys = ', '.join('?' * len(poi_keys))
+    cur = conn.execute(POI_QUERY % {'keys': keys}, tuple(poi_keys) * 2)
+    for row in iter_rows(cur):
+        if row[2] is not None:
+            yield row
+
+
+def find_clusters(pois, max_distance=MAX_DISTANCE):
+    """Cluster POIs that share a name or phone number and lie close together.
+
+    Parameters
+    ----------
+    pois : iterable
+        (type, id, lat, lon, name, phone) of each POI.
+
+    max_distance : float
+        Maximum distance in meters between duplicates.
+
+    Returns
+    -------
+    list
+        The clusters of two or more POIs, each a list of POI tuples.
+    """
+    cell = max_distance / METERS_PER_DEGREE
+    sets = DisjointSet()
+    records = []
+    blocks = defaultdict(list)
+    for poi in pois:
+        _, _, lat, lon, name, phone = poi
+        index = sets.add()
+        records.append(poi)
+        cx, cy = int(math.floor(lon / cell)), int(math.floor(lat / cell))
+        # A cell spans fewer meters east-west than north-south, so more
+        # columns are searched
+        span = int(math.ceil(1.0 / max(math.cos(math.radians(lat)), 0.01)))
+        keys = [key for key in (('name', normalize_name(name)),
+                                ('phone', normalize_phone(phone)))
+                if key[1] is not None]
+        candidates = []
+        for key in keys:
+            for x in range(cx - span, cx + span + 1):
+                for y in (cy - 1, cy, cy + 1):
+                    candidates.extend(blocks.get((key, x, y), ()))
+            blocks[(key, cx, cy)].append(index)
+        if candidates:
+            # Measure the distances to all candidates at once
+            lats = np.array([records[other][2] for other in candidates])
+            lons = np.array([records[other][3] for other in candidates])
+            close = haversine(lat, lon, lats, lons) <= max_distance
+            for other, near in zip(candidates, close):
+                if near:
+                    sets.union(index, other)
+
+    clusters = defaultdict(list)
+    for index, poi in enumerate(records):
+        clusters[sets.find(index)].append(poi)
+    return [cluster for _, cluster in sorted(clusters.iteritems())
+            if len(cluster) > 1]
+
+
+################################################################################
+#                                MAIN FUNCTION                                 #
+################################################################################
+
+def find_duplicate_pois(db=DB, out_file=DUPLICATES_PATH,
+                        max_distance=MAX_DISTANCE, poi_keys=POI_KEYS):
+    """Find duplicate POIs and write the clusters to a csv file.
+
+    Parameters
+    ----------
+    db : str
+        Path to the sqlite database.
+
+    out_file : str
+        Path to the csv output, with one row per POI in a cluster, or None to
+        skip writing.
+
+    max_distance : float
+        Maximum distance in meters between duplicates.
+
+    poi_keys : tuple
+        Tag keys that mark a node or way as a POI.
+
+    Returns
+    -------
+    list
+        The clusters, each a list of (type, id, lat, lon, name, phone).
+    """
+    conn = sqlite3.connect(db)
+    try:
+        clusters = find_clusters(iter_pois(conn, poi_keys), max_distance)
+    finally:
+        conn.close()
+
+    if out_file is not None:
+        with open(out_file, 'wb') as fout:
+            writer = csv.writer(fout)
+            writer.writerow(['cluster', 'type', 'id', 'lat', 'lon', 'name',
+                             'phone'])
+            for number, cluster in enumerate(clusters, 1):
+                for poi in cluster:
+                    writer.writerow([number] + [
+                        value.encode('utf-8') if isinstance(value, unicode)
+                        else value for value in poi])
+    return clusters
+
+
+if __name__ == '__main__':
+    find_duplicate_pois()
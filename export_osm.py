@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""
+Script export_osm.py writes the cleaned data in the database created by
+csv_to_database.py back out in a standard format:
+ - OSM XML, readable by the usual OpenStreetMap tools
+ - Line-delimited GeoJSON, one feature per line: a Point for every tagged node
+   and a LineString for every way
+
+The element and tag tables are read in id order through cursors with
+fetchmany and merged on the fly, so memory use does not grow with the size of
+the database. The export can be restricted to a bounding box or to elements
+with a given tag; the selection is made in SQL with the indexes created by
+csv_to_database.py and kept in temporary tables.
+
+The exported values are already cleaned, and the cleaners of osm_to_csv.py are
+not all idempotent (fix_phone_numbers turns '555-1234' into '555-123-4', then
+into '555-123-'), so an export should not be converted again with
+process_map. Convert the original OSM file instead.
+
+Acknowledgments:
+[1] https://wiki.openstreetmap.org/wiki/OSM_XML
+[2] https://tools.ietf.org/html/rfc7946
+[3] http://ndjson.org/
+"""
+
+import codecs
+import json
+import sqlite3
+from xml.sax.saxutils import quoteattr
+
+from osm_utils import iter_rows
+
+
+DB = 'mydb.db'
+"""str: Path to the sqlite database to be exported."""
+
+OSM_EXPORT_PATH = 'export.osm'
+"""str: Path to the OSM XML output file."""
+
+GEOJSON_EXPORT_PATH = 'export.geojson'
+"""str: Path to the line-delimited GeoJSON output file."""
+
+
+DEFAULT_TAG_TYPE = 'regular'
+"""str: Tag type of keys stored without a prefix, as in osm_to_csv.py."""
+
+
+################################################################################
+#                              HELPER FUNCTIONS                                #
+################################################################################
+
+def osm_key(key, tag_type):
+    """Rebuild the original key of a tag split by osm_to_csv.shape_element.
+
+    Parameters
+    ----------
+    key : str
+        The 'key' field of the tag.
+
+    tag_type : str
+        The 'type' field of the tag.
+
+    Returns
+    -------
+    str
+        The OSM key, e.g. 'addr:street' for key 'street' and type 'addr'.
+    """
+    if tag_type == DEFAULT_TAG_TYPE:
+        return key
+    return tag_type + ':' + key
+
+
+def split_key(osm_key):
+    """Split an OSM key into the 'type' and 'key' fields of the database.
+
+    Parameters
+    ----------
+    osm_key : str
+        A key such as 'amenity' or 'addr:street'.
+
+    Returns
+    -------
+    tuple
+        The 'type' and 'key' fields.
+    """
+    if ':' in osm_key:
+        tag_type, key = osm_key.split(':', 1)
+        return tag_type, key
+    return DEFAULT_TAG_TYPE, osm_key
+
+
+def iter_groups(rows):
+    """Group rows sorted by their first column.
+
+    Parameters
+    ----------
+    rows : iterable
+        Rows whose first column is an element id, in id order.
+
+    Yields
+    ------
+    tuple
+        An id and the list of the remaining columns of each row with that id.
+    """
+    current_id = None
+    group = []
+    for row in rows:
+        if row[0] != current_id:
+            if group:
+                yield current_id, group
+            current_id = row[0]
+            group = []
+        group.append(row[1:])
+    if group:
+        yield current_id, group
+
+
+def merge_children(parents, *children):
+    """Attach the child rows of each parent element, merging streams sorted
+    by element id.
+
+    Parameters
+    ----------
+    parents : iterable
+        Element rows whose first column is the id, in id order.
+
+    children : iterables
+        Streams of (id, list) groups from iter_groups, in id order.
+
+    Yields
+    ------
+    tuple
+        The parent row followed by one list of child rows per stream (empty
+        if the element has none).
+    """
+    streams = [iter_groups(child) for child in children]
+    heads = [next(stream, None) for stream in streams]
+    for parent in parents:
+        element_id = parent[0]
+        lists = []
+        for i, stream in enumerate(streams):
+            while heads[i] is not None and heads[i][0] < element_id:
+                heads[i] = next(stream, None)
+            if heads[i] is not None and heads[i][0] == element_id:
+                lists.append(heads[i][1])
+                heads[i] = next(stream, None)
+            else:
+                lists.append([])
+        yield (parent,) + tuple(lists)
+
+
+def select_elements(conn, bbox=None, tag=None, complete_ways=True):
+    """Record the ids of the elements to be exported in temporary tables.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the database.
+
+    bbox : tuple
+        (min_lat, min_lon, max_lat, max_lon). If given, only the nodes in the
+        box and the ways with at least one node in the box are exported.
+
+    tag : tuple
+        (key, value) or (key, None). If given, only the elements with this
+        tag (and any value, if value is None) are exported.
+
+    complete_ways : bool
+        True to also export the nodes of exported ways that do not match the
+        filters themselves, so that every way can be drawn.
+
+    Returns
+    -------
+    bool
+        True if the temporary tables 'export_nodes' and 'export_ways' were
+        created, False if there is no filter and everything is exported.
+    """
+    if bbox is None and tag is None:
+        return False
+
+    node_filters, way_filters, params_nodes, params_ways = [], [], [], []
+    if bbox is not None:
+        min_lat, min_lon, max_lat, max_lon = bbox
+        node_filters.append('''id IN (SELECT id FROM nodes
+                               WHERE lat BETWEEN ? AND ?
+                               AND lon BETWEEN ? AND ?)''')
+        params_nodes.extend([min_lat, max_lat, min_lon, max_lon])
+        way_filters.append('''id IN (SELECT wn.id
+                              FROM nodes n JOIN ways_nodes wn
+                              ON wn.node_id = n.id
+                              WHERE n.lat BETWEEN ? AND ?
+                              AND n.lon BETWEEN ? AND ?)''')
+        params_ways.extend([min_lat, max_lat, min_lon, max_lon])
+    if tag is not None:
+        key, value = tag
+        tag_type, key = split_key(key)
+        value_filter = '' if value is None else 'AND value = ?'
+        params = [key, tag_type] + ([] if value is None else [value])
+        for table, filters, filter_params in (
+                ('nodes_tags', node_filters, params_nodes),
+                ('ways_tags', way_filters, params_ways)):
+            filters.append('''id IN (SELECT id FROM %s
+                              WHERE key = ? AND type = ? %s)'''
+                           % (table, value_filter))
+            filter_params.extend(params)
+
+    conn.execute('DROP TABLE IF EXISTS temp.export_nodes')
+    conn.execute('DROP TABLE IF EXISTS temp.export_ways')
+    conn.execute('CREATE TEMP TABLE export_nodes(id INTEGER PRIMARY KEY)')
+    conn.execute('CREATE TEMP TABLE export_ways(id INTEGER PRIMARY KEY)')
+    conn.execute('INSERT INTO temp.export_ways(id) SELECT id FROM ways '
+                 'WHERE %s' % ' AND '.join(way_filters), params_ways)
+    conn.execute('INSERT INTO temp.export_nodes(id) SELECT id FROM nodes '
+                 'WHERE %s' % ' AND '.join(node_filters), params_nodes)
+    if complete_ways:
+        conn.execute('''INSERT OR IGNORE INTO temp.export_nodes(id)
+                        SELECT wn.node_id
+                        FROM temp.export_ways w JOIN ways_nodes wn
+                        ON wn.id = w.id''')
+    return True
+
+
+def element_query(table, columns, selected, order='id'):
+    """Build the query reading the rows of the exported elements.
+
+    Parameters
+    ----------
+    table : str
+        Table (or view) to be read, whose first column is the element id.
+
+    columns : str
+        Comma separated columns, the element id first.
+
+    selected : str
+        Temporary table holding the ids of the exported elements, or None to
+        read every row.
+
+    order : str
+        ORDER BY clause, starting with the element id.
+
+    Returns
+    -------
+    str
+        The query text.
+    """
+    if selected is None:
+        return 'SELECT %s FROM %s ORDER BY %s;' % (columns, table, order)
+    columns = ', '.join('t.' + c.strip() for c in columns.split(','))
+    order = ', '.join('t.' + c.strip() for c in order.split(','))
+    return ('SELECT %s FROM temp.%s s JOIN %s t ON t.id = s.id ORDER BY %s;'
+            % (columns, selected, table, order))
+
+
+def iter_nodes(conn, filtered):
+    """Yield the exported nodes with their tags.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the database.
+
+    filtered : bool
+        True if select_elements created the temporary tables.
+
+    Yields
+    ------
+    tuple
+        (id, lat, lon, user, uid, version, changeset, timestamp) and a list of
+        (key, value, type) tuples.
+    """
+    selected = 'export_nodes' if filtered else None
+    nodes = iter_rows(conn.execute(element_query(
+        'nodes', 'id, lat, lon, user, uid, version, changeset, timestamp',
+        selected)))
+    tags = iter_rows(conn.execute(element_query(
+        'nodes_tags', 'id, key, value, type', selected)))
+    return merge_children(nodes, tags)
+
+
+def iter_ways(conn, filtered, coordinates=False):
+    """Yield the exported ways with their nodes and tags.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the database.
+
+    filtered : bool
+        True if select_elements created the temporary tables.
+
+    coordinates : bool
+        True to return the (lon, lat) of each node along the way instead of
+        its id. Nodes missing from the 'nodes' table are skipped.
+
+    Yields
+    ------
+    tuple
+        (id, user, uid, version, changeset, timestamp), a list of (node_id,)
+        or (lon, lat) tuples in order along the way, and a list of
+        (key, value, type) tuples.
+    """
+    selected = 'export_ways' if filtered else None
+    ways = iter_rows(conn.execute(element_query(
+        'ways', 'id, user, uid, version, changeset, timestamp', selected)))
+    if coordinates:
+        join = 'JOIN nodes n ON n.id = wn.node_id'
+        if filtered:
+            join = 'JOIN temp.export_ways s ON s.id = wn.id ' + join
+        way_nodes = iter_rows(conn.execute('''SELECT wn.id, n.lon, n.lat
+                                              FROM ways_nodes wn %s
+                                              ORDER BY wn.id, wn.position;'''
+                                           % join))
+    else:
+        way_nodes = iter_rows(conn.execute(element_query(
+            'ways_nodes', 'id, node_id', selected, 'id, position')))
+    tags = iter_rows(conn.execute(element_query(
+        'ways_tags', 'id, key, value, type', selected)))
+    return merge_children(ways, way_nodes, tags)
+
+
+def xml_attrs(names, values):
+    """Format element attributes for OSM XML, skipping missing values."""
+    return ''.join(' %s=%s' % (name, quoteattr(unicode(value)))
+                   for name, value in zip(names, values) if value is not None)
+
+
+def xml_tags(tags):
+    """Format the tag children of an element for OSM XML."""
+    return ''.join('    <tag k=%s v=%s/>\n'
+                   % (quoteattr(osm_key(key, tag_type)), quoteattr(value))
+                   for key, value, tag_type in tags)
+
+
+def geojson_properties(element_type, element_id, tags):
+    """Build the properties of a GeoJSON feature from an element's tags."""
+    properties = {'@type': element_type, '@id': element_id}
+    for key, value, tag_type in tags:
+        properties[osm_key(key, tag_type)] = value
+    return properties
+
+
+################################################################################
+#                                MAIN FUNCTIONS                                #
+################################################################################
+
+def export_osm(out_file=OSM_EXPORT_PATH, db=DB, bbox=None, tag=None,
+               complete_ways=True):
+    """Export the database to an OSM XML file.
+
+    The file holds cleaned values; it should not be converted again with
+    osm_to_csv.process_map, which would clean them twice.
+
+    Parameters
+    ----------
+    out_file : str
+        Path to the output file.
+
+    db : str
+        Path to the sqlite database.
+
+    bbox : tuple
+        (min_lat, min_lon, max_lat, max_lon) to export only part of the map.
+
+    tag : tuple
+        (key, value) or (key, None) to export only elements with a tag, e.g.
+        ('amenity', 'restaurant') or ('addr:street', None).
+
+    complete_ways : bool
+        True to include every node of the exported ways.
+    """
+    node_fields = ('id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset',
+                   'timestamp')
+    way_fields = ('id', 'user', 'uid', 'version', 'changeset', 'timestamp')
+    conn = sqlite3.connect(db)
+    try:
+        filtered = select_elements(conn, bbox, tag, complete_ways)
+        with codecs.open(out_file, 'w', encoding='utf-8') as fout:
+            fout.write(u"<?xml version='1.0' encoding='UTF-8'?>\n")
+            fout.write(u'<osm version="0.6" generator="export_osm.py">\n')
+            for node, tags in iter_nodes(conn, filtered):
+                node = node[:1] + ('%.7f' % node[1], '%.7f' % node[2]) + \
+                    node[3:]
+                if tags:
+                    fout.write(u'  <node%s>\n%s  </node>\n'
+                               % (xml_attrs(node_fields, node),
+                                  xml_tags(tags)))
+                else:
+                    fout.write(u'  <node%s/>\n'
+                               % xml_attrs(node_fields, node))
+            for way, way_nodes, tags in iter_ways(conn, filtered):
+                fout.write(u'  <way%s>\n' % xml_attrs(way_fields, way))
+                fout.write(u''.join(u'    <nd ref="%d"/>\n' % node_id
+                                    for (node_id,) in way_nodes))
+                fout.write(xml_tags(tags))
+                fout.write(u'  </way>\n')
+            fout.write(u'</osm>\n')
+    finally:
+        conn.close()
+
+
+def export_geojson(out_file=GEOJSON_EXPORT_PATH, db=DB, bbox=None, tag=None):
+    """Export the database to a line-delimited GeoJSON file.
+
+    Every tagged node becomes a Point feature and every way with at least two
+    nodes a LineString feature; tags become feature properties, together
+    with '@type' and '@id'.
+
+    Parameters
+    ----------
+    out_file : str
+        Path to the output file.
+
+    db : str
+        Path to the sqlite database.
+
+    bbox : tuple
+        (min_lat, min_lon, max_lat, max_lon) to export only part of the map.
+
+    tag : tuple
+        (key, value) or (key, None) to export only elements with a tag.
+    """
+    conn = sqlite3.connect(db)
+    try:
+        filtered = select_elements(conn, bbox, tag, complete_ways=False)
+        with open(out_file, 'w') as fout:
+            for node, tags in iter_nodes(conn, filtered):
+                if not tags:
+                    continue
+                feature = {
+                    'type': 'Feature',
+                    'geometry': {'type': 'Point',
+                                 'coordinates': [node[2], node[1]]},
+                    'properties': geojson_properties('node', node[0], tags)
+                }
+                fout.write(json.dumps(feature, sort_keys=True) + '\n')
+            for way, points, tags in iter_ways(conn, filtered,
+                                               coordinates=True):
+                if len(points) < 2:
+                    continue
+                feature = {
+                    'type': 'Feature',
+                    'geometry': {'type': 'LineString',
+                                 'coordinates': [list(p) for p in points]},
+                    'properties': geojson_properties('way', way[0], tags)
+                }
+                fout.write(json.dumps(feature, sort_keys=True) + '\n')
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    export_osm()
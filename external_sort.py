@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Module external_sort.py sorts csv files written by osm_to_csv.py that may be
+too large to sort in memory, e.g. 'ways_nodes' by node id for reverse lookups
+and for loading into the clustered tables of csv_to_database.py.
+
+The rows are read in runs that fit in a memory budget; each run is sorted
+and spilled to a temporary file, and the runs are then merged with a heap,
+MAX_MERGE at a time. The sort is stable, so rows with equal keys (e.g. the
+tags of one element) keep their order.
+
+Acknowledgments:
+[1] https://en.wikipedia.org/wiki/External_sorting
+[2] https://docs.python.org/2/library/heapq.html
+"""
+
+import csv
+import heapq
+import os
+import shutil
+import tempfile
+
+
+MEMORY_BUDGET = 64 * 1024 * 1024
+"""int: Approximate number of bytes of rows held in memory at a time."""
+
+ROW_OVERHEAD = 200
+"""int: Approximate number of bytes used by a row in memory besides the
+characters of its fields (the list, string and key tuple headers)."""
+
+MAX_MERGE = 64
+"""int: Maximum number of runs merged at a time, to bound the number of open
+files."""
+
+SORT_KEYS = (('nodes', ('id',)),
+             ('node_tags', ('id',)),
+             ('ways', ('id',)),
+             ('way_nodes', ('node_id', 'id', 'position')),
+             ('way_tags', ('id',)),
+             ('node_attrs', ('id',)),
+             ('way_attrs', ('id',)))
+"""tuple: Name of each output of osm_to_csv.py and the integer columns it is
+sorted by."""
+
+
+################################################################################
+#                              HELPER FUNCTIONS                                #
+################################################################################
+
+def write_run(rows, directory):
+    """Write sorted rows to a temporary run file.
+
+    Parameters
+    ----------
+    rows : iterable
+        (key, row) pairs, in order.
+
+    directory : str
+        Directory of the run file.
+
+    Returns
+    -------
+    str
+        Path to the run file.
+    """
+    handle, path = tempfile.mkstemp(suffix='.csv', dir=directory)
+    with os.fdopen(handle, 'wb') as fout:
+        csv.writer(fout).writerows(row for _, row in rows)
+    return path
+
+
+def iter_run(path, key_columns, run_index):
+    """Yield the rows of a run file, decorated for a stable merge.
+
+    Parameters
+    ----------
+    path : str
+        Path to the run file.
+
+    key_columns : list
+        Indexes of the integer key columns.
+
+    run_index : int
+        Position of the run among the runs merged, used to break ties.
+
+    Yields
+    ------
+    tuple
+        (key, run_index, row_index, row).
+    """
+    with open(path, 'rb') as fin:
+        for row_index, row in enumerate(csv.reader(fin)):
+            yield (tuple(int(row[i]) for i in key_columns), run_index,
+                   row_index, row)
+
+
+def merge_runs(paths, key_columns):
+    """Merge sorted run files.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to the run files, in input order.
+
+    key_columns : list
+        Indexes of the integer key columns.
+
+    Returns
+    -------
+    iterator
+        The (key, row) pairs of all runs, in order. Rows with equal keys come
+        out in input order.
+    """
+    merged = heapq.merge(*[iter_run(path, key_columns, run_index)
+                           for run_index, path in enumerate(paths)])
+    return ((key, row) for key, _, _, row in merged)
+
+
+def split_runs(reader, key_columns, memory_budget, directory):
+    """Sort the rows of a csv reader into runs that fit in memory.
+
+    Parameters
+    ----------
+    reader : csv.reader
+        The rows to be sorted, after the header.
+
+    key_columns : list
+        Indexes of the integer key columns.
+
+    memory_budget : int
+        Approximate number of bytes of rows held in memory at a time.
+
+    directory : str
+        Directory for the run files.
+
+    Returns
+    -------
+    tuple
+        The paths to the run files, and the sorted (key, row) pairs of the
+        last run, which is kept in memory.
+    """
+    paths = []
+    rows = []
+    size = 0
+    for row in reader:
+        rows.append((tuple(int(row[i]) for i in key_columns), row))
+        size += ROW_OVERHEAD + sum(len(field) for field in row)
+        if size >= memory_budget:
+            # Timsort is stable, so sorting on the key alone keeps input order
+            rows.sort(key=lambda pair: pair[0])
+            paths.append(write_run(rows, directory))
+            rows = []
+            size = 0
+    rows.sort(key=lambda pair: pair[0])
+    return paths, rows
+
+
+################################################################################
+#                                MAIN FUNCTION                                 #
+################################################################################
+
+def sort_csv(in_path, out_path, key_fields, memory_budget=MEMORY_BUDGET,
+             temp_dir=None):
+    """Sort a csv file by integer columns, within a memory budget.
+
+    Parameters
+    ----------
+    in_path : str
+        Path to the csv file, with a header row.
+
+    out_path : str
+        Path to the sorted csv file. May be the same as in_path, in which
+        case the file is replaced once sorted.
+
+    key_fields : tuple
+        Names of the integer columns to sort by, most significant first.
+
+    memory_budget : int
+        Approximate number of bytes of rows held in memory at a time.
+        Defaults to the module level variable MEMORY_BUDGET.
+
+    temp_dir : str
+        Directory for the temporary run files. Defaults to the directory of
+        out_path.
+
+    Returns
+    -------
+    int
+        The number of runs spilled to disk; 0 if the file was sorted in
+        memory.
+    """
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    run_dir = tempfile.mkdtemp(dir=temp_dir or out_dir)
+    try:
+        with open(in_path, 'rb') as fin:
+            reader = csv.reader(fin)
+            header = next(reader)
+            key_columns = [header.index(field) for field in key_fields]
+            paths, rows = split_runs(reader, key_columns, memory_budget,
+                                     run_dir)
+        if paths:
+            if rows:
+                paths.append(write_run(rows, run_dir))
+            spilled = len(paths)
+            # Merge groups of runs until one merge can produce the output
+            while len(paths) > MAX_MERGE:
+                paths = [write_run(merge_runs(paths[i:i + MAX_MERGE],
+                                              key_columns), run_dir)
+                         for i in range(0, len(paths), MAX_MERGE)]
+            rows = merge_runs(paths, key_columns)
+        else:
+            spilled = 0
+
+        # Write next to the output and rename, so that in_path can be out_path
+        handle, sorted_path = tempfile.mkstemp(suffix='.csv', dir=out_dir)
+        with os.fdopen(handle, 'wb') as fout:
+            writer = csv.writer(fout)
+            writer.writerow(header)
+            writer.writerows(row for _, row in rows)
+        shutil.copymode(in_path, sorted_path)
+        os.rename(sorted_path, out_path)
+    finally:
+        shutil.rmtree(run_dir)
+    return spilled
+
+
+def sort_outputs(outputs, memory_budget=MEMORY_BUDGET, sort_keys=SORT_KEYS):
+    """Sort the csv files written by osm_to_csv.process_map in place.
+
+    Parameters
+    ----------
+    outputs : tuple
+        (name, path, fields) of each output, as in osm_to_csv.OUTPUTS.
+
+    memory_budget : int
+        Approximate number of bytes of rows held in memory at a time.
+
+    sort_keys : tuple
+        Name of each output to be sorted and its key columns. Outputs not
+        listed are left as they are.
+    """
+    keys = dict(sort_keys)
+    for name, path, _ in outputs:
+        if name in keys:
+            sort_csv(path, path, keys[name], memory_budget)
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Script extract_region.py takes a raw OpenStreetMaps XML file and writes the
+subset of the map that falls within a bounding box or polygon to a new OSM
+file. The subset is referentially complete:
+ - Every node inside the region is kept
+ - Every way with at least one node inside the region is kept, together with
+   all of its nodes (including those outside the region)
+ - Every relation with at least one kept member is kept; members that are not
+   part of the subset are dropped
+
+The input is streamed three times (node pass, way pass, write pass), and ids are
+tracked in sorted integer arrays, so memory use stays bounded on large inputs.
+
+Acknowledgments:
+[1] https://wiki.openstreetmap.org/wiki/OSM_XML
+[2] https://en.wikipedia.org/wiki/Point_in_polygon#Ray_casting_algorithm
+"""
+
+import codecs
+from xml.sax.saxutils import quoteattr
+import xml.etree.cElementTree as ET
+
+from id_sets import SortedIdArray
+from osm_to_csv import get_element
+
+
+OSM_PATH = "Rochester.osm"
+"""str: Path to OpenStreetMaps XML file to be extracted from."""
+
+SAMPLE_PATH = "Rochester_sample.osm"
+"""str: Path to the OSM file to be written."""
+
+BBOX = (43.13, -77.64, 43.18, -77.56)
+"""tuple: Default region (min_lat, min_lon, max_lat, max_lon), downtown
+Rochester."""
+
+
+################################################################################
+#                              HELPER FUNCTIONS                                #
+################################################################################
+
+def in_bbox(lat, lon, bbox):
+    """Test whether a coordinate falls within a bounding box.
+
+    Parameters
+    ----------
+    lat : float
+        Latitude of the point.
+
+    lon : float
+        Longitude of the point.
+
+    bbox : tuple
+        Bounding box as (min_lat, min_lon, max_lat, max_lon).
+
+    Returns
+    -------
+    bool
+        True if the point is inside the bounding box, edges included.
+    """
+    min_lat, min_lon, max_lat, max_lon = bbox
+    return min_lat <= lat <= max_lat and min_lon <= lon <= max_lon
+
+
+def in_polygon(lat, lon, polygon):
+    """Test whether a coordinate falls within a polygon using ray casting.
+
+    Parameters
+    ----------
+    lat : float
+        Latitude of the point.
+
+    lon : float
+        Longitude of the point.
+
+    polygon : list
+        Vertices of the polygon as (lat, lon) tuples. The polygon is closed
+        implicitly.
+
+    Returns
+    -------
+    bool
+        True if the point is inside the polygon.
+    """
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lon_i = polygon[i]
+        lat_j, lon_j = polygon[j]
+        if (lat_i > lat) != (lat_j > lat):
+            crossing = (lon_j - lon_i) * (lat - lat_i) / (lat_j - lat_i) + lon_i
+            if lon < crossing:
+                inside = not inside
+        j = i
+    return inside
+
+
+def polygon_bbox(polygon):
+    """Compute the bounding box of a polygon.
+
+    Parameters
+    ----------
+    polygon : list
+        Vertices of the polygon as (lat, lon) tuples.
+
+    Returns
+    -------
+    tuple
+        Bounding box as (min_lat, min_lon, max_lat, max_lon).
+    """
+    lats = [lat for lat, _ in polygon]
+    lons = [lon for _, lon in polygon]
+    return (min(lats), min(lons), max(lats), max(lons))
+
+
+def make_region_test(bbox=None, polygon=None):
+    """Build a function that tests whether a coordinate is in the region.
+
+    Parameters
+    ----------
+    bbox : tuple
+        Bounding box as (min_lat, min_lon, max_lat, max_lon).
+
+    polygon : list
+        Vertices of a polygon as (lat, lon) tuples. Takes precedence over
+        bbox if both are given.
+
+    Returns
+    -------
+    function
+        A function of (lat, lon) that returns True inside the region.
+    """
+    if polygon:
+        outer = polygon_bbox(polygon)
+        return lambda lat, lon: in_bbox(lat, lon, outer) and \
+                                in_polygon(lat, lon, polygon)
+    if bbox:
+        return lambda lat, lon: in_bbox(lat, lon, bbox)
+    raise ValueError("Either a bounding box or a polygon is required.")
+
+
+def collect_region_nodes(osm_file, contains):
+    """Collect the ids of all nodes that fall within the region.
+
+    Parameters
+    ----------
+    osm_file : str
+        Path to the OSM file.
+
+    contains : function
+        Function of (lat, lon) that returns True inside the region.
+
+    Returns
+    -------
+    SortedIdArray
+        Ids of the nodes inside the region.
+    """
+    node_ids = SortedIdArray()
+    for element in get_element(osm_file, tags=('node',)):
+        if contains(float(element.get('lat')), float(element.get('lon'))):
+            node_ids.add(int(element.get('id')))
+    return node_ids
+
+
+def collect_region_ways(osm_file, node_ids):
+    """Collect the ways that touch the region and the nodes they reference.
+
+    Parameters
+    ----------
+    osm_file : str
+        Path to the OSM file.
+
+    node_ids : SortedIdArray
+        Ids of the nodes inside the region.
+
+    Returns
+    -------
+    tuple
+        A SortedIdArray of the ids of ways with at least one node inside the
+        region, and a SortedIdArray of the ids of nodes outside the region
+        that those ways reference.
+    """
+    way_ids = SortedIdArray()
+    extra_node_ids = SortedIdArray()
+    for element in get_element(osm_file, tags=('way',)):
+        refs = [int(nd.get('ref')) for nd in element.iter('nd')]
+        if any(ref in node_ids for ref in refs):
+            way_ids.add(int(element.get('id')))
+            for ref in refs:
+                if ref not in node_ids:
+                    extra_node_ids.add(ref)
+    return way_ids, extra_node_ids
+
+
+def collect_region_relations(osm_file, node_ids, way_ids):
+    """Collect the relations that have at least one member in the subset.
+
+    Parameters
+    ----------
+    osm_file : str
+        Path to the OSM file.
+
+    node_ids : function
+        Function of a node id that returns True if the node is in the subset.
+
+    way_ids : SortedIdArray
+        Ids of the ways in the subset.
+
+    Returns
+    -------
+    SortedIdArray
+        Ids of the relations to be kept.
+    """
+    relation_ids = SortedIdArray()
+    for element in get_element(osm_file, tags=('relation',)):
+        for member in element.iter('member'):
+            ref = int(member.get('ref'))
+            if (member.get('type') == 'node' and node_ids(ref)) or \
+               (member.get('type') == 'way' and ref in way_ids):
+                relation_ids.add(int(element.get('id')))
+                break
+    return relation_ids
+
+
+def write_region(osm_file, out_file, node_ids, way_ids, relation_ids,
+                 bbox=None):
+    """Write the elements of the subset to a new OSM file.
+
+    Parameters
+    ----------
+    osm_file : str
+        Path to the OSM file to be read.
+
+    out_file : str
+        Path to the OSM file to be written.
+
+    node_ids : function
+        Function of a node id that returns True if the node is in the subset.
+
+    way_ids : SortedIdArray
+        Ids of the ways in the subset.
+
+    relation_ids : SortedIdArray
+        Ids of the relations in the subset.
+
+    bbox : tuple
+        Bounding box written to the 'bounds' element of the output file.
+    """
+    members = {'node': node_ids,
+               'way': lambda ref: ref in way_ids,
+               'relation': lambda ref: ref in relation_ids}
+
+    with codecs.open(out_file, 'w') as fout:
+        fout.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        fout.write('<osm version="0.6" generator="extract_region.py">\n')
+        if bbox:
+            fout.write(' <bounds minlat=%s minlon=%s maxlat=%s maxlon=%s/>\n'
+                       % tuple(quoteattr(str(b)) for b in bbox))
+        for element in get_element(osm_file):
+            element_id = int(element.get('id'))
+            if element.tag == 'node':
+                keep = node_ids(element_id)
+            elif element.tag == 'way':
+                keep = element_id in way_ids
+            else:
+                keep = element_id in relation_ids
+                if keep:
+                    for member in element.findall('member'):
+                        if not members[member.get('type')](
+                                int(member.get('ref'))):
+                            element.remove(member)
+            if keep:
+                element.tail = None
+                fout.write('  ')
+                fout.write(ET.tostring(element, encoding='utf-8'))
+                fout.write('\n')
+        fout.write('</osm>\n')
+
+
+################################################################################
+#                                MAIN FUNCTION                                 #
+################################################################################
+
+def extract_region(osm_file=OSM_PATH, out_file=SAMPLE_PATH, bbox=None,
+                   polygon=None):
+    """Write a referentially complete subset of an OSM file for a region.
+
+    Parameters
+    ----------
+    osm_file : str
+        Path to the OSM file to be read.
+
+    out_file : str
+        Path to the OSM file to be written.
+
+    bbox : tuple
+        Bounding box as (min_lat, min_lon, max_lat, max_lon). Defaults to
+        the module level variable BBOX if no polygon is given.
+
+    polygon : list
+        Vertices of a polygon as (lat, lon) tuples.
+    """
+    if bbox is None and polygon is None:
+        bbox = BBOX
+    contains = make_region_test(bbox, polygon)
+
+    inside_ids = collect_region_nodes(osm_file, contains)
+    way_ids, extra_ids = collect_region_ways(osm_file, inside_ids)
+    node_ids = lambda ref: ref in inside_ids or ref in extra_ids
+    relation_ids = collect_region_relations(osm_file, node_ids, way_ids)
+
+    write_region(osm_file, out_file, node_ids, way_ids, relation_ids,
+                 bbox or polygon_bbox(polygon))
+
+
+if __name__ == '__main__':
+    extract_region()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Module id_sets.py provides a compact container for OpenStreetMaps element ids.
+A Python set of ints costs on the order of 70 bytes per id, which is prohibitive
+for extracts with hundreds of millions of nodes. The container below stores ids
+in a sorted array of machine integers (8 bytes per id) and answers membership
+queries with a binary search.
+
+Acknowledgments:
+[1] https://docs.python.org/2/library/array.html
+[2] https://docs.python.org/2/library/bisect.html
+"""
+
+from array import array
+from bisect import bisect_left
+
+
+ID_TYPECODE = 'l'
+"""str: Array typecode used to store ids (signed 64-bit on LP64 platforms)."""
+
+MIN_PENDING = 65536
+"""int: Minimum number of out-of-order ids buffered before a merge."""
+
+RUN_SIZE = 64
+"""int: Number of out-of-order ids collected unsorted before they are sorted
+into a run. Lookups scan them linearly, so this stays small."""
+
+
+def merge_sorted(ids, other):
+    """Merge two sorted arrays of distinct ids.
+
+    Parameters
+    ----------
+    ids : array.array
+        A sorted array.
+
+    other : array.array
+        A sorted array with no id in common with ids, ideally the shorter
+        one: it is walked id by id, while ids is copied in slices.
+
+    Returns
+    -------
+    array.array
+        The sorted ids of both arrays.
+    """
+    merged = array(ID_TYPECODE)
+    i = 0
+    for element_id in other:
+        j = bisect_left(ids, element_id, i)
+        merged.extend(ids[i:j])
+        merged.append(element_id)
+        i = j
+    merged.extend(ids[i:])
+    return merged
+
+
+class SortedIdArray(object):
+    """Set of integer ids stored in a sorted array.
+
+    OSM files list elements of each type in ascending id order, so ids added
+    while streaming through a file are usually appended directly to the end of
+    the array. Ids that arrive out of order are buffered and merged into the
+    array in batches, which keeps the amortized cost of an insertion low while
+    bounding the size of the buffer.
+
+    The buffer is made of arrays too: a short unsorted array of the latest
+    ids, and sorted runs of earlier ones. A full unsorted array is sorted
+    into a run, and runs of similar length are merged, so there are only
+    logarithmically many runs to search.
+    """
+
+    def __init__(self, ids=()):
+        self._ids = array(ID_TYPECODE)
+        self._recent = array(ID_TYPECODE)
+        self._runs = []
+        self._pending = 0
+        for element_id in ids:
+            self.add(element_id)
+
+    def add(self, element_id):
+        """Add an id to the set.
+
+        Parameters
+        ----------
+        element_id : int
+            The id to be added.
+
+        Returns
+        -------
+        bool
+            True if the id was not previously in the set; False otherwise.
+        """
+        ids = self._ids
+        # Buffered ids are below the last id of the array, so a larger id is
+        # always new
+        if not ids or element_id > ids[-1]:
+            ids.append(element_id)
+            return True
+        if element_id in self:
+            return False
+        self._recent.append(element_id)
+        self._pending += 1
+        if len(self._recent) >= RUN_SIZE:
+            self._push_run()
+        if self._pending > max(MIN_PENDING, len(ids) // 8):
+            self._merge()
+        return True
+
+    def __contains__(self, element_id):
+        for ids in [self._ids] + self._runs:
+            i = bisect_left(ids, element_id)
+            if i < len(ids) and ids[i] == element_id:
+                return True
+        return element_id in self._recent
+
+    def __len__(self):
+        return len(self._ids) + self._pending
+
+    def __iter__(self):
+        self._merge()
+        return iter(self._ids)
+
+    def _push_run(self):
+        """Sort the latest out-of-order ids into a run, merging it with the
+        runs that are not longer than it."""
+        run = array(ID_TYPECODE, sorted(self._recent))
+        self._recent = array(ID_TYPECODE)
+        runs = self._runs
+        while runs and len(runs[-1]) <= len(run):
+            run = merge_sorted(runs.pop(), run)
+        runs.append(run)
+
+    def _merge(self):
+        """Merge the buffer of out-of-order ids into the sorted array."""
+        if not self._pending:
+            return
+        if self._recent:
+            self._push_run()
+        # The runs are longest first
+        pending = self._runs.pop()
+        while self._runs:
+            pending = merge_sorted(self._runs.pop(), pending)
+        self._pending = 0
+        self._ids = merge_sorted(self._ids, pending)
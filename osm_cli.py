@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Script osm_cli.py is a single command-line entry point for the toolkit:
+
+    python osm_cli.py audit Rochester.osm --snapshot audit.json.gz
+    python osm_cli.py audit-changes daily.osc --baseline audit.json.gz
+    python osm_cli.py convert Rochester.osm --validate
+    python osm_cli.py load --db mydb.db
+    python osm_cli.py query --report stats
+    python osm_cli.py bench --baseline bench_baseline.json
+
+Each subcommand imports the modules it needs only when it runs, so that
+starting the tool does not pay for libraries used by other subcommands (e.g.
+matplotlib for the query plots, or cerberus for validation).
+
+Acknowledgments:
+[1] https://docs.python.org/2/library/argparse.html
+"""
+
+import argparse
+import os
+import sys
+
+
+################################################################################
+#                              HELPER FUNCTIONS                                #
+################################################################################
+
+def run_audit(args):
+    """Audit one or more OSM files."""
+    from audit_tags import audit_osm_file, audit_osm_files
+
+    if (len(args.osm_files) == 1 and args.processes is None
+            and args.shards is None):
+        audit_osm_file(args.osm_files[0], args.sample_every,
+                       args.sample_fraction, args.approximate, args.snapshot,
+                       args.baseline)
+    else:
+        audit_osm_files(args.osm_files, args.processes, args.shards,
+                        args.sample_every, args.sample_fraction,
+                        args.approximate, args.snapshot, args.baseline)
+
+
+def run_audit_changes(args):
+    """Audit the elements of an osmChange file against a baseline."""
+    from audit_tags import audit_changes
+
+    audit_changes(args.osc_file, args.baseline)
+
+
+def run_convert(args):
+    """Convert an OSM file to csv files."""
+    from osm_to_csv import RULES_PATHS, process_map
+
+    process_map(args.osm_file, args.validate,
+                sample_every=args.sample_every,
+                sample_fraction=args.sample_fraction,
+                rules_paths=RULES_PATHS + tuple(args.rules),
+                batch_size=args.batch_size or None,
+                checkpoint_every=args.checkpoint_every, resume=args.resume,
+                pivot=args.pivot, check_integrity=args.check_integrity,
+                output_dir=args.output_dir, threaded=args.threaded,
+                sort=args.sort,
+                memory_budget=args.memory_budget * 1024 * 1024,
+                canonical=args.canonical)
+
+
+def run_load(args):
+    """Load csv files into the database."""
+    import csv_to_database as loader
+
+    def path(name):
+        return os.path.join(args.csv_dir, name)
+
+    pivot = {}
+    if args.pivot:
+        pivot = {'node_attrs': path(loader.NODE_ATTRS),
+                 'way_attrs': path(loader.WAY_ATTRS)}
+    loader.convert_csv_to_database(args.db, nodes=path(loader.NODES),
+                                   nodes_tags=path(loader.NODES_TAGS),
+                                   ways=path(loader.WAYS),
+                                   ways_nodes=path(loader.WAYS_NODES),
+                                   ways_tags=path(loader.WAYS_TAGS),
+                                   check_tables=args.check_tables,
+                                   encoded=args.encoded,
+                                   activity=not args.no_activity,
+                                   indexes=not args.no_indexes,
+                                   clustered=args.clustered, **pivot)
+
+
+def run_query(args):
+    """Run the reports of sql_queries.py."""
+    import sql_queries
+
+    cache = None if args.no_cache else sql_queries.CACHE
+    if args.report == 'all':
+        sql_queries.run_all_queries(args.db, cache)
+    elif args.report == 'stats':
+        sql_queries.db_statistics(args.db, cache)
+    elif args.report == 'large-ways':
+        sql_queries.describe_large_ways(args.db, cache)
+    elif args.report == 'distribution':
+        sql_queries.distribution_way_nodes(args.db, cache)
+
+
+def run_bench(args):
+    """Benchmark the reports of sql_queries.py against a stored baseline."""
+    from bench_queries import bench_queries
+
+    failures = bench_queries(args.baseline, args.nodes, args.seed, args.repeat,
+                             args.encoded, args.tolerance, args.update_baseline,
+                             args.work_dir)
+    if failures:
+        sys.exit(1)
+
+
+def build_parser():
+    """Build the command-line parser.
+
+    Returns
+    -------
+    argparse.ArgumentParser
+        The parser, with one subparser per subcommand.
+    """
+    parser = argparse.ArgumentParser(
+        description='Audit, clean, load and query OpenStreetMap extracts.')
+    subparsers = parser.add_subparsers(title='subcommands')
+
+    def add_sampling(subparser):
+        subparser.add_argument('--sample-every', type=int, metavar='K',
+                               help='process every Kth element only')
+        subparser.add_argument('--sample-fraction', type=float, metavar='F',
+                               help='process a hashed fraction F of the '
+                                    'elements only')
+
+    audit = subparsers.add_parser('audit', help='audit the tags of OSM files')
+    audit.add_argument('osm_files', nargs='+', metavar='osm_file')
+    audit.add_argument('--processes', type=int,
+                       help='audit in parallel with this many processes')
+    audit.add_argument('--shards', type=int,
+                       help='audit in parallel, splitting each file into '
+                            'this many byte ranges')
+    audit.add_argument('--approximate', action='store_true',
+                       help='count with bounded-memory sketches')
+    audit.add_argument('--snapshot', metavar='PATH',
+                       help='save the counts to a snapshot file')
+    audit.add_argument('--baseline', metavar='PATH',
+                       help='print only the differences from this snapshot')
+    add_sampling(audit)
+    audit.set_defaults(run=run_audit)
+
+    audit_changes = subparsers.add_parser(
+        'audit-changes',
+        help='audit the elements of an osmChange file against a snapshot')
+    audit_changes.add_argument('osc_file')
+    audit_changes.add_argument('--baseline', metavar='PATH', required=True,
+                               help='snapshot of an audit of the extract')
+    audit_changes.set_defaults(run=run_audit_changes)
+
+    convert = subparsers.add_parser('convert',
+                                    help='clean an OSM file into csv files')
+    convert.add_argument('osm_file')
+    convert.add_argument('--validate', action='store_true',
+                         help='validate the elements against the schema')
+    convert.add_argument('--rules', action='append', default=[],
+                         metavar='PATH',
+                         help='additional cleaning rules file (repeatable)')
+    convert.add_argument('--batch-size', type=int, default=10000,
+                         help='elements cleaned together; 0 to clean one by '
+                              'one')
+    convert.add_argument('--checkpoint-every', type=int, metavar='N',
+                         help='record progress every N elements')
+    convert.add_argument('--resume', action='store_true',
+                         help='resume from the last checkpoint (requires '
+                              '--checkpoint-every)')
+    convert.add_argument('--pivot', action='store_true',
+                         help='also write the wide-format attrs tables')
+    convert.add_argument('--check-integrity', choices=('report', 'drop'),
+                         help='check referential integrity')
+    convert.add_argument('--output-dir', help='directory for the csv files')
+    convert.add_argument('--threaded', action='store_true',
+                         help='parse and write in background threads')
+    convert.add_argument('--canonical', action='store_true',
+                         help='correct rare misspellings of city and street '
+                              'names learned from the file')
+    convert.add_argument('--sort', action='store_true',
+                         help='sort the csv files by id (way nodes by node id)')
+    convert.add_argument('--memory-budget', type=int, default=64, metavar='MB',
+                         help='memory used for sorting before spilling runs '
+                              'to disk')
+    add_sampling(convert)
+    convert.set_defaults(run=run_convert)
+
+    load = subparsers.add_parser('load',
+                                 help='load csv files into the database')
+    load.add_argument('--db', default='mydb.db')
+    load.add_argument('--csv-dir', default='.',
+                      help='directory holding the csv files')
+    load.add_argument('--encoded', action='store_true',
+                      help='dictionary-encode users, tag keys and types')
+    load.add_argument('--pivot', action='store_true',
+                      help='load the wide-format attrs tables')
+    load.add_argument('--no-activity', action='store_true',
+                      help='skip the activity rollups')
+    load.add_argument('--no-indexes', action='store_true',
+                      help='skip the export and filter indexes')
+    load.add_argument('--clustered', action='store_true',
+                      help='store way nodes in a table clustered by node id')
+    load.add_argument('--check-tables', action='store_true',
+                      help='print the first rows of each table')
+    load.set_defaults(run=run_load)
+
+    query = subparsers.add_parser('query', help='report on the database')
+    query.add_argument('--db', default='mydb.db')
+    query.add_argument('--report', default='all',
+                       choices=('all', 'stats', 'large-ways', 'distribution'))
+    query.add_argument('--no-cache', action='store_true',
+                       help='always run the queries')
+    query.set_defaults(run=run_query)
+
+    bench = subparsers.add_parser(
+        'bench', help='benchmark the database reports on synthetic data')
+    bench.add_argument('--baseline', default='bench_baseline.json')
+    bench.add_argument('--update-baseline', action='store_true')
+    bench.add_argument('--nodes', type=int, default=50000)
+    bench.add_argument('--seed', type=int, default=0)
+    bench.add_argument('--repeat', type=int, default=10)
+    bench.add_argument('--encoded', action='store_true')
+    bench.add_argument('--tolerance', type=float, default=2.0)
+    bench.add_argument('--work-dir', default=None,
+                       help='keep the synthetic csv files and database here')
+    bench.set_defaults(run=run_bench)
+
+    return parser
+
+
+################################################################################
+#                                MAIN FUNCTION                                 #
+################################################################################
+
+def main(argv=None):
+    """Parse the command line and run the chosen subcommand.
+
+    Parameters
+    ----------
+    argv : list
+        Command-line arguments, without the program name. Defaults to
+        sys.argv[1:].
+    """
+    args = build_parser().parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
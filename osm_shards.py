@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Module osm_shards.py splits an OpenStreetMaps XML file into byte ranges that
+can be parsed independently, e.g. by separate worker processes. Each range
+starts at the beginning of a top-level element (node, way, or relation), so a
+range can be parsed by wrapping it in an artificial root element.
+
+The split relies on the layout written by the usual OSM tools (osmosis, osmium,
+JOSM, the planet dumps): every top-level element starts on a new line. Only
+the first element is searched for anywhere, since it may share a line with the
+root element.
+
+Acknowledgments:
+[1] https://wiki.openstreetmap.org/wiki/OSM_XML
+"""
+
+from collections import deque
+import os
+import re
+import xml.etree.cElementTree as ET
+
+
+ELEMENT_STARTS = ('<node', '<way', '<relation', '</osm')
+"""tuple: Line prefixes that mark the boundary between top-level elements."""
+
+FIRST_ELEMENT = re.compile(r'<(?:node|way|relation)\b|</osm\b')
+"""re.RegexObject: Regular expression for the start of the first top-level
+element, or the end of the root element if there is none."""
+
+ELEMENT_ID = re.compile(
+    r'<(node|way|relation)\b[^>]*?\bid\s*=\s*[\'"](-?\d+)[\'"]')
+"""re.RegexObject: Regular expression to extract the type and id of an element
+from its start tag, with either kind of quotes."""
+
+BLOCK_SIZE = 64 * 1024
+"""int: Number of bytes read at a time when searching a file."""
+
+
+def find_first_element(osm_file):
+    """Find the first top-level element of an OSM file.
+
+    Parameters
+    ----------
+    osm_file : file
+        An OSM file opened in binary mode.
+
+    Returns
+    -------
+    int
+        Byte offset of the start tag of the first node, way, or relation, or
+        of the closing tag of the root element if there is none. The size of
+        the file if neither exists.
+    """
+    osm_file.seek(0)
+    position = 0
+    tail = ''
+    while True:
+        block = osm_file.read(BLOCK_SIZE)
+        if not block:
+            return position + len(tail)
+        data = tail + block
+        match = FIRST_ELEMENT.search(data)
+        if match:
+            return position + match.start()
+        # Keep enough of the end to match a tag split between blocks
+        tail = data[-16:]
+        position += len(data) - len(tail)
+
+
+def find_element_start(osm_file, offset):
+    """Find the first element boundary at or after a byte offset.
+
+    Parameters
+    ----------
+    osm_file : file
+        An OSM file opened in binary mode.
+
+    offset : int
+        Byte offset at which to start looking.
+
+    Returns
+    -------
+    int
+        Byte offset of the first line at or after offset that starts a node,
+        way, or relation, or closes the file's root element. The size of the
+        file if no such line exists.
+    """
+    if offset > 0:
+        # Step back one byte so that a line starting exactly at offset is not
+        # skipped as the tail of the previous line
+        osm_file.seek(offset - 1)
+        osm_file.readline()
+    else:
+        osm_file.seek(0)
+    while True:
+        position = osm_file.tell()
+        line = osm_file.readline()
+        if not line or line.lstrip().startswith(ELEMENT_STARTS):
+            return position
+
+
+def find_root_end(osm_file):
+    """Find the closing tag of the root element of an OSM file.
+
+    Parameters
+    ----------
+    osm_file : file
+        An OSM file opened in binary mode.
+
+    Returns
+    -------
+    int
+        Byte offset of the closing '</osm>' tag, or the size of the file if
+        the tag is missing.
+    """
+    osm_file.seek(0, os.SEEK_END)
+    size = osm_file.tell()
+    tail_start = max(0, size - 4096)
+    osm_file.seek(tail_start)
+    index = osm_file.read().rfind('</osm')
+    if index < 0:
+        return size
+    return tail_start + index
+
+
+def shard_offsets(filename, shards):
+    """Split an OSM file into byte ranges that start at element boundaries.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the OSM file.
+
+    shards : int
+        Number of ranges to split the file into. Fewer ranges are returned if
+        the file has fewer elements.
+
+    Returns
+    -------
+    list
+        A list of (start, end) byte offset tuples covering every top-level
+        element of the file exactly once. A single range if no element starts
+        a line, e.g. in a file without line breaks; empty if the file has no
+        elements.
+    """
+    with open(filename, 'rb') as osm_file:
+        root_end = find_root_end(osm_file)
+        # The first element may share a line with the root element
+        first = min(find_first_element(osm_file), root_end)
+        boundaries = [find_element_start(osm_file, root_end * i // shards)
+                      for i in range(1, shards)]
+    boundaries = sorted(set(min(max(b, first), root_end)
+                            for b in [first] + boundaries + [root_end]))
+    return zip(boundaries[:-1], boundaries[1:])
+
+
+class ShardReader(object):
+    """Read-only file-like view of a byte range of an OSM file, wrapped in an
+    artificial root element so that it can be passed to iterparse.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the OSM file.
+
+    start : int
+        Byte offset of the first element in the range.
+
+    end : int
+        Byte offset just past the range. Reads to the end of the file's root
+        element if None.
+
+    track_offsets : bool
+        True to record the byte offset of each element as it is read, for
+        offset_of. Each block read is then searched for start tags, which is
+        slower.
+    """
+
+    PREFIX = '<osm>'
+    SUFFIX = '</osm>'
+
+    def __init__(self, filename, start, end=None, track_offsets=False):
+        self._file = open(filename, 'rb')
+        if end is None:
+            end = find_root_end(self._file)
+        self._file.seek(start)
+        self._remaining = end - start
+        self._pending = [self.PREFIX]
+        self._done = False
+        self._offsets = deque() if track_offsets else None
+        self._tail = ''
+
+    def _read_range(self, size):
+        """Read up to size bytes from the range, recording the offsets of the
+        element start tags if tracking is enabled."""
+        if self._offsets is None:
+            return self._file.read(min(size, self._remaining))
+        position = self._file.tell()
+        block = self._file.read(min(size, self._remaining))
+        # A start tag cut off at the end of the previous block is searched
+        # again together with this one
+        data = self._tail + block
+        base = position - len(self._tail)
+        end = 0
+        for match in ELEMENT_ID.finditer(data):
+            self._offsets.append((match.group(1), match.group(2),
+                                  base + match.start()))
+            end = match.end()
+        cut = data.rfind('<', end)
+        if cut >= 0 and data.find('>', cut) < 0:
+            self._tail = data[cut:]
+        else:
+            self._tail = ''
+        return block
+
+    def offset_of(self, tag, element_id):
+        """Return the byte offset at which an element starts.
+
+        Offsets of the elements read before it are discarded, so elements
+        must be looked up in file order.
+
+        Parameters
+        ----------
+        tag : str
+            The element type ('node', 'way' or 'relation').
+
+        element_id : str
+            The id of the element, as it appears in the file.
+
+        Returns
+        -------
+        int
+            The byte offset of the element's start tag.
+
+        Raises
+        ------
+        KeyError
+            If the element has not been read, or offsets are not tracked.
+        """
+        offsets = self._offsets
+        while offsets:
+            offset_tag, offset_id, position = offsets.popleft()
+            if offset_tag == tag and offset_id == element_id:
+                return position
+        raise KeyError((tag, element_id))
+
+    def read(self, size=-1):
+        """Read up to size bytes of the wrapped range.
+
+        Parameters
+        ----------
+        size : int
+            Maximum number of bytes to return; all remaining bytes if negative.
+
+        Returns
+        -------
+        str
+            The bytes read; an empty string at the end of the range.
+        """
+        if size < 0:
+            size = self._remaining + len(self.PREFIX) + len(self.SUFFIX)
+        chunks = []
+        while size > 0:
+            if self._pending:
+                chunk = self._pending.pop()
+            elif self._remaining > 0:
+                chunk = self._read_range(size)
+                self._remaining -= len(chunk)
+                if not chunk:
+                    self._remaining = 0
+            elif not self._done:
+                chunk = self.SUFFIX
+                self._done = True
+            else:
+                break
+            if len(chunk) > size:
+                self._pending.append(chunk[size:])
+                chunk = chunk[:size]
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def close(self):
+        """Close the underlying file."""
+        self._file.close()
+
+
+def iter_reader_elements(reader, tags=('node', 'way', 'relation')):
+    """Yield the elements read through a ShardReader.
+
+    Parameters
+    ----------
+    reader : ShardReader
+        The byte range to be parsed. The reader is closed when the generator
+        finishes.
+
+    tags : tuple
+        Tuple of strings that indicate which elements to extract.
+
+    Yields
+    ------
+    xml.etree.cElementTree.Element
+        An element in the range that belongs to a type identified in the
+        parameter 'tags'.
+    """
+    try:
+        context = ET.iterparse(reader, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag in tags:
+                yield elem
+                root.clear()
+    finally:
+        reader.close()
+
+
+def iter_shard_elements(filename, start, end=None,
+                        tags=('node', 'way', 'relation')):
+    """Yield the elements of a byte range of an OSM file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the OSM file.
+
+    start : int
+        Byte offset of the first element in the range.
+
+    end : int
+        Byte offset just past the range, or None to read to the end of the
+        file.
+
+    tags : tuple
+        Tuple of strings that indicate which elements to extract.
+
+    Yields
+    ------
+    xml.etree.cElementTree.Element
+        An element in the range that belongs to a type identified in the
+        parameter 'tags'.
+    """
+    return iter_reader_elements(ShardReader(filename, start, end), tags)
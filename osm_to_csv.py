@@ -14,14 +14,25 @@ Acknowledgments:
     316820862075461/lessons/5436095827/concepts/54908788190923#
 """
 
-import cerberus
 import codecs
+from collections import defaultdict
 import csv
+import json
+import os
 import pprint
 import re
 import schema
 import xml.etree.cElementTree as ET
 
+from canonical_names import CanonicalIndex
+from cleaning_rules import RULES_PATH, RuleTable, load_rules
+from external_sort import MEMORY_BUDGET, sort_outputs
+from integrity import IntegrityChecker
+from osm_shards import ShardReader, find_first_element, iter_reader_elements
+from pipeline import BackgroundWriter, iter_read_ahead
+from sampling import ElementSampler
+from street_trie import get_trie
+
 
 OSM_PATH = "Rochester.osm"
 """str: Path to OpenStreetMaps XML file to be analyzed."""
@@ -66,6 +77,65 @@ WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
 """list: Fields for way's node entries."""
 
+OUTPUTS = (('nodes', NODES_PATH, NODE_FIELDS),
+           ('node_tags', NODE_TAGS_PATH, NODE_TAGS_FIELDS),
+           ('ways', WAYS_PATH, WAY_FIELDS),
+           ('way_nodes', WAY_NODES_PATH, WAY_NODES_FIELDS),
+           ('way_tags', WAY_TAGS_PATH, WAY_TAGS_FIELDS))
+"""tuple: Name, file name, and fields of each csv output."""
+
+NODE_ATTRS_PATH = "node_attrs.csv"
+"""str: Path to output csv file for the wide-format 'node_attrs' table."""
+
+WAY_ATTRS_PATH = "way_attrs.csv"
+"""str: Path to output csv file for the wide-format 'way_attrs' table."""
+
+HOT_KEYS = (('name', 'regular', 'name'),
+            ('amenity', 'regular', 'amenity'),
+            ('street', 'addr', 'street'),
+            ('city', 'addr', 'city'),
+            ('postcode', 'addr', 'postcode'),
+            ('phone', 'regular', 'phone'))
+"""tuple: (column, type, key) of each tag pivoted into its own column of the
+wide-format tables. A column holds the cleaned value of the tag."""
+
+NODE_ATTRS_FIELDS = ['id', 'lat', 'lon'] + [c for c, _, _ in HOT_KEYS]
+"""list: Fields of the wide-format 'node_attrs' table."""
+
+WAY_ATTRS_FIELDS = ['id'] + [c for c, _, _ in HOT_KEYS]
+"""list: Fields of the wide-format 'way_attrs' table."""
+
+ATTRS_OUTPUTS = (('node_attrs', NODE_ATTRS_PATH, NODE_ATTRS_FIELDS),
+                 ('way_attrs', WAY_ATTRS_PATH, WAY_ATTRS_FIELDS))
+"""tuple: (name, path, fields) of each output written if pivot tables are
+requested."""
+
+CHECKPOINT_PATH = "process_map.checkpoint"
+"""str: File name for the progress record of a checkpointed conversion."""
+
+RULES_PATHS = (RULES_PATH,)
+"""tuple: Paths to the cleaning rules files, applied in order."""
+
+BATCH_SIZE = 10000
+"""int: Number of elements whose tags are cleaned together by process_map."""
+
+# Look for zipcodes that have the format '12345', with optional trailing
+# four digits '-6789'
+ZIP_FORMAT = re.compile(r"(^[0-9]{5})(-[0-9]{4})?")
+"""re.RegexObject: Regular expression to identify valid zip codes."""
+
+ZIP_FORMAT_LINES = re.compile(r"^[0-9]{5}", re.MULTILINE)
+"""re.RegexObject: ZIP_FORMAT applied to each line of a newline-joined batch."""
+
+# Find clusters of digits between 3 and 10 numbers in length
+PHONE_DIGITS = re.compile(r'[0-9]{3,10}')
+"""re.RegexObject: Regular expression to identify digit clusters in phone
+numbers."""
+
+PHONE_DIGITS_LINES = re.compile(r'[0-9]{3,10}|\n')
+"""re.RegexObject: PHONE_DIGITS plus the line breaks of a newline-joined
+batch."""
+
 
 ################################################################################
 #                              HELPER FUNCTIONS                                #
@@ -90,13 +160,18 @@ def fix_prob_chars(key, problem_chars=PROBLEMCHARS):
     return new_key
             
 
-def fix_street_abbrevs(street):
+def fix_street_abbrevs(street, mapping=None):
     """Expand abbreviations in street names.
     
     Parameters
     ----------
     street : str
         The name of a street to be cleaned.
+
+    mapping : dict
+        Abbreviations (single words or multi-word phrases) and their full
+        forms. Defaults to the 'street_types' mapping of the default cleaning
+        rules.
         
     Returns
     -------
@@ -104,36 +179,12 @@ def fix_street_abbrevs(street):
         The cleaned street name, with abbreviations replaced with their full
         form.
     """
-    mapping = {
-        'ave': 'Avenue',
-        'Ave': 'Avenue',
-        'Avenu': 'Avenue',
-        'Bl': 'Boulevard',
-        'Blvd': 'Boulevard',
-        'Cir': 'Circle',
-        'Ct': 'Court',
-        'Dr': 'Drive',
-        'line': 'Line',
-        'Pkwy': 'Parkway',
-        'PW': 'Parkway',
-        'Rd': 'Road',
-        'St': 'Street',
-        'Stree': 'Street',
-        'N': 'North',
-        'S': 'South',
-        'E': 'East',
-        'W': 'West'
-    }
-    
-    elements = street.split()
-    for i in range(len(elements)):
-        if elements[i] in mapping:
-            elements[i] = mapping[elements[i]]
-    updated_street = ' '.join(elements)
-    return updated_street
+    if mapping is None:
+        mapping = get_rule_table().mappings['street_types']
+    return get_trie(mapping).expand(street)
 
 
-def fix_cities(city):
+def fix_cities(city, mapping=None):
     """Fix erroneous cities in the OSM file. Specifically, make sure that cities
     are capitalized and valid.
     
@@ -141,18 +192,18 @@ def fix_cities(city):
     ----------
     city : str
         The name of a city.
+
+    mapping : dict
+        Erroneous city names and their corrections. Defaults to the 'cities'
+        mapping of the default cleaning rules.
         
     Returns
     -------
     str
         A clean version of the original city value.  
     """
-    mapping = {
-        'East Rochester Town': 'East Rochester',
-        'Rochester, Ny': 'Rochester',
-        'Rochestet': 'Rochester',
-        'W Commercial St': 'East Rochester'
-    }
+    if mapping is None:
+        mapping = get_rule_table().mappings['cities']
     
     city = city.title()
     if city in mapping:
@@ -175,31 +226,25 @@ def fix_zipcode(zipcode):
         The unchanged zipcode, if formatted correctly. The label 'fixme' if 
         erroneous.
     """
-    # Look for zipcodes that have the format '12345', with optional trailing
-    # four digits '-6789'
-    zipformat = re.compile(r"(^[0-9]{5})(-[0-9]{4})?")
-    if zipformat.search(zipcode):
+    if ZIP_FORMAT.search(zipcode):
         return zipcode
     else:
         return 'fixme'
 
 
-def fix_phone_numbers(phone_number):
-    """Change all phone numbers to format '123-456-7890'.
+def format_phone_number(digits):
+    """Format the digit clusters found in a phone number as '123-456-7890'.
     
     Parameters
     ----------
-    phone_number : str
-        A phone number extracted from the OSM file.
+    digits : list
+        Clusters of 3 to 10 digits, in order of appearance.
         
     Returns
     -------
     str
-        The phone number in format '123-456-7890'. Country code omitted.        
+        The phone number in format '123-456-7890'. Country code omitted.
     """
-    # Find clusters of digits between 3 and 10 numbers in length
-    number_re = re.compile(r'[0-9]{3,10}')
-    digits = number_re.findall(phone_number)
     # If more than 3 clusters are present, then omit the first cluster, the 
     # country code (note: the initial audit showed that no extensions were 
     # present)
@@ -209,9 +254,205 @@ def fix_phone_numbers(phone_number):
     digits = ''.join(digits)
     new_phone_number = '-'.join([digits[0:3], digits[3:6], digits[6:10]])
     return new_phone_number
+
+
+def fix_phone_numbers(phone_number):
+    """Change all phone numbers to format '123-456-7890'.
+    
+    Parameters
+    ----------
+    phone_number : str
+        A phone number extracted from the OSM file.
+        
+    Returns
+    -------
+    str
+        The phone number in format '123-456-7890'. Country code omitted.        
+    """
+    return format_phone_number(PHONE_DIGITS.findall(phone_number))
+
+
+def distinct_values(values):
+    """List the distinct values of a batch, dropping those with line breaks.
+    
+    Parameters
+    ----------
+    values : list
+        Tag values to be cleaned.
+        
+    Returns
+    -------
+    tuple
+        A list of the distinct values without line breaks, in order of first
+        appearance, and a list of the distinct values with line breaks.
+    """
+    seen = set()
+    plain = []
+    multiline = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            if '\n' in value:
+                multiline.append(value)
+            else:
+                plain.append(value)
+    return plain, multiline
+
+
+def fix_zipcode_batch(zipcodes, mapping=None):
+    """Apply fix_zipcode to a batch of values with a single regex pass.
+    
+    Parameters
+    ----------
+    zipcodes : list
+        The zipcodes to be cleaned.
+
+    mapping : None
+        Unused; accepted for a uniform batch cleaner signature.
+        
+    Returns
+    -------
+    list
+        The cleaned zipcodes, in the same order.
+    """
+    plain, multiline = distinct_values(zipcodes)
+    # Offset of the start of each value in the joined batch
+    starts = {}
+    offset = 0
+    for value in plain:
+        starts[offset] = value
+        offset += len(value) + 1
+    valid = set(starts[m.start()] for m in
+                ZIP_FORMAT_LINES.finditer('\n'.join(plain)))
+    valid.update(value for value in multiline if ZIP_FORMAT.search(value))
+    return [zipcode if zipcode in valid else 'fixme' for zipcode in zipcodes]
+
+
+def fix_phone_numbers_batch(phone_numbers, mapping=None):
+    """Apply fix_phone_numbers to a batch of values with a single regex pass.
+    
+    Parameters
+    ----------
+    phone_numbers : list
+        Phone numbers extracted from the OSM file.
+
+    mapping : None
+        Unused; accepted for a uniform batch cleaner signature.
+        
+    Returns
+    -------
+    list
+        The phone numbers in format '123-456-7890', in the same order.
+    """
+    plain, multiline = distinct_values(phone_numbers)
+    clusters = [[] for _ in plain]
+    line = 0
+    for match in PHONE_DIGITS_LINES.finditer('\n'.join(plain)):
+        if match.group() == '\n':
+            line += 1
+        else:
+            clusters[line].append(match.group())
+    fixed = dict((value, format_phone_number(digits))
+                 for value, digits in zip(plain, clusters))
+    fixed.update((value, fix_phone_numbers(value)) for value in multiline)
+    return [fixed[phone_number] for phone_number in phone_numbers]
+
+
+def fix_cities_batch(cities, mapping=None):
+    """Apply fix_cities to a batch of values, cleaning each distinct value once.
+    
+    Parameters
+    ----------
+    cities : list
+        City names to be cleaned.
+
+    mapping : dict
+        Erroneous city names and their corrections.
+        
+    Returns
+    -------
+    list
+        The cleaned city names, in the same order.
+    """
+    fixed = {}
+    for city in cities:
+        if city not in fixed:
+            fixed[city] = fix_cities(city, mapping)
+    return [fixed[city] for city in cities]
+
+
+def fix_street_abbrevs_batch(streets, mapping=None):
+    """Apply fix_street_abbrevs to a batch of values.
     
+    Parameters
+    ----------
+    streets : list
+        Street names to be cleaned.
 
-def clean_tags(tags, problem_chars=PROBLEMCHARS):
+    mapping : dict
+        Abbreviations and their full forms.
+        
+    Returns
+    -------
+    list
+        The cleaned street names, in the same order.
+    """
+    if mapping is None:
+        mapping = get_rule_table().mappings['street_types']
+    return get_trie(mapping).expand_all(streets)
+    
+
+CLEANERS = {
+    'fix_street_abbrevs': fix_street_abbrevs,
+    'fix_cities': fix_cities,
+    'fix_zipcode': fix_zipcode,
+    'fix_phone_numbers': fix_phone_numbers
+}
+"""dict: Cleaner functions that can be named in the cleaning rules."""
+
+BATCH_CLEANERS = {
+    'fix_street_abbrevs': fix_street_abbrevs_batch,
+    'fix_cities': fix_cities_batch,
+    'fix_zipcode': fix_zipcode_batch,
+    'fix_phone_numbers': fix_phone_numbers_batch
+}
+"""dict: Batch versions of the cleaner functions, by cleaner name. Cleaners
+without a batch version are applied value by value."""
+
+CANONICAL_CLEANERS = ('fix_cities', 'fix_street_abbrevs')
+"""tuple: Cleaners whose output can be mapped to canonical forms learned from
+the data, see build_canonical_indexes."""
+
+_RULE_TABLES = {}
+
+
+def get_rule_table(paths=RULES_PATHS, problem_chars=PROBLEMCHARS):
+    """Load and compile the cleaning rules, reusing earlier compilations.
+    
+    Parameters
+    ----------
+    paths : tuple
+        Paths to the cleaning rules files. Defaults to the module level
+        variable RULES_PATHS.
+        
+    problem_chars : re.RegexObject
+        Regular expression to identify problematic characters in keys.
+        
+    Returns
+    -------
+    cleaning_rules.RuleTable
+        The compiled rules.
+    """
+    cache_key = (tuple(paths), problem_chars.pattern)
+    if cache_key not in _RULE_TABLES:
+        key_fixer = lambda key: fix_prob_chars(key, problem_chars) \
+            if problem_chars.search(key) else key
+        _RULE_TABLES[cache_key] = RuleTable(load_rules(paths), CLEANERS,
+                                            key_fixer)
+    return _RULE_TABLES[cache_key]
+    
+
+def clean_tags(tags, problem_chars=PROBLEMCHARS, rules=None, canonical=None):
     """Clean tags from the OSM file.
     
     Parameters
@@ -221,37 +462,102 @@ def clean_tags(tags, problem_chars=PROBLEMCHARS):
         
     problem_chars : re.RegexObject
         Regular expression to identify problematic characters.
+
+    rules : cleaning_rules.RuleTable
+        Compiled cleaning rules. Defaults to the rules in the module level
+        variable RULES_PATHS.
+
+    canonical : dict
+        canonical_names.CanonicalIndex by cleaner name, as returned by
+        build_canonical_indexes. The output of these cleaners is replaced by
+        its canonical form. No replacement if None.
+
+    Returns
+    -------
+    list
+        A cleaned version of the input tag attribute list.
+    """
+    if rules is None:
+        rules = get_rule_table(problem_chars=problem_chars)
+    for tag in tags:
+        # Eliminate problematic characters in keys and look up the cleaners
+        # that apply to the tag
+        tag['key'], actions = rules.lookup(tag['type'], tag['key'])
+        for action in actions:
+            tag['value'] = action.apply(tag['value'])
+            if canonical and action.name in canonical:
+                tag['value'] = canonical[action.name].canonical(tag['value'])
+    return tags
+
+
+def clean_tags_batch(tags, problem_chars=PROBLEMCHARS, rules=None,
+                     canonical=None):
+    """Clean the tags of many elements at once.
+
+    Produces the same result as clean_tags, but the values handled by each
+    cleaner are collected into a column and cleaned with one call to the
+    cleaner's batch version.
+    
+    Parameters
+    ----------
+    tags : list
+        A list of tag attributes to be cleaned, e.g. all the tags of a chunk of
+        elements.
         
+    problem_chars : re.RegexObject
+        Regular expression to identify problematic characters.
+
+    rules : cleaning_rules.RuleTable
+        Compiled cleaning rules. Defaults to the rules in the module level
+        variable RULES_PATHS.
+
+    canonical : dict
+        canonical_names.CanonicalIndex by cleaner name, as in clean_tags.
+
     Returns
     -------
     list
         A cleaned version of the input tag attribute list.
-    """   
+    """
+    if rules is None:
+        rules = get_rule_table(problem_chars=problem_chars)
+    pending = []
     for tag in tags:
-        # Eliminate problematic characters in keys
-        if problem_chars.search(tag['key']):
-            tag['key'] = fix_prob_chars(tag['key'])
-        # Expand abbreviations in address fields
-        if (tag['key'] == 'address') or \
-           (tag['key'] == 'street' and 'street' in tag['type']):
-            tag['value'] = fix_street_abbrevs(tag['value'])
-        # Fix erroneous city values
-        if tag['key'] in ('city', 'city_1'):
-            tag['value'] = fix_cities(tag['value'])
-        # Replace invalid zipcodes with 'fixme'
-        if (tag['key'] in ('zip_left', 'zip_right')) or \
-           (tag['key'] == 'addr' and tag['type'] == 'postcode'):
-            tag['value'] = fix_zipcode(tag['value'])   
-        # Reformat phone numbers
-        if tag['key'] == 'phone':
-            tag['value'] = fix_phone_numbers(tag['value'])
+        tag['key'], actions = rules.lookup(tag['type'], tag['key'])
+        if actions:
+            pending.append((tag, actions))
+
+    # Apply the first action of every tag, then the second, and so on, so
+    # that chained actions see the output of the previous ones
+    depth = 0
+    while pending:
+        columns = {}
+        for tag, actions in pending:
+            action = actions[depth]
+            columns.setdefault(id(action), (action, []))[1].append(tag)
+        for action, column in columns.itervalues():
+            values = [tag['value'] for tag in column]
+            batch_cleaner = BATCH_CLEANERS.get(action.name)
+            if batch_cleaner is not None:
+                values = batch_cleaner(values, action.mapping)
+            else:
+                values = [action.apply(value) for value in values]
+            if canonical and action.name in canonical:
+                index = canonical[action.name]
+                values = [index.canonical(value) for value in values]
+            for tag, value in zip(column, values):
+                tag['value'] = value
+        depth += 1
+        pending = [(tag, actions) for tag, actions in pending
+                   if len(actions) > depth]
     return tags
             
 
 def shape_element(element, node_attr_fields=NODE_FIELDS, 
                   way_attr_fields=WAY_FIELDS,
                   problem_chars=PROBLEMCHARS, lower_colon=LOWER_COLON,
-                  default_tag_type='regular'):
+                  default_tag_type='regular', rules=None, clean=True,
+                  canonical=None):
     """Clean and shape node or way XML element to Python dict.
     
     Parameters
@@ -273,7 +579,18 @@ def shape_element(element, node_attr_fields=NODE_FIELDS,
         
     default_tag_type : str
         Default value for tag field 'type'.
-        
+
+    rules : cleaning_rules.RuleTable
+        Compiled cleaning rules. Defaults to the rules in the module level
+        variable RULES_PATHS.
+
+    clean : bool
+        True if the tags are to be cleaned. False leaves cleaning to the
+        caller, e.g. to clean the tags of many elements with clean_tags_batch.
+
+    canonical : dict
+        canonical_names.CanonicalIndex by cleaner name, passed to clean_tags.
+
     Returns
     -------
     dict
@@ -333,7 +650,8 @@ def shape_element(element, node_attr_fields=NODE_FIELDS,
                 i += 1
 	
 	# Clean tags   
-    tags = clean_tags(tags, problem_chars)  
+    if clean:
+        tags = clean_tags(tags, problem_chars, rules, canonical)
      
     # Shape the element for integration into the database            
     if element.tag == 'node':
@@ -343,7 +661,40 @@ def shape_element(element, node_attr_fields=NODE_FIELDS,
 
 
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
+def make_sampler(osm_file, tags, sample_every=None, sample_fraction=None):
+    """Create the sampler used by get_element, if sampling is requested.
+    
+    Parameters
+    ----------
+    osm_file : str
+        Path to the OSM file.
+        
+    tags : tuple
+        Tuple of strings that indicate which elements are to be sampled.
+
+    sample_every : int
+        Keep every Kth element of each type.
+
+    sample_fraction : float
+        Keep elements whose hashed id falls below this fraction.
+        
+    Returns
+    -------
+    sampling.ElementSampler
+        The sampler, with the nodes of the sampled ways collected if nodes
+        are sampled. None if neither sample_every nor sample_fraction is
+        given.
+    """
+    if not (sample_every or sample_fraction):
+        return None
+    sampler = ElementSampler(sample_every, sample_fraction)
+    if 'node' in tags:
+        sampler.collect_way_nodes(get_element(osm_file, tags=('way',)))
+    return sampler
+
+
+def get_element(osm_file, tags=('node', 'way', 'relation'), sample_every=None,
+                sample_fraction=None):
     """Yield element if it is the right type of tag.
     
     Parameters
@@ -354,6 +705,14 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
     tags : tuple
         Tuple of strings that indicate which elements to extract from the OSM
         file.
+
+    sample_every : int
+        If given, only every Kth element of each type is yielded, plus the
+        nodes referenced by the yielded ways.
+
+    sample_fraction : float
+        If given, only elements whose hashed id falls below this fraction are
+        yielded, plus the nodes referenced by the yielded ways.
         
     Yields
     ------
@@ -361,14 +720,59 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
         An element of the OSM file that belongs to a type identified in the 
         parameter 'tags'.
     """
+    sampler = make_sampler(osm_file, tags, sample_every, sample_fraction)
+
     context = ET.iterparse(osm_file, events=('start', 'end'))
     _, root = next(context)
     for event, elem in context:
         if event == 'end' and elem.tag in tags:
-            yield elem
+            if sampler is None or sampler.keep(elem):
+                yield elem
             root.clear()
 
 
+def build_canonical_indexes(osm_file, rules=None, sample_every=None,
+                            sample_fraction=None, cleaners=CANONICAL_CLEANERS):
+    """Learn the canonical forms of cleaned values in a pass over a file.
+
+    Parameters
+    ----------
+    osm_file : str
+        Path to the OSM file.
+
+    rules : cleaning_rules.RuleTable
+        Compiled cleaning rules. Defaults to the rules in the module level
+        variable RULES_PATHS.
+
+    sample_every, sample_fraction : int, float
+        Sampling of the elements, as in get_element.
+
+    cleaners : tuple
+        Names of the cleaners whose output is counted.
+
+    Returns
+    -------
+    dict
+        A canonical_names.CanonicalIndex of the values output by each
+        cleaner.
+    """
+    if rules is None:
+        rules = get_rule_table()
+    counts = dict((name, defaultdict(int)) for name in cleaners)
+    for element in get_element(osm_file, tags=('node', 'way'),
+                               sample_every=sample_every,
+                               sample_fraction=sample_fraction):
+        el = shape_element(element, rules=rules)
+        for tag in el['node_tags'] if 'node' in el else el['way_tags']:
+            # Cleaned keys are already fixed, so they resolve to the same
+            # actions as the original keys
+            for action in rules.lookup(tag['type'], tag['key'])[1]:
+                if action.name in counts:
+                    counts[action.name][tag['value']] += 1
+    return dict((name, CanonicalIndex(values))
+                for name, values in counts.iteritems())
+
+
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema.
     
@@ -425,11 +829,217 @@ class UnicodeDictWriter(csv.DictWriter, object):
            self.writerow(row)
 
 
+def pivot_tags(attribs, tags, fields, hot_keys=HOT_KEYS):
+    """Build the wide-format row of an element from its shaped tags.
+    
+    Parameters
+    ----------
+    attribs : dict
+        The attributes of a node or way shaped by shape_element.
+
+    tags : list
+        The cleaned tags of the element.
+
+    fields : list
+        Attributes copied to the row, e.g. 'id', 'lat' and 'lon'.
+
+    hot_keys : tuple
+        (column, type, key) of each pivoted tag. Defaults to the module level
+        variable HOT_KEYS.
+        
+    Returns
+    -------
+    dict
+        The row, or None if the element has none of the pivoted tags.
+    """
+    columns = dict(((tag_type, key), column)
+                   for column, tag_type, key in hot_keys)
+    row = {}
+    for tag in tags:
+        column = columns.get((tag['type'], tag['key']))
+        if column is not None and column not in row:
+            row[column] = tag['value']
+    if not row:
+        return None
+    for field in fields:
+        row[field] = attribs[field]
+    return row
+
+
+def write_element(el, writers):
+    """Write a shaped element to the csv writers.
+    
+    Parameters
+    ----------
+    el : dict
+        A node or way shaped by shape_element.
+
+    writers : dict
+        UnicodeDictWriters for 'nodes', 'node_tags', 'ways', 'way_nodes', and
+        'way_tags', and optionally 'node_attrs' and 'way_attrs'.
+    """
+    if 'node' in el:
+        writers['nodes'].writerow(el['node'])
+        writers['node_tags'].writerows(el['node_tags'])
+        if 'node_attrs' in writers:
+            row = pivot_tags(el['node'], el['node_tags'], ('id', 'lat', 'lon'))
+            if row is not None:
+                writers['node_attrs'].writerow(row)
+    elif 'way' in el:
+        writers['ways'].writerow(el['way'])
+        writers['way_nodes'].writerows(el['way_nodes'])
+        writers['way_tags'].writerows(el['way_tags'])
+        if 'way_attrs' in writers:
+            row = pivot_tags(el['way'], el['way_tags'], ('id',))
+            if row is not None:
+                writers['way_attrs'].writerow(row)
+
+
+def iter_chunks(iterable, size):
+    """Yield lists of up to size consecutive items.
+    
+    Parameters
+    ----------
+    iterable : iterable
+        The items to be grouped.
+
+    size : int
+        Maximum number of items per list.
+
+    Yields
+    ------
+    list
+        The next group of items.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def write_checkpoint(path, state):
+    """Durably record the progress of a conversion.
+
+    The record is written to a temporary file that replaces the previous
+    record in one step, so a crash never leaves a partial record behind.
+    
+    Parameters
+    ----------
+    path : str
+        Path to the checkpoint file.
+
+    state : dict
+        JSON-serializable progress record.
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as fout:
+        json.dump(state, fout)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.rename(temp_path, path)
+
+
+def read_checkpoint(path, osm_file):
+    """Load the progress record of an interrupted conversion.
+    
+    Parameters
+    ----------
+    path : str
+        Path to the checkpoint file.
+
+    osm_file : str
+        Path to the OSM file being converted.
+        
+    Returns
+    -------
+    dict
+        The progress record, or None if there is no checkpoint file.
+
+    Raises
+    ------
+    ValueError
+        If the checkpoint was recorded for a different input file.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as fin:
+        state = json.load(fin)
+    if state['input'] != os.path.abspath(osm_file) or \
+       state['input_size'] != os.path.getsize(osm_file):
+        raise ValueError("Checkpoint %s was recorded for a different input "
+                         "file." % path)
+    return state
+
+
+def open_outputs(positions=None, outputs=OUTPUTS):
+    """Open the csv output files, either afresh or to resume a conversion.
+    
+    Parameters
+    ----------
+    positions : dict
+        Byte position of each output at the last checkpoint. The files are
+        truncated to these positions. If None, the files are created empty.
+
+    outputs : tuple
+        (name, path, fields) of each output. Defaults to the module level
+        variable OUTPUTS.
+        
+    Returns
+    -------
+    dict
+        An open file object for each output name.
+    """
+    files = {}
+    try:
+        for name, path, _ in outputs:
+            if positions is None:
+                files[name] = codecs.open(path, 'w')
+            else:
+                files[name] = open(path, 'r+b')
+                files[name].seek(positions[name])
+                files[name].truncate()
+    except:
+        for output in files.itervalues():
+            output.close()
+        raise
+    return files
+
+
+def sync_outputs(files):
+    """Flush the csv output files to disk.
+    
+    Parameters
+    ----------
+    files : dict
+        An open file object for each output name.
+        
+    Returns
+    -------
+    dict
+        The byte position of each output.
+    """
+    positions = {}
+    for name, output in files.iteritems():
+        output.flush()
+        os.fsync(output.fileno())
+        positions[name] = output.tell()
+    return positions
+
+
 ################################################################################
 #                                MAIN FUNCTION                                 #
 ################################################################################
 
-def process_map(file_in, validate):
+def process_map(file_in, validate, sample_every=None, sample_fraction=None,
+                rules_paths=RULES_PATHS, batch_size=BATCH_SIZE,
+                checkpoint_every=None, resume=False,
+                checkpoint_path=CHECKPOINT_PATH, pivot=False,
+                check_integrity=None, output_dir=None, threaded=False,
+                sort=False, memory_budget=MEMORY_BUDGET, canonical=False):
     """Iteratively process each XML element and write to csv(s).
     
     Parameters
@@ -439,41 +1049,227 @@ def process_map(file_in, validate):
         
     validate : bool
         True if validation to be executed. False if validation omitted.
+
+    sample_every : int
+        If given, only every Kth node and way is processed, plus the nodes
+        referenced by the processed ways.
+
+    sample_fraction : float
+        If given, only nodes and ways whose hashed id falls below this fraction
+        are processed, plus the nodes referenced by the processed ways.
+
+    rules_paths : tuple
+        Paths to the cleaning rules files, e.g. the defaults followed by
+        regional rules. Defaults to the module level variable RULES_PATHS.
+
+    batch_size : int
+        Number of elements whose tags are cleaned together with
+        clean_tags_batch. If None, each element's tags are cleaned separately.
+        Defaults to the module level variable BATCH_SIZE.
+
+    checkpoint_every : int
+        If given, the input offset and output positions are recorded in
+        checkpoint_path after roughly every this many elements (rounded up to
+        a whole batch). The record is removed when the conversion completes.
+
+    resume : bool
+        True to continue from the record in checkpoint_path, if it exists,
+        instead of starting from the beginning of the input. The outputs are
+        truncated to their recorded positions. Requires checkpoint_every,
+        since only the checkpointing reader can start from an input offset.
+
+    checkpoint_path : str
+        Path to the checkpoint file. Defaults to the module level variable
+        CHECKPOINT_PATH.
+
+    pivot : bool
+        True to also write the wide-format 'node_attrs' and 'way_attrs'
+        tables, with one column per tag in the module level variable HOT_KEYS.
+        Only elements with at least one of these tags get a row.
+
+    check_integrity : str
+        'report' to check for dangling way node references, ways with fewer
+        than two nodes and duplicate ids while converting, and print what was
+        found; 'drop' to also leave the offending way nodes and elements out
+        of the csv files. No check if None. Cannot be combined with resuming
+        from a checkpoint, since the ids seen before it are not recorded.
+
+    output_dir : str
+        Directory in which the csv files are written, created if needed.
+        Defaults to the current directory.
+
+    threaded : bool
+        True to parse the input in a read-ahead thread and write the csv
+        files in a writer thread, while elements are shaped and cleaned in
+        the calling thread. The output is the same.
+
+    sort : bool
+        True to sort the csv files once written: 'ways_nodes' by node id, way
+        id and position, as loaded into clustered tables by csv_to_database.py,
+        and the other files by element id.
+
+    memory_budget : int
+        Approximate number of bytes of rows held in memory while sorting;
+        larger files are sorted in runs spilled to disk. Defaults to
+        external_sort.MEMORY_BUDGET.
+
+    canonical : bool
+        True to first learn the frequent city and street names of the file,
+        then replace rare misspellings of them while cleaning, see
+        build_canonical_indexes.
+
+    Returns
+    -------
+    integrity.IntegrityChecker
+        The checker with the problems found, or None if no check was made.
+
+    Raises
+    ------
+    ValueError
+        If resume is set without checkpoint_every, or check_integrity is set
+        when resuming from a checkpoint.
     """
+    if resume and not checkpoint_every:
+        raise ValueError("resume requires checkpoint_every, otherwise the "
+                         "input would be converted again from the start.")
+    rules = get_rule_table(rules_paths)
+    canonical_indexes = None
+    if canonical:
+        canonical_indexes = build_canonical_indexes(file_in, rules,
+                                                    sample_every,
+                                                    sample_fraction)
+    outputs = OUTPUTS + ATTRS_OUTPUTS if pivot else OUTPUTS
+    if output_dir is not None:
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        outputs = tuple((name, os.path.join(output_dir, path), fields)
+                        for name, path, fields in outputs)
+    tags = ('node', 'way')
+    checkpoint = read_checkpoint(checkpoint_path, file_in) if resume else None
+    if check_integrity is not None and checkpoint is not None:
+        raise ValueError("check_integrity cannot be used when resuming from "
+                         "a checkpoint.")
+    checker = check_integrity and IntegrityChecker(check_integrity)
+
+    files = open_outputs(checkpoint and checkpoint['outputs'], outputs)
+    background_writer = None
+    try:
+        writers = dict((name, UnicodeDictWriter(files[name], fields))
+                       for name, _, fields in outputs)
+        if checkpoint is None:
+            for writer in writers.itervalues():
+                writer.writeheader()
 
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
+        # cerberus is only imported when needed; it is slow to import
+        if validate is True:
+            import cerberus
+            validator = cerberus.Validator()
+
+        if checkpoint_every:
+            # Parse through a reader that records where each element starts,
+            # so that progress can be expressed as an input offset
+            if checkpoint is None:
+                with open(file_in, 'rb') as fin:
+                    start = find_first_element(fin)
+            else:
+                start = checkpoint['offset']
+            reader = ShardReader(file_in, start, track_offsets=True)
+            elements = iter_reader_elements(reader, tags)
+            if threaded:
+                # Sampling stays in this thread, so that the sample counts
+                # recorded in a checkpoint match the elements written
+                elements = iter_read_ahead(elements)
+            if checkpoint is not None:
+                # The checkpoint offset is that of the last element written
+                next(elements)
+            sampler = make_sampler(file_in, tags, sample_every,
+                                   sample_fraction)
+            if sampler is not None:
+                if checkpoint is not None:
+                    sampler.counts.update(checkpoint['sample_counts'])
+                elements = (element for element in elements
+                            if sampler.keep(element))
+            processed = checkpoint['elements'] if checkpoint else 0
+            last_saved = processed
+        else:
+            elements = get_element(file_in, tags=tags,
+                                   sample_every=sample_every,
+                                   sample_fraction=sample_fraction)
+            if threaded:
+                elements = iter_read_ahead(elements)
+
+        if threaded:
+            background_writer = BackgroundWriter(
+                lambda el: write_element(el, writers))
+
+        shaped = (shape_element(element, rules=rules,
+                                clean=batch_size is None,
+                                canonical=canonical_indexes)
+                  for element in elements)
+        for chunk in iter_chunks(shaped, batch_size or 1):
+            chunk = [el for el in chunk if el]
+            if batch_size is not None:
+                chunk_tags = []
+                for el in chunk:
+                    chunk_tags.extend(el['node_tags'] if 'node' in el
+                                      else el['way_tags'])
+                clean_tags_batch(chunk_tags, rules=rules,
+                                 canonical=canonical_indexes)
+            kept = []
+            for el in chunk:
+                if checker is not None and not checker.check(el):
+                    continue
                 if validate is True:
                     validate_element(el, validator)
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
-            
+                kept.append(el)
+            if background_writer is not None:
+                background_writer.put(kept)
+            else:
+                for el in kept:
+                    write_element(el, writers)
+
+            if checkpoint_every and chunk:
+                last = chunk[-1]
+                tag = 'node' if 'node' in last else 'way'
+                try:
+                    offset = reader.offset_of(tag, last[tag]['id'])
+                except KeyError:
+                    raise ValueError("Cannot locate the start tag of %s %s "
+                                     "in '%s' to record a checkpoint; convert "
+                                     "it without checkpoint_every." %
+                                     (tag, last[tag]['id'], file_in))
+                processed += len(chunk)
+                if processed - last_saved >= checkpoint_every:
+                    if background_writer is not None:
+                        # The recorded output positions must cover every
+                        # element up to the offset
+                        background_writer.join()
+                    write_checkpoint(checkpoint_path, {
+                        'input': os.path.abspath(file_in),
+                        'input_size': os.path.getsize(file_in),
+                        'offset': offset,
+                        'elements': processed,
+                        'sample_counts': sampler and dict(sampler.counts),
+                        'outputs': sync_outputs(files)
+                    })
+                    last_saved = processed
+        if background_writer is not None:
+            background_writer.close()
+    finally:
+        if background_writer is not None:
+            background_writer.close(discard=True)
+        for output in files.itervalues():
+            output.close()
+
+    if checkpoint_every and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    if sort:
+        sort_outputs(outputs, memory_budget)
+
+    if checker is not None:
+        checker.report()
+    return checker
 
 
 if __name__ == '__main__':
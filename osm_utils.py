@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Module osm_utils.py holds the helpers shared by the scripts that read the
+database created by csv_to_database.py: streaming the rows of a query a batch
+at a time, so that large tables are read without holding every row in memory,
+and the great-circle distance between points.
+
+Acknowledgments:
+[1] https://docs.python.org/2/library/sqlite3.html#sqlite3.Cursor.fetchmany
+[2] https://en.wikipedia.org/wiki/Haversine_formula
+"""
+
+import numpy as np
+
+
+FETCH_SIZE = 10000
+"""int: Number of rows fetched from the database at a time."""
+
+EARTH_RADIUS = 6371008.8
+"""float: Mean radius of the earth in meters."""
+
+
+################################################################################
+#                              HELPER FUNCTIONS                                #
+################################################################################
+
+def iter_batches(cur, fetch_size=FETCH_SIZE):
+    """Yield the rows of a cursor in batches.
+
+    Parameters
+    ----------
+    cur : sqlite3.Cursor
+        A cursor on which a query has been executed.
+
+    fetch_size : int
+        Number of rows in a batch.
+
+    Yields
+    ------
+    list
+        The next batch of rows.
+    """
+    while True:
+        rows = cur.fetchmany(fetch_size)
+        if not rows:
+            break
+        yield rows
+
+
+def iter_rows(cur, fetch_size=FETCH_SIZE):
+    """Yield the rows of a cursor one at a time, fetching them in batches.
+
+    Parameters
+    ----------
+    cur : sqlite3.Cursor
+        A cursor on which a query has been executed.
+
+    fetch_size : int
+        Number of rows fetched at a time.
+
+    Yields
+    ------
+    tuple
+        The next row.
+    """
+    for rows in iter_batches(cur, fetch_size):
+        for row in rows:
+            yield row
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance between points.
+
+    Parameters
+    ----------
+    lat1, lon1, lat2, lon2 : float or numpy.ndarray
+        Coordinates of the start and end points in degrees.
+
+    Returns
+    -------
+    float or numpy.ndarray
+        The distances in meters.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Module pipeline.py overlaps the stages of a streaming conversion with
+background threads: a read-ahead thread that pulls items (e.g. parsed XML
+elements) from an iterator before they are needed, and a writer thread that
+drains chunks of results to the output files. The stages hand items over
+through bounded queues, so a fast stage blocks once it is MAX_CHUNKS chunks
+ahead of a slow one and memory stays bounded.
+
+Items are passed in chunks rather than one at a time, since every queue
+operation takes a lock. Errors raised in a background thread are re-raised
+in the calling thread.
+
+Acknowledgments:
+[1] https://docs.python.org/2/library/queue.html
+[2] https://docs.python.org/2/library/threading.html
+"""
+
+import Queue
+import sys
+import threading
+
+
+CHUNK_SIZE = 1000
+"""int: Number of items read ahead and handed over at a time."""
+
+MAX_CHUNKS = 8
+"""int: Number of chunks a queue holds before the stage feeding it blocks."""
+
+_DONE = object()
+"""object: Marker put on a queue after the last chunk."""
+
+
+class _Failure(object):
+    """Exception raised in a background thread, to be re-raised."""
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+    def reraise(self):
+        """Raise the exception with its original traceback."""
+        raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
+def _start_thread(target):
+    """Start a daemon thread, so that an abandoned stage cannot keep the
+    interpreter alive."""
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def iter_read_ahead(iterable, chunk_size=CHUNK_SIZE, max_chunks=MAX_CHUNKS):
+    """Iterate over an iterable that is consumed in a background thread.
+
+    Parameters
+    ----------
+    iterable : iterable
+        The items. It is iterated over in the background thread only, so it
+        must not be shared with the caller.
+
+    chunk_size : int
+        Number of items handed over at a time.
+
+    max_chunks : int
+        Number of chunks the background thread may read ahead.
+
+    Yields
+    ------
+    object
+        The items of iterable, in order.
+    """
+    chunks = Queue.Queue(max_chunks)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            chunk = []
+            for item in iterable:
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    chunks.put(chunk)
+                    chunk = []
+                    if stop.is_set():
+                        return
+            if chunk:
+                chunks.put(chunk)
+            chunks.put(_DONE)
+        except Exception:
+            chunks.put(_Failure(sys.exc_info()))
+
+    _start_thread(produce)
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _DONE:
+                return
+            if isinstance(chunk, _Failure):
+                chunk.reraise()
+            for item in chunk:
+                yield item
+    finally:
+        # If the caller stops early, unblock the producer so that it can
+        # notice the stop
+        stop.set()
+        while True:
+            try:
+                chunks.get_nowait()
+            except Queue.Empty:
+                break
+
+
+class BackgroundWriter(object):
+    """Write chunks of items in a background thread.
+
+    Parameters
+    ----------
+    write : callable
+        Function called with each item, in order, in the background thread.
+
+    max_chunks : int
+        Number of chunks queued before put blocks.
+    """
+
+    def __init__(self, write, max_chunks=MAX_CHUNKS):
+        self._write = write
+        self._chunks = Queue.Queue(max_chunks)
+        self._failure = None
+        self._discard = False
+        self._thread = _start_thread(self._run)
+
+    def _run(self):
+        """Write the queued chunks until the end marker."""
+        while True:
+            chunk = self._chunks.get()
+            try:
+                if chunk is _DONE:
+                    return
+                if self._failure is None and not self._discard:
+                    for item in chunk:
+                        self._write(item)
+            except Exception:
+                self._failure = _Failure(sys.exc_info())
+            finally:
+                self._chunks.task_done()
+
+    def _check(self):
+        """Re-raise an error of the background thread."""
+        if self._failure is not None:
+            self._failure.reraise()
+
+    def put(self, chunk):
+        """Queue a list of items to be written.
+
+        Raises
+        ------
+        Exception
+            The error that stopped the background thread, if any.
+        """
+        self._check()
+        self._chunks.put(chunk)
+
+    def join(self):
+        """Wait until every chunk queued so far has been written.
+
+        Raises
+        ------
+        Exception
+            The error that stopped the background thread, if any.
+        """
+        self._chunks.join()
+        self._check()
+
+    def close(self, discard=False):
+        """Write the queued chunks and stop the background thread.
+
+        Parameters
+        ----------
+        discard : bool
+            True to drop the chunks not written yet and ignore errors, e.g.
+            when cleaning up after an error in the calling thread.
+
+        Raises
+        ------
+        Exception
+            The error that stopped the background thread, unless discard is
+            True.
+        """
+        if self._thread.is_alive():
+            self._discard = discard
+            self._chunks.put(_DONE)
+            self._thread.join()
+        if not discard:
+            self._check()
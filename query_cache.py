@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Module query_cache.py caches the results of the read-only queries in
+sql_queries.py. A result is keyed by the database path, the query text, the
+query parameters, and a random instance id and a generation counter stored
+in the database itself. csv_to_database.py increments the counter after every
+load, so cached results are never served for data that has since changed; the
+instance id is written when the counter is first created, so a database that
+is deleted and loaded again under the same path does not reuse the results of
+the old one although its counter starts over.
+
+Results are kept in two tiers:
+ - An in-memory least-recently-used tier, for repeated calls in one process
+ - An optional on-disk tier (one pickle file per result), shared between
+   processes and kept across runs
+
+Acknowledgments:
+[1] https://en.wikipedia.org/wiki/Cache_replacement_policies#LRU
+[2] https://docs.python.org/2/library/pickle.html
+"""
+
+from collections import OrderedDict
+import cPickle as pickle
+import hashlib
+import os
+import sqlite3
+import uuid
+
+
+META_TABLE = 'db_meta'
+"""str: Table holding the instance id and generation counter of a
+database."""
+
+MEMORY_ENTRIES = 256
+"""int: Maximum number of results kept in the in-memory tier."""
+
+
+def get_generation(conn):
+    """Return the generation counter of a database.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the database.
+
+    Returns
+    -------
+    int
+        The counter, or 0 if it has never been incremented.
+    """
+    try:
+        row = conn.execute("SELECT value FROM %s WHERE key = 'generation'"
+                           % META_TABLE).fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] if row else 0
+
+
+def get_instance(conn):
+    """Return the instance id of a database.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the database.
+
+    Returns
+    -------
+    str
+        The random id written when the generation counter was first created,
+        or None if the database has none.
+    """
+    try:
+        row = conn.execute("SELECT value FROM %s WHERE key = 'instance'"
+                           % META_TABLE).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+
+def bump_generation(conn):
+    """Increment the generation counter of a database, invalidating every
+    cached result for it. Called after the contents have changed.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the database. The change is committed.
+
+    Returns
+    -------
+    int
+        The new value of the counter.
+    """
+    generation = get_generation(conn) + 1
+    conn.execute('CREATE TABLE IF NOT EXISTS %s(key TEXT PRIMARY KEY, '
+                 'value INTEGER)' % META_TABLE)
+    # Identify this database, unlike any other created under the same path
+    conn.execute("INSERT OR IGNORE INTO %s(key, value) VALUES ('instance', ?)"
+                 % META_TABLE, ('db-' + uuid.uuid4().hex,))
+    conn.execute("INSERT OR REPLACE INTO %s(key, value) "
+                 "VALUES ('generation', ?)" % META_TABLE, (generation,))
+    conn.commit()
+    return generation
+
+
+class QueryCache(object):
+    """Two-tier cache of query results.
+
+    Parameters
+    ----------
+    max_entries : int
+        Maximum number of results kept in memory. Defaults to the module level
+        variable MEMORY_ENTRIES.
+
+    cache_dir : str
+        Directory of the on-disk tier, created if needed. If None, results are
+        only cached in memory.
+    """
+
+    def __init__(self, max_entries=MEMORY_ENTRIES, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self._memory = OrderedDict()
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _disk_path(self, key):
+        """Return the path of the on-disk entry for a key."""
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(repr(key)).hexdigest() + '.pkl')
+
+    def _remember(self, key, results):
+        """Store a result in the in-memory tier, evicting the least recently
+        used result if the tier is full."""
+        self._memory[key] = results
+        if len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Return the cached result for a key, or None on a miss.
+
+        Parameters
+        ----------
+        key : tuple
+            The key built by fetchall.
+
+        Returns
+        -------
+        list
+            The cached rows, or None.
+        """
+        results = self._memory.pop(key, None)
+        if results is not None:
+            self._memory[key] = results
+            return results
+        if self.cache_dir is not None:
+            try:
+                with open(self._disk_path(key), 'rb') as fin:
+                    results = pickle.load(fin)
+            except (IOError, EOFError, pickle.UnpicklingError):
+                return None
+            self._remember(key, results)
+        return results
+
+    def put(self, key, results):
+        """Store a result in both tiers.
+
+        Parameters
+        ----------
+        key : tuple
+            The key built by fetchall.
+
+        results : list
+            The rows returned by the query.
+        """
+        self._remember(key, results)
+        if self.cache_dir is not None:
+            path = self._disk_path(key)
+            temp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(temp_path, 'wb') as fout:
+                pickle.dump(results, fout, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, path)
+
+    def fetchall(self, conn, db, query, params=()):
+        """Return the rows of a query, from the cache if possible.
+
+        The rows are shared with the cache and must not be modified.
+
+        Parameters
+        ----------
+        conn : sqlite3.Connection
+            Connection to the database, used on a cache miss and to read the
+            instance id and generation counter.
+
+        db : str
+            Path to the database, part of the key.
+
+        query : str
+            The query text.
+
+        params : tuple
+            The query parameters.
+
+        Returns
+        -------
+        list
+            The rows returned by the query.
+        """
+        path = os.path.abspath(db)
+        instance = get_instance(conn)
+        if instance is None and os.path.exists(path):
+            # Never loaded by this toolkit: tell files apart by their identity
+            stat = os.stat(path)
+            instance = (stat.st_ino, stat.st_mtime)
+        key = (path, instance, get_generation(conn), query, tuple(params))
+        results = self.get(key)
+        if results is None:
+            results = conn.execute(query, params).fetchall()
+            self.put(key, results)
+        return results
+
+    def clear(self):
+        """Remove every result from both tiers."""
+        self._memory.clear()
+        if self.cache_dir is not None:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+
+def fetchall(conn, db, query, params=(), cache=None):
+    """Run a query, serving the result from a cache if one is given.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the database.
+
+    db : str
+        Path to the sqlite database being queried.
+
+    query : str
+        The query text.
+
+    params : tuple
+        The query parameters.
+
+    cache : QueryCache
+        Cache of query results, or None to always run the query.
+
+    Returns
+    -------
+    list
+        The rows returned by the query.
+    """
+    if cache is None:
+        return conn.execute(query, params).fetchall()
+    return cache.fetchall(conn, db, query, params)
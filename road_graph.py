@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""
+Script road_graph.py builds a routable road network from the database created
+by csv_to_database.py. The highway ways are streamed from 'ways_nodes' in node
+order and split at every node they share with another highway way (and at
+their end points), giving one edge per stretch of road between intersections.
+
+The graph is stored in compressed sparse row (CSR) form as NumPy arrays:
+ - offsets: the edges leaving vertex v are offsets[v] to offsets[v + 1] - 1
+ - targets: the vertex at the end of each edge
+ - lengths: the length of each edge in meters
+plus the OSM node id, latitude and longitude of each vertex and the OSM way id
+of each edge. The arrays are saved as .npy files and memory-mapped when
+loaded, so graphs with tens of millions of edges are queried without reading
+them into memory or creating a Python object per edge.
+
+Acknowledgments:
+[1] https://en.wikipedia.org/wiki/Sparse_matrix#Compressed_sparse_row_(CSR,_CRS_or_Yale_format)
+[2] https://en.wikipedia.org/wiki/Dijkstra%27s_algorithm
+[3] https://wiki.openstreetmap.org/wiki/Key:oneway
+"""
+
+from array import array
+import heapq
+import os
+import sqlite3
+
+import numpy as np
+
+from osm_utils import haversine, iter_batches
+
+
+DB = 'mydb.db'
+"""str: Path to the sqlite database holding the ways."""
+
+GRAPH_DIR = 'road_graph'
+"""str: Directory in which the graph arrays are saved."""
+
+GRAPH_ARRAYS = ('node_ids', 'lat', 'lon', 'offsets', 'targets', 'lengths',
+                'ways')
+"""tuple: Names of the arrays making up a graph, saved as <name>.npy."""
+
+EXCLUDED_HIGHWAYS = ('proposed', 'construction', 'abandoned', 'disused',
+                     'platform', 'raceway', 'elevator')
+"""tuple: Values of the 'highway' tag of ways that are not routable."""
+
+ONEWAY_FORWARD = ('yes', 'true', '1')
+"""tuple: Values of the 'oneway' tag for travel in the direction of the way."""
+
+ONEWAY_REVERSE = ('-1', 'reverse')
+"""tuple: Values of the 'oneway' tag for travel against the way."""
+
+
+################################################################################
+#                              HELPER FUNCTIONS                                #
+################################################################################
+
+def read_highway_ways(conn):
+    """Find the routable highway ways and their direction of travel.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the database.
+
+    Returns
+    -------
+    tuple
+        Sorted numpy array of way ids, and an array with the direction of
+        each way: 0 if both ways, 1 if in the direction of the way, -1 if
+        against it.
+    """
+    query = '''SELECT h.id, o.value, j.value
+               FROM ways_tags h
+               LEFT JOIN ways_tags o
+               ON o.id = h.id AND o.key = 'oneway' AND o.type = 'regular'
+               LEFT JOIN ways_tags j
+               ON j.id = h.id AND j.key = 'junction' AND j.type = 'regular'
+               WHERE h.key = 'highway' AND h.type = 'regular'
+               AND h.value NOT IN (%s)
+               ORDER BY h.id;''' % ', '.join('?' * len(EXCLUDED_HIGHWAYS))
+    way_ids = array('l')
+    directions = array('b')
+    cur = conn.execute(query, EXCLUDED_HIGHWAYS)
+    for rows in iter_batches(cur):
+        for way_id, oneway, junction in rows:
+            if way_ids and way_ids[-1] == way_id:
+                continue
+            if oneway in ONEWAY_FORWARD or \
+               (oneway is None and junction == 'roundabout'):
+                direction = 1
+            elif oneway in ONEWAY_REVERSE:
+                direction = -1
+            else:
+                direction = 0
+            way_ids.append(way_id)
+            directions.append(direction)
+    return (np.array(way_ids, dtype=np.int64),
+            np.array(directions, dtype=np.int8))
+
+
+def read_way_sequences(conn, way_ids):
+    """Stream the node sequences of the given ways.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the database.
+
+    way_ids : numpy.ndarray
+        Ids of the ways to be read.
+
+    Returns
+    -------
+    tuple
+        Two numpy arrays holding, for each position along the ways, the way
+        id and the node id, ordered by way and position.
+    """
+    conn.execute('DROP TABLE IF EXISTS temp.graph_ways')
+    conn.execute('CREATE TEMP TABLE graph_ways(id INTEGER PRIMARY KEY)')
+    conn.executemany('INSERT INTO temp.graph_ways(id) VALUES (?)',
+                     ((int(way_id),) for way_id in way_ids))
+    cur = conn.execute('''SELECT wn.id, wn.node_id
+                          FROM ways_nodes wn
+                          JOIN temp.graph_ways g ON wn.id = g.id
+                          ORDER BY wn.id, wn.position;''')
+    way_of = array('l')
+    node_of = array('l')
+    for rows in iter_batches(cur):
+        for way_id, node_id in rows:
+            way_of.append(way_id)
+            node_of.append(node_id)
+    conn.execute('DROP TABLE temp.graph_ways')
+    return (np.array(way_of, dtype=np.int64),
+            np.array(node_of, dtype=np.int64))
+
+
+def read_coordinates(conn, node_ids):
+    """Stream the coordinates of the given nodes from the 'nodes' table.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the database.
+
+    node_ids : numpy.ndarray
+        Sorted, distinct ids of the nodes whose coordinates are needed.
+
+    Returns
+    -------
+    tuple
+        Numpy arrays of the ids, latitudes and longitudes of the nodes found,
+        sorted by id. Ids missing from the 'nodes' table are left out.
+    """
+    ids, lats, lons = [], [], []
+    cur = conn.execute('SELECT id, lat, lon FROM nodes ORDER BY id;')
+    for rows in iter_batches(cur):
+        chunk_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        found = np.in1d(chunk_ids, node_ids, assume_unique=True)
+        ids.append(chunk_ids[found])
+        lats.append(np.array([row[1] for row in rows])[found])
+        lons.append(np.array([row[2] for row in rows])[found])
+    if not ids:
+        return (np.zeros(0, np.int64), np.zeros(0), np.zeros(0))
+    return np.concatenate(ids), np.concatenate(lats), np.concatenate(lons)
+
+
+class RoadGraph(object):
+    """Directed road graph in compressed sparse row form.
+
+    Parameters
+    ----------
+    node_ids : numpy.ndarray
+        Sorted OSM node id of each vertex.
+
+    lat, lon : numpy.ndarray
+        Coordinates of each vertex in degrees.
+
+    offsets : numpy.ndarray
+        The edges leaving vertex v are offsets[v] to offsets[v + 1] - 1.
+
+    targets : numpy.ndarray
+        The vertex at the end of each edge.
+
+    lengths : numpy.ndarray
+        The length of each edge in meters.
+
+    ways : numpy.ndarray
+        The OSM way id of each edge.
+    """
+
+    def __init__(self, node_ids, lat, lon, offsets, targets, lengths, ways):
+        self.node_ids = node_ids
+        self.lat = lat
+        self.lon = lon
+        self.offsets = offsets
+        self.targets = targets
+        self.lengths = lengths
+        self.ways = ways
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def save(self, graph_dir=GRAPH_DIR):
+        """Save the graph arrays as .npy files.
+
+        Parameters
+        ----------
+        graph_dir : str
+            Directory in which the arrays are saved, created if needed.
+        """
+        if not os.path.isdir(graph_dir):
+            os.makedirs(graph_dir)
+        for name in GRAPH_ARRAYS:
+            np.save(os.path.join(graph_dir, name + '.npy'),
+                    getattr(self, name))
+
+    @classmethod
+    def load(cls, graph_dir=GRAPH_DIR, mmap_mode='r'):
+        """Load a graph saved with save().
+
+        Parameters
+        ----------
+        graph_dir : str
+            Directory holding the arrays.
+
+        mmap_mode : str
+            Memory-mapping mode passed to numpy.load; None reads the arrays
+            into memory.
+
+        Returns
+        -------
+        RoadGraph
+            The graph.
+        """
+        return cls(*[np.load(os.path.join(graph_dir, name + '.npy'),
+                             mmap_mode=mmap_mode)
+                     for name in GRAPH_ARRAYS])
+
+    def vertex(self, node_id):
+        """Return the vertex of an OSM node.
+
+        Parameters
+        ----------
+        node_id : int
+            The id of a node at an intersection or end of a road.
+
+        Returns
+        -------
+        int
+            The vertex index.
+
+        Raises
+        ------
+        KeyError
+            If the node is not a vertex of the graph.
+        """
+        v = int(np.searchsorted(self.node_ids, node_id))
+        if v == len(self.node_ids) or self.node_ids[v] != node_id:
+            raise KeyError(node_id)
+        return v
+
+    def nearest_node(self, lat, lon):
+        """Return the OSM id of the vertex nearest to a point.
+
+        Parameters
+        ----------
+        lat, lon : float
+            Coordinates of the point in degrees.
+
+        Returns
+        -------
+        int
+            The node id of the nearest vertex.
+        """
+        distances = haversine(lat, lon, self.lat, self.lon)
+        return int(self.node_ids[int(np.argmin(distances))])
+
+    def edges(self, v):
+        """Return the edges leaving a vertex.
+
+        Parameters
+        ----------
+        v : int
+            The vertex index.
+
+        Returns
+        -------
+        list
+            (target vertex, length) pairs.
+        """
+        start, end = int(self.offsets[v]), int(self.offsets[v + 1])
+        return zip(self.targets[start:end].tolist(),
+                   self.lengths[start:end].tolist())
+
+    def shortest_path(self, source, target):
+        """Find the shortest route between two OSM nodes with Dijkstra's
+        algorithm.
+
+        Parameters
+        ----------
+        source, target : int
+            Node ids of vertices of the graph.
+
+        Returns
+        -------
+        tuple
+            The length of the route in meters and the list of node ids of the
+            vertices along it, or (inf, []) if target cannot be reached.
+        """
+        start, goal = self.vertex(source), self.vertex(target)
+        distances = {start: 0.0}
+        previous = {}
+        heap = [(0.0, start)]
+        while heap:
+            distance, v = heapq.heappop(heap)
+            if v == goal:
+                break
+            if distance > distances[v]:
+                continue
+            for w, length in self.edges(v):
+                candidate = distance + length
+                if candidate < distances.get(w, float('inf')):
+                    distances[w] = candidate
+                    previous[w] = v
+                    heapq.heappush(heap, (candidate, w))
+        else:
+            return float('inf'), []
+
+        path = [goal]
+        while path[-1] != start:
+            path.append(previous[path[-1]])
+        path.reverse()
+        return distances[goal], [int(self.node_ids[v]) for v in path]
+
+
+################################################################################
+#                                MAIN FUNCTION                                 #
+################################################################################
+
+def build_road_graph(db=DB, graph_dir=GRAPH_DIR):
+    """Build the road graph of the highway ways in a database.
+
+    Nodes missing from the 'nodes' table (e.g. outside an extract) are
+    skipped, joining their neighbours along the way directly.
+
+    Parameters
+    ----------
+    db : str
+        Path to the sqlite database.
+
+    graph_dir : str
+        Directory in which the graph arrays are saved, or None to skip saving.
+
+    Returns
+    -------
+    RoadGraph
+        The graph, held in memory.
+    """
+    conn = sqlite3.connect(db)
+    try:
+        highway_ids, directions = read_highway_ways(conn)
+        way_of, node_of = read_way_sequences(conn, highway_ids)
+        coord_ids, coord_lat, coord_lon = read_coordinates(
+            conn, np.unique(node_of))
+    finally:
+        conn.close()
+
+    # Drop positions whose node has no coordinates
+    index = np.searchsorted(coord_ids, node_of)
+    index[index == len(coord_ids)] = 0
+    found = coord_ids[index] == node_of if len(coord_ids) else \
+        np.zeros(len(node_of), bool)
+    way_of, node_of, index = way_of[found], node_of[found], index[found]
+
+    # Split the ways at their end points and at nodes used more than once
+    new_way = np.ones(len(way_of), bool)
+    new_way[1:] = way_of[1:] != way_of[:-1]
+    way_end = np.ones(len(way_of), bool)
+    way_end[:-1] = new_way[1:]
+    _, inverse, counts = np.unique(node_of, return_inverse=True,
+                                   return_counts=True)
+    is_vertex = new_way | way_end | (counts[inverse] > 1)
+
+    # Length along the ways up to each position
+    lat, lon = coord_lat[index], coord_lon[index]
+    steps = haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    steps[new_way[1:]] = 0
+    distance = np.zeros(len(way_of))
+    distance[1:] = np.cumsum(steps)
+
+    # One edge between consecutive vertices of the same way
+    positions = np.flatnonzero(is_vertex)
+    a, b = positions[:-1], positions[1:]
+    same_way = way_of[a] == way_of[b]
+    a, b = a[same_way], b[same_way]
+    vertex_ids = np.unique(node_of[positions])
+    src = np.searchsorted(vertex_ids, node_of[a])
+    dst = np.searchsorted(vertex_ids, node_of[b])
+    lengths = distance[b] - distance[a]
+    edge_ways = way_of[a]
+    direction = directions[np.searchsorted(highway_ids, edge_ways)]
+    forward, backward = direction >= 0, direction <= 0
+
+    sources = np.concatenate([src[forward], dst[backward]])
+    targets = np.concatenate([dst[forward], src[backward]])
+    lengths = np.concatenate([lengths[forward], lengths[backward]])
+    edge_ways = np.concatenate([edge_ways[forward], edge_ways[backward]])
+    loops = sources == targets
+    sources, targets = sources[~loops], targets[~loops]
+    lengths, edge_ways = lengths[~loops], edge_ways[~loops]
+
+    order = np.lexsort((targets, sources))
+    offsets = np.zeros(len(vertex_ids) + 1, np.int64)
+    offsets[1:] = np.cumsum(np.bincount(sources, minlength=len(vertex_ids)))
+    vertex_index = np.searchsorted(coord_ids, vertex_ids)
+    graph = RoadGraph(vertex_ids, coord_lat[vertex_index],
+                      coord_lon[vertex_index], offsets,
+                      targets[order].astype(np.int32),
+                      lengths[order].astype(np.float32), edge_ways[order])
+    if graph_dir is not None:
+        graph.save(graph_dir)
+    return graph
+
+
+if __name__ == '__main__':
+    build_road_graph()
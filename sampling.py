@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Module sampling.py selects a deterministic sample of the elements in an
+OpenStreetMaps XML file, so that cleaning rules and audit reports can be
+iterated on quickly before running against a full extract. Two modes are
+supported:
+ - Keep every Kth element of each type (node, way, relation)
+ - Keep a fixed fraction of elements, chosen by a hash of the element id
+
+In both modes the nodes referenced by a sampled way are kept as well, so the
+sample stays referentially consistent. Because the selection depends only on
+the position or id of an element, repeated runs produce identical samples.
+
+Acknowledgments:
+[1] https://en.wikipedia.org/wiki/Hash_function#Fibonacci_hashing
+"""
+
+from collections import defaultdict
+
+from id_sets import SortedIdArray
+
+
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+"""int: 64-bit Fibonacci hashing multiplier used to scramble element ids."""
+
+HASH_MASK = 0xFFFFFFFFFFFFFFFF
+"""int: Mask that truncates products to 64 bits."""
+
+
+def hash_fraction(element_id):
+    """Map an element id to a pseudo-random number in [0, 1).
+
+    Parameters
+    ----------
+    element_id : int
+        The id of an OSM element.
+
+    Returns
+    -------
+    float
+        A number in [0, 1) that depends only on the id.
+    """
+    return (((element_id * HASH_MULTIPLIER) & HASH_MASK) >> 32) / 4294967296.0
+
+
+class ElementSampler(object):
+    """Decide which OSM elements belong to a deterministic sample.
+
+    Parameters
+    ----------
+    sample_every : int
+        Keep every Kth element of each type.
+
+    sample_fraction : float
+        Keep elements whose hashed id falls below this fraction. Ignored if
+        sample_every is given.
+
+    Attributes
+    ----------
+    counts : collections.defaultdict
+        Number of elements of each type passed to keep() so far. Saving and
+        restoring it allows a sample to be resumed part way through a file.
+    """
+
+    def __init__(self, sample_every=None, sample_fraction=None):
+        if not sample_every and not sample_fraction:
+            raise ValueError("Either sample_every or sample_fraction is "
+                             "required.")
+        if sample_fraction is not None and not 0 < sample_fraction <= 1:
+            raise ValueError("sample_fraction must be in (0, 1].")
+        self.sample_every = sample_every
+        self.sample_fraction = None if sample_every else sample_fraction
+        self.way_nodes = SortedIdArray()
+        self.counts = defaultdict(int)
+
+    @property
+    def scale(self):
+        """float: Factor that converts counts in the sample to estimated
+        totals."""
+        if self.sample_every:
+            return float(self.sample_every)
+        return 1.0 / self.sample_fraction
+
+    def _selected(self, tag, element_id, counts):
+        """Apply the sampling rule to a single element.
+
+        Parameters
+        ----------
+        tag : str
+            The element type ('node', 'way' or 'relation').
+
+        element_id : int
+            The id of the element.
+
+        counts : dict
+            Number of elements of each type seen so far; updated in place.
+
+        Returns
+        -------
+        bool
+            True if the element is selected by the sampling rule.
+        """
+        if self.sample_every:
+            index = counts[tag]
+            counts[tag] = index + 1
+            return index % self.sample_every == 0
+        return hash_fraction(element_id) < self.sample_fraction
+
+    def collect_way_nodes(self, ways):
+        """Record the nodes referenced by the sampled ways.
+
+        Parameters
+        ----------
+        ways : iterable
+            The way elements of the OSM file, in file order.
+        """
+        counts = defaultdict(int)
+        for way in ways:
+            if self._selected('way', int(way.get('id')), counts):
+                for nd in way.iter('nd'):
+                    self.way_nodes.add(int(nd.get('ref')))
+
+    def keep(self, element):
+        """Decide whether an element belongs to the sample.
+
+        Elements must be passed in file order, since the every-Kth mode
+        counts the elements seen so far.
+
+        Parameters
+        ----------
+        element : xml.etree.cElementTree.Element
+            A node, way, or relation element of the OSM file.
+
+        Returns
+        -------
+        bool
+            True if the element should be kept.
+        """
+        element_id = int(element.get('id'))
+        selected = self._selected(element.tag, element_id, self.counts)
+        if element.tag == 'node' and not selected:
+            return element_id in self.way_nodes
+        return selected
@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+"""
+Module sketches.py provides counters for the aggregations in audit_tags.py. The
+exact counter keeps one entry per distinct value, which grows without bound on
+planet-scale data. The bounded-memory alternative combines three sketches:
+ - HyperLogLog, for the number of distinct values
+ - Count-Min, for the frequency of any individual value
+ - Space-Saving, for the most frequent values (heavy hitters)
+
+Both counters expose the same interface (add, merge, keys, item lookup, len), so
+the audit functions can use either one, and counts of separate parts of the
+input can be combined.
+
+Acknowledgments:
+[1] Flajolet et al., "HyperLogLog: the analysis of a near-optimal cardinality
+    estimation algorithm", 2007
+[2] Cormode and Muthukrishnan, "An improved data stream summary: the count-min
+    sketch and its applications", 2005
+[3] Metwally et al., "Efficient computation of frequent and top-k elements in
+    data streams", 2005
+"""
+
+from array import array
+from collections import defaultdict
+import hashlib
+import heapq
+import math
+import struct
+
+
+HLL_PRECISION = 14
+"""int: Number of index bits in the HyperLogLog sketch (2**14 registers)."""
+
+CMS_EPSILON = 0.001
+"""float: Count-Min overestimate bound, as a fraction of the total count."""
+
+CMS_DELTA = 0.01
+"""float: Probability that a Count-Min estimate exceeds its bound."""
+
+TOP_K = 200
+"""int: Number of heavy hitters tracked by the Space-Saving sketch."""
+
+MASK_64 = 0xFFFFFFFFFFFFFFFF
+"""int: Mask that truncates integers to 64 bits."""
+
+
+def hash_value(value):
+    """Hash a value to two independent 64-bit integers.
+
+    The hash is stable across processes and interpreter runs, unlike the
+    built-in hash().
+
+    Parameters
+    ----------
+    value : str or unicode
+        The value to be hashed.
+
+    Returns
+    -------
+    tuple
+        Two 64-bit integers.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return struct.unpack('<QQ', hashlib.md5(value).digest())
+
+
+class ExactCounter(defaultdict):
+    """Exact count of every distinct value; a defaultdict(int) with add()."""
+
+    def __init__(self, *args):
+        super(ExactCounter, self).__init__(int, *args)
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def add(self, value, count=1):
+        """Count a value.
+
+        Parameters
+        ----------
+        value : str
+            The value to be counted.
+
+        count : int
+            Number of occurrences to add. Defaults to 1.
+        """
+        self[value] += count
+
+    def merge(self, other):
+        """Add the counts of another counter to this one.
+
+        Parameters
+        ----------
+        other : ExactCounter
+            Counts of the same field over a different part of the input.
+
+        Returns
+        -------
+        ExactCounter
+            This counter, updated in place.
+        """
+        for value, count in other.iteritems():
+            self[value] += count
+        return self
+
+
+class HyperLogLog(object):
+    """Estimate the number of distinct values in a stream.
+
+    Parameters
+    ----------
+    precision : int
+        Number of hash bits used to select a register. The relative standard
+        error of the estimate is 1.04 / sqrt(2**precision).
+    """
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    @property
+    def relative_error(self):
+        """float: Relative standard error of the estimate."""
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add_hash(self, h):
+        """Record a hashed value.
+
+        Parameters
+        ----------
+        h : int
+            A 64-bit hash of the value.
+        """
+        p = self.precision
+        index = h >> (64 - p)
+        rest = h & ((1 << (64 - p)) - 1)
+        rank = (64 - p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Combine with a sketch of the same precision over other values.
+
+        Parameters
+        ----------
+        other : HyperLogLog
+            A sketch of a different part of the input.
+
+        Returns
+        -------
+        HyperLogLog
+            This sketch, updated in place.
+        """
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches of different "
+                             "precision.")
+        self.registers = bytearray(max(a, b) for a, b in
+                                   zip(self.registers, other.registers))
+        return self
+
+    def estimate(self):
+        """Estimate the number of distinct values recorded.
+
+        Returns
+        -------
+        int
+            The estimated cardinality.
+        """
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(b"\x00")
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+
+class CountMinSketch(object):
+    """Estimate the frequency of values in a stream.
+
+    Estimates never undercount; with probability 1 - delta they overcount by
+    at most epsilon times the total count.
+
+    Parameters
+    ----------
+    epsilon : float
+        Overestimate bound, as a fraction of the total count.
+
+    delta : float
+        Probability that an estimate exceeds the bound.
+    """
+
+    def __init__(self, epsilon=CMS_EPSILON, delta=CMS_DELTA):
+        self.epsilon = epsilon
+        self.delta = delta
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1.0 / delta)))
+        self.tables = [array('l', [0]) * self.width for _ in range(self.depth)]
+        self.total = 0
+
+    def _columns(self, h1, h2):
+        """Yield the column of each row for a hashed value."""
+        for i in range(self.depth):
+            yield ((h1 + i * h2) & MASK_64) % self.width
+
+    def add_hash(self, h1, h2, count=1):
+        """Record a hashed value.
+
+        Parameters
+        ----------
+        h1, h2 : int
+            Two independent 64-bit hashes of the value.
+
+        count : int
+            Number of occurrences to add.
+        """
+        for table, column in zip(self.tables, self._columns(h1, h2)):
+            table[column] += count
+        self.total += count
+
+    def estimate_hash(self, h1, h2):
+        """Estimate the count of a hashed value.
+
+        Parameters
+        ----------
+        h1, h2 : int
+            Two independent 64-bit hashes of the value.
+
+        Returns
+        -------
+        int
+            An upper bound on the count, exceeded by at most epsilon * total
+            with probability 1 - delta.
+        """
+        return min(table[column] for table, column in
+                   zip(self.tables, self._columns(h1, h2)))
+
+    def merge(self, other):
+        """Combine with a sketch of the same dimensions over other values.
+
+        Parameters
+        ----------
+        other : CountMinSketch
+            A sketch of a different part of the input.
+
+        Returns
+        -------
+        CountMinSketch
+            This sketch, updated in place.
+        """
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("Cannot merge Count-Min sketches of different "
+                             "dimensions.")
+        for table, other_table in zip(self.tables, other.tables):
+            for column, count in enumerate(other_table):
+                if count:
+                    table[column] += count
+        self.total += other.total
+        return self
+
+    @property
+    def error_bound(self):
+        """int: Maximum overestimate of any count (with probability
+        1 - delta)."""
+        return int(math.ceil(self.epsilon * self.total))
+
+
+class SpaceSaving(object):
+    """Track the most frequent values in a stream with a fixed number of
+    counters.
+
+    Each tracked value has a count and an error; its true count lies between
+    count - error and count. Any value whose true count exceeds total / k is
+    guaranteed to be tracked.
+
+    Parameters
+    ----------
+    k : int
+        Number of counters.
+    """
+
+    def __init__(self, k=TOP_K):
+        self.k = k
+        self.counters = {}
+        self._heap = []
+
+    def add(self, value, count=1):
+        """Count a value.
+
+        Parameters
+        ----------
+        value : str
+            The value to be counted.
+
+        count : int
+            Number of occurrences to add.
+        """
+        counters = self.counters
+        if value in counters:
+            counters[value][0] += count
+        elif len(counters) < self.k:
+            counters[value] = [count, 0]
+        else:
+            min_value, min_count = self._pop_min()
+            del counters[min_value]
+            counters[value] = [min_count + count, min_count]
+        heapq.heappush(self._heap, (counters[value][0], value))
+        if len(self._heap) > 4 * self.k:
+            self._heap = [(c[0], v) for v, c in counters.iteritems()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        """Remove and return the tracked value with the smallest count.
+
+        Heap entries are not updated when a count changes, so stale entries
+        are skipped until one matches the current count of its value.
+        """
+        while True:
+            count, value = heapq.heappop(self._heap)
+            current = self.counters.get(value)
+            if current is not None and current[0] == count:
+                return value, count
+
+    def error(self, value):
+        """Return the maximum overcount of a tracked value."""
+        return self.counters[value][1]
+
+    def _floor(self):
+        """Return the largest count an untracked value could have."""
+        if len(self.counters) < self.k:
+            return 0
+        return min(c[0] for c in self.counters.itervalues())
+
+    def merge(self, other):
+        """Combine with a summary of other values, keeping the k largest.
+
+        A value missing from one summary may have occurred up to that
+        summary's smallest count, which is added to both its count and error.
+
+        Parameters
+        ----------
+        other : SpaceSaving
+            A summary of a different part of the input.
+
+        Returns
+        -------
+        SpaceSaving
+            This summary, updated in place.
+        """
+        floor, other_floor = self._floor(), other._floor()
+        merged = {}
+        for value in set(self.counters) | set(other.counters):
+            count, error = self.counters.get(value, (floor, floor))
+            other_count, other_error = other.counters.get(
+                value, (other_floor, other_floor))
+            merged[value] = [count + other_count, error + other_error]
+        largest = heapq.nlargest(self.k, merged.iteritems(),
+                                 key=lambda item: (item[1][0], item[0]))
+        self.counters = dict(largest)
+        self._heap = [(c[0], v) for v, c in self.counters.iteritems()]
+        heapq.heapify(self._heap)
+        return self
+
+
+class FieldSketch(object):
+    """Bounded-memory replacement for an exact counter of distinct values.
+
+    Iterating over the sketch (or calling keys()) returns the tracked heavy
+    hitters only; len() returns the estimated number of distinct values.
+
+    Parameters
+    ----------
+    precision : int
+        HyperLogLog precision.
+
+    epsilon : float
+        Count-Min overestimate bound, as a fraction of the total count.
+
+    delta : float
+        Probability that a Count-Min estimate exceeds its bound.
+
+    k : int
+        Number of heavy hitters tracked.
+    """
+
+    def __init__(self, precision=HLL_PRECISION, epsilon=CMS_EPSILON,
+                 delta=CMS_DELTA, k=TOP_K):
+        self.distinct = HyperLogLog(precision)
+        self.frequencies = CountMinSketch(epsilon, delta)
+        self.top = SpaceSaving(k)
+
+    def add(self, value, count=1):
+        """Count a value.
+
+        Parameters
+        ----------
+        value : str
+            The value to be counted.
+
+        count : int
+            Number of occurrences to add. Defaults to 1.
+        """
+        h1, h2 = hash_value(value)
+        self.distinct.add_hash(h1)
+        self.frequencies.add_hash(h1, h2, count)
+        self.top.add(value, count)
+
+    def merge(self, other):
+        """Combine with a sketch of the same field over other values.
+
+        Parameters
+        ----------
+        other : FieldSketch
+            A sketch of a different part of the input.
+
+        Returns
+        -------
+        FieldSketch
+            This sketch, updated in place.
+        """
+        self.distinct.merge(other.distinct)
+        self.frequencies.merge(other.frequencies)
+        self.top.merge(other.top)
+        return self
+
+    def __getitem__(self, value):
+        if value in self.top.counters:
+            return self.top.counters[value][0]
+        return self.frequencies.estimate_hash(*hash_value(value))
+
+    def __contains__(self, value):
+        return value in self.top.counters
+
+    def __iter__(self):
+        return iter(self.top.counters)
+
+    def __len__(self):
+        return self.distinct.estimate()
+
+    def keys(self):
+        """Return the tracked heavy hitters."""
+        return self.top.counters.keys()
+
+    def error(self, value):
+        """Return the maximum overcount of a value's count."""
+        if value in self.top.counters:
+            return self.top.error(value)
+        return self.frequencies.error_bound
+
+    @property
+    def total(self):
+        """int: Total number of values counted."""
+        return self.frequencies.total
@@ -9,108 +9,161 @@ Acknowledgments:
 """
 
 
-import matplotlib.pyplot as plt
-import numpy as np
 from pprint import pprint
-import seaborn
 import sqlite3
 
+from query_cache import QueryCache, fetchall
+
 
 DB = 'mydb.db'
 """str: Path to the sqlite database to be queried."""
 
+CACHE = QueryCache()
+"""query_cache.QueryCache: Default cache of query results. Results are
+invalidated when csv_to_database.py reloads the database."""
+
+ENCODED_TABLES = {'nodes': 'nodes_data', 'ways': 'ways_data',
+                  'nodes_tags': 'nodes_tags_data',
+                  'ways_tags': 'ways_tags_data'}
+"""dict: Tables of the dictionary-encoded schema of csv_to_database.py behind
+each compatibility view. Queries that need no user name, tag key or tag type
+read them directly, since the views join every row to the lookup tables."""
+
 
 ################################################################################
 #                              HELPER FUNCTIONS                                #
 ################################################################################
 
-def db_statistics(db=DB):
+def table_names(conn):
+    """Return the tables to be queried for each table of the plain schema.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the database.
+
+    Returns
+    -------
+    dict
+        The plain table names, mapped to the encoded tables of ENCODED_TABLES
+        if the database uses the dictionary-encoded schema, or to themselves.
+    """
+    encoded = conn.execute("SELECT COUNT(*) FROM sqlite_master "
+                           "WHERE type = 'table' AND name = 'nodes_data'"
+                           ).fetchone()[0]
+    if encoded:
+        return dict(ENCODED_TABLES)
+    return dict((name, name) for name in ENCODED_TABLES)
+
+
+def db_statistics(db=DB, cache=CACHE):
     """Collect basic statistics on the database.
     
     Parameters
     ----------
     db : str
         Path to the sqlite database to be queried.
+
+    cache : query_cache.QueryCache
+        Cache of query results, or None to always run the queries.
     """
     conn = sqlite3.connect(db)
-    cur = conn.cursor()
-    
+    tables = table_names(conn)
+
     # Count the number of unique users in the entire OSM file
     query = '''SELECT COUNT(DISTINCT(subquery.uid))
                FROM
-                   (SELECT uid FROM nodes
+                   (SELECT uid FROM %(nodes)s
                     UNION ALL
-                    SELECT uid FROM ways)
-                   AS subquery;'''
-    cur.execute(query)
-    results = cur.fetchall()
+                    SELECT uid FROM %(ways)s)
+                   AS subquery;''' % tables
+    results = fetchall(conn, db, query, cache=cache)
     print "Number of unique users in the database is: %d" % results[0]
     
     # Identify the most active users and their number of contributions
-    query = '''SELECT subquery.user, count(*) AS num
-               FROM
-                   (SELECT user from nodes
-                    UNION ALL
-                    SELECT user from ways)
-                   AS subquery
-               GROUP BY subquery.user
-               ORDER BY num DESC
-               LIMIT 10;'''
-    cur.execute(query)
-    results = cur.fetchall()
+    if tables['nodes'] == 'nodes':
+        query = '''SELECT subquery.user, count(*) AS num
+                   FROM
+                       (SELECT user from nodes
+                        UNION ALL
+                        SELECT user from ways)
+                       AS subquery
+                   GROUP BY subquery.user
+                   ORDER BY num DESC
+                   LIMIT 10;'''
+    else:
+        # Group on the user ids, and look up the names of the top users only
+        query = '''SELECT users.user, top.num
+                   FROM
+                       (SELECT subquery.user_id, count(*) AS num
+                        FROM
+                            (SELECT user_id from nodes_data
+                             UNION ALL
+                             SELECT user_id from ways_data)
+                            AS subquery
+                        GROUP BY subquery.user_id
+                        ORDER BY num DESC
+                        LIMIT 10)
+                       AS top
+                   JOIN users ON users.id = top.user_id
+                   ORDER BY top.num DESC;'''
+    results = fetchall(conn, db, query, cache=cache)
     print "Top contributors|Number of contibutions: "
     for user, contribs in results:
         print "%s|%r" % (user, contribs)
     
     # Count the total number of nodes
     query = '''SELECT COUNT(*)
-			   FROM nodes;'''
-    cur.execute(query)
-    results = cur.fetchall()
+			   FROM %(nodes)s;''' % tables
+    results = fetchall(conn, db, query, cache=cache)
     print "Number of nodes: %d" % results[0]
     
     # Count the total number of ways
     query = '''SELECT COUNT(*)
-			   FROM ways;'''
-    cur.execute(query)
-    results = cur.fetchall()
+			   FROM %(ways)s;''' % tables
+    results = fetchall(conn, db, query, cache=cache)
     print "Nuber of ways: %d" % results[0]
 
     # Count the number of nodes and ways related to restaurants
     query = '''SELECT COUNT(DISTINCT(value))
                FROM 
-                   (SELECT value from nodes_tags
+                   (SELECT value from %(nodes_tags)s
                     UNION ALL
-                    SELECT value from ways_tags)
-                   AS subquery 
-               WHERE subquery.value LIKE "%restaurant%";'''
-    cur.execute(query)
-    results = cur.fetchall()
+                    SELECT value from %(ways_tags)s)
+                   AS subquery
+               WHERE subquery.value LIKE "%%restaurant%%";''' % tables
+    results = fetchall(conn, db, query, cache=cache)
     print "Number of restaurants: %d" %  results[0]
         
     # Count the number of school nodes
     query = '''SELECT COUNT(DISTINCT(value))
                FROM 
-                   (SELECT value from nodes_tags
+                   (SELECT value from %(nodes_tags)s
                     UNION ALL
-                    SELECT value from ways_tags)
-                   AS subquery 
-               WHERE subquery.value LIKE "%school%";'''
-    cur.execute(query)
-    results = cur.fetchall()
+                    SELECT value from %(ways_tags)s)
+                   AS subquery
+               WHERE subquery.value LIKE "%%school%%";''' % tables
+    results = fetchall(conn, db, query, cache=cache)
     print "Number of schools: %d" % results[0]
                 
         
-def distribution_way_nodes(db=DB):
+def distribution_way_nodes(db=DB, cache=CACHE):
     """Characterize the number of nodes that are associated with ways.
     
     Parameters
     ----------
     db : str
         Path to the sqlite database to be queried.
+
+    cache : query_cache.QueryCache
+        Cache of query results, or None to always run the queries.
     """
+    # The plotting libraries are slow to import, so they are only imported
+    # by the query that plots
+    import matplotlib.pyplot as plt
+    import seaborn
+
     conn = sqlite3.connect(db)
-    cur = conn.cursor()
 
     # Calculate the average number of nodes associated with a way
     query = '''SELECT AVG(num)
@@ -120,8 +173,7 @@ def distribution_way_nodes(db=DB):
                     GROUP BY id)
                    AS subquery;'''
     
-    cur.execute(query)
-    results = cur.fetchall()
+    results = fetchall(conn, db, query, cache=cache)
     print "Average nodes associated with each way: %d" % results[0]
 
     # Plot a histogram of the distribution of number of nodes per way
@@ -129,8 +181,7 @@ def distribution_way_nodes(db=DB):
 			   FROM ways_nodes
 			   GROUP BY id
 			   ORDER BY num DESC;'''
-    cur.execute(query)
-    results = cur.fetchall()
+    results = fetchall(conn, db, query, cache=cache)
     results = [result[0] for result in results]
     plt.hist(results, bins=100, range=(0, 100))
     plt.title('Distribution of Number of Nodes per Way')
@@ -141,17 +192,19 @@ def distribution_way_nodes(db=DB):
     conn.close()
 
 
-def describe_large_ways(db=DB):
+def describe_large_ways(db=DB, cache=CACHE):
     """Output ways with the most number of nodes; Include tag information.
     
     Parameters
     ----------
     db : str
         Path to the sqlite database to be queried.
+
+    cache : query_cache.QueryCache
+        Cache of query results, or None to always run the queries.
     """
 
     conn = sqlite3.connect(db)
-    cur = conn.cursor()
 
     query = '''SELECT subquery.id, num, key, value, type
 			   FROM 
@@ -165,8 +218,7 @@ def describe_large_ways(db=DB):
 			   ON subquery.id=ways_tags.id
 			   ORDER BY num DESC
 			   LIMIT 10;'''
-    cur.execute(query)
-    results = cur.fetchall()
+    results = fetchall(conn, db, query, cache=cache)
     print "way id|num nodes|key|value|type"
     for (id, num, key, value, type) in results:
         print "%d|%d|%s|%s|%s" % (id, num, key, value, type)  
@@ -176,17 +228,20 @@ def describe_large_ways(db=DB):
 #                                MAIN FUNCTION                                 #
 ################################################################################
 
-def run_all_queries(db=DB):
+def run_all_queries(db=DB, cache=CACHE):
     """Run all SQL queries from helper functions.
     
     Parameters
     ----------
     db : str
         Path to the sqlite database to be queried.
+
+    cache : query_cache.QueryCache
+        Cache of query results, or None to always run the queries.
     """
-    db_statistics(db)
-    distribution_way_nodes(db)
-    describe_large_ways(db)
+    db_statistics(db, cache)
+    distribution_way_nodes(db, cache)
+    describe_large_ways(db, cache)
 
 
 if __name__ == '__main__':			   
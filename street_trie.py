@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Module street_trie.py expands abbreviations in street names with a token trie
+compiled once from a mapping table. Mapping keys may be single tokens ('St')
+or multi-token phrases ('St N', 'Co Rd'); at each position of a street name
+the longest matching phrase is replaced. A street name is scanned once, and
+the cost per token is bounded by the length of the longest phrase rather than
+the size of the mapping.
+
+Acknowledgments:
+[1] https://en.wikipedia.org/wiki/Trie
+"""
+
+from collections import OrderedDict
+
+
+VALUE = None
+"""NoneType: Trie node key holding the replacement of the phrase ending at the
+node. Tokens produced by str.split() are never None."""
+
+MEMO_SIZE = 100000
+"""int: Maximum number of expanded street names remembered by a trie."""
+
+
+class AbbreviationTrie(object):
+    """Token trie that replaces abbreviated words and phrases.
+
+    Parameters
+    ----------
+    mapping : dict
+        Abbreviations (single tokens or space separated phrases) and their
+        full forms.
+    """
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        self.root = {}
+        for phrase, replacement in mapping.iteritems():
+            node = self.root
+            for token in phrase.split():
+                node = node.setdefault(token, {})
+            node[VALUE] = replacement
+        self._memo = {}
+
+    def expand(self, street):
+        """Expand the abbreviations in a street name.
+
+        Parameters
+        ----------
+        street : str
+            The name of a street to be cleaned.
+
+        Returns
+        -------
+        str
+            The street name with each abbreviation replaced by its full form
+            and whitespace normalized to single spaces.
+        """
+        memo = self._memo
+        if street in memo:
+            return memo[street]
+
+        tokens = street.split()
+        expanded = []
+        i = 0
+        n = len(tokens)
+        while i < n:
+            node = self.root
+            match = None
+            j = i
+            while j < n:
+                node = node.get(tokens[j])
+                if node is None:
+                    break
+                j += 1
+                if VALUE in node:
+                    match = (j, node[VALUE])
+            if match is None:
+                expanded.append(tokens[i])
+                i += 1
+            else:
+                i, replacement = match
+                expanded.append(replacement)
+        result = ' '.join(expanded)
+
+        if len(memo) >= MEMO_SIZE:
+            memo.clear()
+        memo[street] = result
+        return result
+
+    def expand_all(self, streets):
+        """Expand the abbreviations in a list of street names.
+
+        Each distinct name is expanded once.
+
+        Parameters
+        ----------
+        streets : list
+            Street names to be cleaned.
+
+        Returns
+        -------
+        list
+            The cleaned street names, in the same order.
+        """
+        expanded = {}
+        for street in streets:
+            if street not in expanded:
+                expanded[street] = self.expand(street)
+        return [expanded[street] for street in streets]
+
+
+_TRIES = OrderedDict()
+
+TRIE_CACHE_SIZE = 16
+"""int: Maximum number of compiled tries kept by get_trie."""
+
+
+def get_trie(mapping):
+    """Return the compiled trie for a mapping, compiling it on first use.
+
+    Tries are cached by mapping identity, so a mapping must not be modified
+    after its first use.
+
+    Parameters
+    ----------
+    mapping : dict
+        Abbreviations and their full forms.
+
+    Returns
+    -------
+    AbbreviationTrie
+        The compiled trie.
+    """
+    trie = _TRIES.get(id(mapping))
+    if trie is None or trie.mapping is not mapping:
+        trie = _TRIES[id(mapping)] = AbbreviationTrie(mapping)
+        if len(_TRIES) > TRIE_CACHE_SIZE:
+            _TRIES.popitem(last=False)
+    return trie
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Script tile_grid.py pre-aggregates the database created by csv_to_database.py
+into a multi-zoom grid of map tiles, so that map overlays can be served without
+scanning the 'nodes' table for every viewport. Nodes and the centroids of ways
+are bucketed into the z/x/y tiles of the Web Mercator tiling scheme used by
+OpenStreetMap. Every tile stores, for each tag category (e.g. 'amenity'):
+ - the number of nodes and ways in the tile
+ - the ids of those nodes and ways, as packed 64-bit integers, unless the
+   tile holds more than MAX_TILE_IDS features
+
+The rows are kept in the clustered table 'tile_features', keyed on
+(category, z, x, y), so a viewport is read as a handful of index range scans.
+
+Acknowledgments:
+[1] https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
+[2] https://www.sqlite.org/withoutrowid.html
+"""
+
+import sqlite3
+
+import numpy as np
+
+from osm_utils import iter_batches
+from query_cache import bump_generation
+
+
+DB = 'mydb.db'
+"""str: Path to the sqlite database to be aggregated."""
+
+ZOOMS = range(8, 17)
+"""list: Zoom levels of the tile grid."""
+
+CATEGORY_KEYS = ('amenity', 'shop', 'tourism', 'leisure', 'highway',
+                 'building')
+"""tuple: Tag keys whose features are aggregated, one category per key."""
+
+ALL_FEATURES = '*'
+"""str: Category counting every node and way, whether tagged or not."""
+
+MAX_TILE_IDS = 1000
+"""int: Maximum number of feature ids stored for a tile and category. Only the
+counts are stored for denser tiles."""
+
+MAX_LATITUDE = 85.0511287798
+"""float: Latitude at which the Web Mercator projection is cut off."""
+
+TILE_SCHEMA = '''CREATE TABLE tile_features(
+                 category TEXT,
+                 z INTEGER,
+                 x INTEGER,
+                 y INTEGER,
+                 count INTEGER,
+                 node_ids BLOB,
+                 way_ids BLOB,
+                 PRIMARY KEY (category, z, x, y)) WITHOUT ROWID'''
+"""str: Statement creating the tile table."""
+
+
+################################################################################
+#                              HELPER FUNCTIONS                                #
+################################################################################
+
+def tile_coordinates(lat, lon, zoom):
+    """Return the tile containing each point at a zoom level.
+
+    Parameters
+    ----------
+    lat, lon : numpy.ndarray
+        Coordinates of the points in degrees.
+
+    zoom : int
+        The zoom level.
+
+    Returns
+    -------
+    tuple
+        Numpy arrays of the x and y tile numbers.
+    """
+    n = 1 << zoom
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = np.floor((np.asarray(lon) + 180.0) / 360.0 * n)
+    y = np.floor((1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi)
+                 / 2.0 * n)
+    return (np.clip(x, 0, n - 1).astype(np.int64),
+            np.clip(y, 0, n - 1).astype(np.int64))
+
+
+def pack_ids(ids):
+    """Pack feature ids into a blob of little-endian 64-bit integers."""
+    return buffer(np.asarray(ids, dtype='<i8').tostring())
+
+
+def unpack_ids(blob):
+    """Unpack a blob written by pack_ids into a list of ids, or None."""
+    if blob is None:
+        return None
+    return np.frombuffer(bytes(blob), dtype='<i8').tolist()
+
+
+def read_features(conn, category_keys=CATEGORY_KEYS):
+    """Stream the position and category of every feature to be aggregated.
+
+    Ways are positioned at the centroid of their nodes.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the database.
+
+    category_keys : tuple
+        Tag keys aggregated as categories.
+
+    Returns
+    -------
+    tuple
+        Numpy arrays with, for each feature and category it belongs to: the
+        category index (len(category_keys) for ALL_FEATURES), 0 for nodes or
+        1 for ways, the id, the latitude and the longitude.
+    """
+    index = dict((key, i) for i, key in enumerate(category_keys))
+    index[ALL_FEATURES] = len(category_keys)
+    placeholders = ', '.join('?' * len(category_keys))
+
+    conn.execute('DROP TABLE IF EXISTS temp.way_centroids')
+    conn.execute('''CREATE TEMP TABLE way_centroids AS
+                    SELECT wn.id AS id, AVG(n.lat) AS lat, AVG(n.lon) AS lon
+                    FROM ways_nodes wn JOIN nodes n ON n.id = wn.node_id
+                    GROUP BY wn.id;''')
+    cur = conn.execute('''SELECT ?, 0, id, lat, lon FROM nodes
+                          UNION ALL
+                          SELECT ?, 1, id, lat, lon FROM temp.way_centroids
+                          UNION ALL
+                          SELECT t.key, 0, n.id, n.lat, n.lon
+                          FROM nodes_tags t JOIN nodes n ON n.id = t.id
+                          WHERE t.type = 'regular' AND t.key IN (%s)
+                          UNION ALL
+                          SELECT t.key, 1, c.id, c.lat, c.lon
+                          FROM ways_tags t
+                          JOIN temp.way_centroids c ON c.id = t.id
+                          WHERE t.type = 'regular' AND t.key IN (%s);'''
+                       % (placeholders, placeholders),
+                       (ALL_FEATURES, ALL_FEATURES) + tuple(category_keys) * 2)
+    chunks = [[], [], [], [], []]
+    for rows in iter_batches(cur):
+        categories, kinds, ids, lats, lons = zip(*rows)
+        chunks[0].append(np.array([index[c] for c in categories], np.int64))
+        chunks[1].append(np.array(kinds, np.int8))
+        chunks[2].append(np.array(ids, np.int64))
+        chunks[3].append(np.array(lats, float))
+        chunks[4].append(np.array(lons, float))
+    conn.execute('DROP TABLE temp.way_centroids')
+    dtypes = (np.int64, np.int8, np.int64, float, float)
+    return tuple(np.concatenate(chunk) if chunk else np.zeros(0, dtype)
+                 for chunk, dtype in zip(chunks, dtypes))
+
+
+def aggregate_zoom(categories, kinds, ids, x, y, category_names):
+    """Group the features of one zoom level by category and tile.
+
+    Parameters
+    ----------
+    categories, kinds, ids : numpy.ndarray
+        Category index, kind (0 for nodes, 1 for ways) and id of each
+        feature, as returned by read_features.
+
+    x, y : numpy.ndarray
+        Tile numbers of each feature at the zoom level.
+
+    category_names : list
+        Name of each category index.
+
+    Yields
+    ------
+    tuple
+        (category, x, y, count, node_ids, way_ids) for each non-empty tile and
+        category, the id blobs being None for tiles with more than
+        MAX_TILE_IDS features.
+    """
+    if not len(ids):
+        return
+    order = np.lexsort((ids, kinds, y, x, categories))
+    categories, kinds, ids = categories[order], kinds[order], ids[order]
+    x, y = x[order], y[order]
+    boundaries = np.flatnonzero((np.diff(categories) != 0) |
+                                (np.diff(x) != 0) | (np.diff(y) != 0)) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [len(ids)]])
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        node_ids = way_ids = None
+        if end - start <= MAX_TILE_IDS:
+            tile_kinds = kinds[start:end]
+            tile_ids = ids[start:end]
+            node_ids = pack_ids(tile_ids[tile_kinds == 0])
+            way_ids = pack_ids(tile_ids[tile_kinds == 1])
+        yield (category_names[categories[start]], int(x[start]),
+               int(y[start]), end - start, node_ids, way_ids)
+
+
+def tile_range(bbox, zoom):
+    """Return the range of tiles covering a bounding box.
+
+    Parameters
+    ----------
+    bbox : tuple
+        (min_lat, min_lon, max_lat, max_lon) in degrees.
+
+    zoom : int
+        The zoom level.
+
+    Returns
+    -------
+    tuple
+        (min_x, max_x, min_y, max_y), inclusive.
+    """
+    min_lat, min_lon, max_lat, max_lon = bbox
+    x, y = tile_coordinates(np.array([max_lat, min_lat]),
+                            np.array([min_lon, max_lon]), zoom)
+    return int(x[0]), int(x[1]), int(y[0]), int(y[1])
+
+
+def query_viewport(bbox, zoom, category=ALL_FEATURES, db=DB):
+    """Read the pre-aggregated tiles covering a viewport.
+
+    Parameters
+    ----------
+    bbox : tuple
+        (min_lat, min_lon, max_lat, max_lon) of the viewport in degrees.
+
+    zoom : int
+        Zoom level of the tiles, one of the levels in the grid.
+
+    category : str
+        A tag key in CATEGORY_KEYS, or ALL_FEATURES.
+
+    db : str
+        Path to the sqlite database.
+
+    Returns
+    -------
+    list
+        (x, y, count, node_ids, way_ids) for each non-empty tile, where the
+        id lists are None for tiles with more than MAX_TILE_IDS features.
+    """
+    min_x, max_x, min_y, max_y = tile_range(bbox, zoom)
+    conn = sqlite3.connect(db)
+    try:
+        rows = conn.execute('''SELECT x, y, count, node_ids, way_ids
+                               FROM tile_features
+                               WHERE category = ? AND z = ?
+                               AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?
+                               ORDER BY x, y;''',
+                            (category, zoom, min_x, max_x, min_y, max_y))
+        return [(x, y, count, unpack_ids(node_ids), unpack_ids(way_ids))
+                for x, y, count, node_ids, way_ids in rows]
+    finally:
+        conn.close()
+
+
+################################################################################
+#                                MAIN FUNCTION                                 #
+################################################################################
+
+def build_tile_grid(db=DB, zooms=ZOOMS, category_keys=CATEGORY_KEYS):
+    """Build the 'tile_features' table of a database, replacing any previous
+    grid. Run after csv_to_database.py.
+
+    Parameters
+    ----------
+    db : str
+        Path to the sqlite database.
+
+    zooms : list
+        Zoom levels of the grid.
+
+    category_keys : tuple
+        Tag keys aggregated as categories.
+    """
+    conn = sqlite3.connect(db)
+    try:
+        categories, kinds, ids, lats, lons = read_features(conn,
+                                                           category_keys)
+        category_names = list(category_keys) + [ALL_FEATURES]
+
+        # Tiles at lower zoom levels are found by dropping bits of the tile
+        # numbers at the highest level
+        max_zoom = max(zooms)
+        max_x, max_y = tile_coordinates(lats, lons, max_zoom)
+
+        conn.execute('DROP TABLE IF EXISTS tile_features')
+        conn.execute(TILE_SCHEMA)
+        for zoom in zooms:
+            shift = max_zoom - zoom
+            rows = aggregate_zoom(categories, kinds, ids, max_x >> shift,
+                                  max_y >> shift, category_names)
+            conn.executemany('''INSERT INTO tile_features(category, z, x, y,
+                                count, node_ids, way_ids)
+                                VALUES (?, %d, ?, ?, ?, ?, ?);''' % zoom,
+                             rows)
+        conn.commit()
+        bump_generation(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    build_tile_grid()